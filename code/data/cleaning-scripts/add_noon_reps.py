@@ -1,10 +1,16 @@
 import os
 import glob
+import argparse
 import pandas as pd
 import numpy as np
 from loguru import logger
 from config import NOON_REPORT_QIDS, NOON_REPORT_UNITS
 from multiprocessing import Pool, cpu_count
+from appended_store import LONG_TABLE_DIR_NAME, timestamps_to_int64, write_long_table
+from long_table import full_precision_qids, parse_numeric_values, qid_codes, to_compact_long
+from metadata import load_catalog
+from merge_ingest import time_deltas
+from ingest_manifest import NOON_REPORT_MANIFEST_NAME, empty_manifest, last_timestamps_array, load_manifest, plan_ingest, save_manifest, update_manifest
 
 # Defining prerequisites for appending loop
 # Get the directory where THIS script is located
@@ -20,9 +26,11 @@ columns = [
 
 # Define paths relative to script location
 appended_data_dir = os.path.join(script_dir, '..', 'appended')
+long_table_dir = os.path.join(appended_data_dir, LONG_TABLE_DIR_NAME)
 noon_rep_qid_dict = NOON_REPORT_QIDS
 noon_rep_units_dict = NOON_REPORT_UNITS
 raw_noon_reports_dir = os.path.join(script_dir, '..', 'raw', 'unzipped', 'Noon Reports')
+manifest_path = os.path.join(long_table_dir, NOON_REPORT_MANIFEST_NAME)
 
 # Parallel file reading and processing function
 def process_noon_report_file(file_path):
@@ -40,69 +48,113 @@ def process_noon_report_file(file_path):
     
     # Add a column called "qid_mapping" that contains maps the quantity names to their QID dummies
     melted_df['qid_mapping'] = melted_df['quantity_name'].map(noon_rep_qid_dict)
+    unmapped = melted_df.loc[melted_df['qid_mapping'].isna(), 'quantity_name'].unique()
+    if len(unmapped):
+        logger.warning(f'Noon report columns without a qid in NOON_REPORT_QIDS are not stored: {list(unmapped)}')
     
     # Arrange the columns in the same order as specified in the columns list
     melted_df = melted_df[['utc_timestamp', 'qid_mapping', 'value', 'quantity_name']]
     
     return melted_df
 
-# Get all noon report files
-all_files = glob.glob(os.path.join(raw_noon_reports_dir, '*.csv'))
-logger.info(f'Found {len(all_files)} noon report files to process')
-
-# Read and process files in parallel
-with Pool(min(cpu_count() - 1, len(all_files))) as pool:
-    dfs = pool.map(process_noon_report_file, all_files)
-
-# Concatenate all dataframes at once (much faster than iterative concat)
-appended_df = pd.concat(dfs, ignore_index=True)
-logger.info(f'Successfully processed all noon reports. Total shape: {appended_df.shape}')    
-
-# drop rows where the value is NaN
-logger.info(f'Shape before dropping NaN values: {appended_df.shape}')
-appended_df = appended_df.dropna(subset=['value'])
-logger.info(f'Dropped NaN values. Shape is now: {appended_df.shape}')
-
-# add needed columns to match excl. noon reports dataframe
-
-# Change utc_timestamp column to datetime with UTC (for consistency), although timezones are not known
-appended_df['utc_timestamp'] = pd.to_datetime(appended_df['utc_timestamp']).dt.tz_convert('UTC')
-
-# add a "source_name" column with value "Noon Report"
-appended_df['source_name'] = 'Noon Report'
-
-# add a "unit" column by mapping the quantity_name column to the units in the NOON_REPORT_UNITS dictionary
-appended_df['unit'] = appended_df['quantity_name'].map(noon_rep_units_dict)
-
-# add a column for time delta between observations for each variable (measuring only the difference between a given observation and the last observation of that qid_mapping)
-logger.info(f'shape before adding time_delta: {appended_df.shape}')
-appended_df['time_delta_sec'] = appended_df.groupby('qid_mapping')['utc_timestamp'].diff().dt.total_seconds()
-logger.info(f'Added time_delta column to noon reports dataframe. Shape is now: {appended_df.shape}')
-
-# save the noon report data only as a separate csv file for reference
-appended_df.to_csv(os.path.join(appended_data_dir, 'noon_reports_only.csv'), index=False)
-
-# load the dataframe containing all the appended sensor observations
-excl_noon_reps_df = pd.read_csv(os.path.join(appended_data_dir, 'excl_noon_reports.csv'))
-logger.info(f'Loaded appended sensor observations excl. noon reports with shape: {excl_noon_reps_df.shape}')
-
-# set the column "utc_timestamp" to datetime with UTC timezone if not already
-excl_noon_reps_df['utc_timestamp'] = pd.to_datetime(excl_noon_reps_df['utc_timestamp'], format='ISO8601').dt.tz_convert('UTC')
-
-# append all the noon report observations to the dataframe containing all the sensor observations
-full_appended_df = pd.concat([excl_noon_reps_df, appended_df], ignore_index=True)
-logger.info(f'Appended noon reports. New shape: {full_appended_df.shape}')
-logger.info(f'Columns in appended dataframe excl. sensors: {appended_df.columns.tolist()}')
-logger.info(f'Columns in appended dataframe excl. noon reports: {excl_noon_reps_df.columns.tolist()}')
-logger.info(f'Columns in full appended dataframe: {full_appended_df.columns.tolist()}')
-logger.info(f'distribution of dtypes in utc_timestamp columns: {full_appended_df["utc_timestamp"].apply(type).value_counts()}')
-
-# sort by utc_timestamp for consistency
-full_appended_df = full_appended_df.sort_values(by='utc_timestamp').reset_index(drop=True)
-logger.info(f'Sorted full appended dataframe by utc_timestamp.')
-
-# save the full appended dataframe to the appended data folder
-full_appended_df.to_csv(os.path.join(appended_data_dir, 'incl_noon_reports.csv'), index=False)
-logger.info(f'Saved full appended dataframe with noon reports to CSV.')
-
-
+def read_noon_report_files(keys):
+    # Read and process files in parallel
+    with Pool(max(1, min(cpu_count() - 1, len(keys)))) as pool:
+        dfs = pool.map(process_noon_report_file, [os.path.join(raw_noon_reports_dir, key) for key in keys])
+    return dict(zip(keys, dfs))
+
+def add_noon_reps(full=False):
+    """
+    This function adds the noon reports to their own partitions of the long table store (pipeline stage).
+    Only noon report files that are not in the ingest manifest yet are added, unless full is True.
+
+    Args:
+        full: If True, all noon report files are re-ingested and the noon report partitions are rebuilt.
+
+    Returns:
+        Number of added noon report observations.
+    """
+    # Get all noon report files and compare them with the ingest manifest (size, modification time and sha256 hash)
+    all_files = glob.glob(os.path.join(raw_noon_reports_dir, '*.csv'))
+    logger.info(f'Found {len(all_files)} noon report files')
+    manifest = None if full else load_manifest(manifest_path)
+    fingerprints, new_files, changed_files = plan_ingest(all_files, raw_noon_reports_dir, manifest)
+    full_rebuild = manifest is None or len(changed_files) > 0
+    if changed_files:
+        logger.warning(f'{len(changed_files)} already ingested noon report file(s) were changed or removed, rebuilding the noon report partitions: {changed_files}')
+    if not full_rebuild and not new_files:
+        logger.info('All noon report files are already ingested, nothing to add')
+        return 0
+
+    files_to_read = list(fingerprints) if full_rebuild else new_files
+    logger.info(f'{"Full rebuild" if full_rebuild else "Incremental append"}: processing {len(files_to_read)} noon report file(s)')
+    dfs = read_noon_report_files(files_to_read)
+
+    # new noon reports can only be appended behind the existing ones, otherwise the partitions would not be time ordered anymore
+    if not full_rebuild and manifest['max_timestamp'] is not None:
+        min_new_timestamp = min((df['utc_timestamp'].min() for df in dfs.values() if len(df)), default=None)
+        if min_new_timestamp is not None and min_new_timestamp < pd.Timestamp(manifest['max_timestamp'], unit='ns', tz='UTC'):
+            logger.warning('New noon reports are older than the already ingested ones, rebuilding the noon report partitions')
+            full_rebuild = True
+            dfs.update(read_noon_report_files([key for key in fingerprints if key not in dfs]))
+            dfs = {key: dfs[key] for key in fingerprints}
+    if full_rebuild:
+        manifest = empty_manifest()
+    rows_per_file = {key: len(df) for key, df in dfs.items()}
+
+    # Concatenate all dataframes at once (much faster than iterative concat)
+    appended_df = pd.concat(list(dfs.values()), ignore_index=True)
+    logger.info(f'Successfully processed all noon reports. Total shape: {appended_df.shape}')    
+
+    # drop rows where the value is NaN
+    logger.info(f'Shape before dropping NaN values: {appended_df.shape}')
+    appended_df = appended_df.dropna(subset=['value'])
+    logger.info(f'Dropped NaN values. Shape is now: {appended_df.shape}')
+
+    # add needed columns to match excl. noon reports dataframe
+
+    # Change utc_timestamp column to datetime with UTC (for consistency), although timezones are not known
+    appended_df['utc_timestamp'] = pd.to_datetime(appended_df['utc_timestamp']).dt.tz_convert('UTC')
+
+    # add a "source_name" column with value "Noon Report"
+    appended_df['source_name'] = 'Noon Report'
+
+    # add a "unit" column by mapping the quantity_name column to the units in the NOON_REPORT_UNITS dictionary
+    appended_df['unit'] = appended_df['quantity_name'].map(noon_rep_units_dict)
+
+    # sort by utc_timestamp for consistency
+    appended_df = appended_df.sort_values(by='utc_timestamp').reset_index(drop=True)
+
+    # add a column for time delta between observations for each variable (measuring only the difference between a given observation and the last observation of that qid_mapping)
+    logger.info(f'shape before adding time_delta: {appended_df.shape}')
+    # the last timestamp per qid of the already ingested noon reports comes from the manifest
+    qid_lookup = load_catalog()
+    last_timestamps = last_timestamps_array(manifest, qid_lookup)
+    appended_df['time_delta_sec'] = time_deltas(timestamps_to_int64(appended_df['utc_timestamp']), qid_codes(appended_df['qid_mapping'], qid_lookup), last_timestamps)
+    logger.info(f'Added time_delta column to noon reports dataframe. Shape is now: {appended_df.shape}')
+
+    # save the noon report data only as a separate csv file for reference (with the raw, unparsed values)
+    noon_reports_csv_path = os.path.join(appended_data_dir, 'noon_reports_only.csv')
+    appended_df.to_csv(noon_reports_csv_path, index=False, mode='w' if full_rebuild else 'a', header=full_rebuild)
+
+    # the columnar store holds numeric values only, so parse values like '%:  -3.85' before writing
+    appended_df['value'] = parse_numeric_values(appended_df['value'])
+    logger.info(f'Parsed noon report values to numbers. Values without a number: {appended_df["value"].isna().sum()}')
+
+    # convert to the compact long table schema shared by all stages
+    appended_df, qid_lookup = to_compact_long(appended_df, qid_lookup)
+
+    # write the noon reports to their own partitions of the columnar store (the sensor observations written by append.py are left untouched).
+    # A full rebuild replaces the noon report partitions, an incremental append adds part files behind the existing ones.
+    os.makedirs(long_table_dir, exist_ok=True)
+    write_long_table(appended_df, long_table_dir, part_name=f'part-{manifest["batches"]:04d}-00000', replace=full_rebuild, full_precision_qids=full_precision_qids(qid_lookup))
+    save_manifest(update_manifest(manifest, fingerprints, list(dfs), rows_per_file, last_timestamps, qid_lookup), manifest_path)
+    logger.info(f'Saved noon reports to {long_table_dir}')
+    return len(appended_df)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Adds the noon reports to their own partitions of the long table store. Only noon report files that are not in the ingest manifest yet are added, unless --full is given.')
+    parser.add_argument('--full', action='store_true', help='re-ingest all noon report files instead of only the new ones')
+    args = parser.parse_args()
+    add_noon_reps(full=args.full)
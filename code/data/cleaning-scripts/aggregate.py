@@ -1,103 +1,322 @@
 import pandas as pd
 import numpy as np
 import os
-import re
+from pandas.tseries.frequencies import to_offset
 from datetime import datetime
-from config import WINDOW_LENGTH, MIN_WINDOW_COVERAGE, WINDOW_SIDE, WINDOW_LABEL, SENSOR_DATA_AGGREGATION_METHODS, ANGLE_COLUMNS, CUMULATIVE_COLS
+from config import AGGREGATION_WINDOW_LENGTHS, MIN_WINDOW_COVERAGE, WINDOW_SIDE, WINDOW_LABEL, SENSOR_DATA_AGGREGATION_METHODS, ANGLE_COLUMNS, CUMULATIVE_COLS
 from loguru import logger
+from appended_store import LONG_TABLE_DIR_NAME, WEATHER_QID_PREFIX, NOON_REPORT_QID_PREFIX
+from long_table import load_long_table, parse_numeric_values
+from metadata import load_catalog, qid_attribute
 
-_num_re = re.compile(r"[-+]?\d*\.?\d+(?:[eE][-+]?\d+)?")
+
+# as-of join tolerances of the weather and noon report values (also bound the time range of the long table that is read)
+WEATHER_JOIN_TOLERANCE = "1h"
+NOON_REPORT_JOIN_TOLERANCE = "24h"
 
 # define paths
 script_dir = os.path.dirname(os.path.abspath(__file__))
 appended_dir = os.path.join(script_dir, '..', 'appended')
+long_table_dir = os.path.join(appended_dir, LONG_TABLE_DIR_NAME)
 filtered_dir = os.path.join(script_dir, '..', 'filtered')
 aggregated_dir = os.path.join(script_dir, '..', 'aggregated')
 aggregation_output_dir = os.path.join(script_dir, '..', '..', 'outputs', 'aggregation')
 
-# Create the aggregated directory if it doesn't exist
-if not os.path.exists(aggregated_dir):
-    os.makedirs(aggregated_dir)
-    logger.info(f'Created aggregated directory: {aggregated_dir}')
-else:
-    logger.info(f'Aggregated directory already exists: {aggregated_dir}')
-
-# start logger
-
-# Create the filtering output directory for filtering results if it doesn't exist
-if not os.path.exists(aggregation_output_dir):
-    os.makedirs(aggregation_output_dir)
-    logger.info(f'Created aggregation output directory: {aggregation_output_dir}')
-else:
-    logger.info(f'Aggregation output directory already exists: {aggregation_output_dir}')
-
-log_path = os.path.join(aggregation_output_dir, f'pre_agg_cleaning_log_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log')
-
-logger.add(
-    log_path,
-    level='INFO',
-    format='{time:YYYY-MM-DD HH:mm:ss} | {level} | {message}'
-)
-
-# load dataframes
-df = pd.read_csv(
-    os.path.join(filtered_dir, 'filtered.csv'),
-#    nrows=20000
-    )
+# functions
 
-mixed_long = pd.read_csv(
-    os.path.join(appended_dir, 'incl_noon_reports.csv'),
-#    nrows=1000000
-    )
+# Multi-resolution aggregation from shared sufficient statistics.
+#
+# The filtered data is grouped once, into base windows per segment (the greatest common divisor of the requested window lengths).
+# Per base window only sufficient statistics are kept, all computed with built-in groupby reductions:
+#   - mean:              sum and count of the valid values
+#   - sum/count/min/max: the statistic itself
+#   - circular mean:     sum of the sine and cosine of the angles and the count (angles in ANGLE_COLUMNS)
+#   - counter increase:  sum of the positive increments between consecutive valid values, first and last valid value and the count (CUMULATIVE_COLS)
+#   - n_obs:             number of rows
+# Every output resolution is rolled up from these base statistics (sums of sums, min of mins, ...; for the counters the positive increments
+# between the last value of a base window and the first value of the next base window in the same output window are added), so
+# another window length costs a groupby over the base windows instead of another pass over the filtered data.
+# The window lengths must divide a day, so that the windows of all resolutions are aligned to midnight like the pd.Grouper bins.
+
+# sufficient statistics of every aggregation method
+METHOD_STATISTICS = {
+    'mean': ['sum', 'count'],
+    'sum': ['sum'],
+    'count': ['count'],
+    'min': ['min'],
+    'max': ['max'],
+    'circular_mean': ['sin_sum', 'cos_sum', 'count'],
+    'counter_increase': ['increase', 'first', 'last', 'count'],
+}
+
+# reduction that combines a statistic of several base windows
+STATISTIC_ROLLUP = {'sum': 'sum', 'count': 'sum', 'min': 'min', 'max': 'max', 'sin_sum': 'sum', 'cos_sum': 'sum', 'increase': 'sum', 'first': 'first', 'last': 'last'}
+
+def aggregation_methods(sensor_data_aggregation_methods=SENSOR_DATA_AGGREGATION_METHODS, angle_columns=ANGLE_COLUMNS, cumulative_columns=CUMULATIVE_COLS):
+    """
+    This function returns the aggregation method of every column: the config methods, the circular mean for the angles and the counter increase for the cumulative counters.
+    """
+    methods = dict(sensor_data_aggregation_methods)  # copy, so that repeated calls start from the config methods
+
+    # Change angles to circular mean instead of arithmetic mean
+    for c in angle_columns:
+        methods[c] = 'circular_mean'
+        logger.info(f'set column "{c}" to use circular mean aggregation')
+
+    # Change cumulative counters to use the counter increase
+    for col in cumulative_columns:
+        if col in methods:
+            methods[col] = 'counter_increase'
+            logger.info(f'set column "{col}" to use counter increase aggregation, since it is cumulative')
+
+    unknown = {col: method for col, method in methods.items() if method not in METHOD_STATISTICS}
+    if unknown:
+        raise ValueError(f'Unsupported aggregation methods {unknown}, supported are {list(METHOD_STATISTICS)}')
+    return methods
 
+def base_window_length(window_lengths):
+    """
+    This function returns the base window length (greatest common divisor) of the window lengths and checks that they divide a day.
+    """
+    seconds = [int(pd.Timedelta(length).total_seconds()) for length in window_lengths]
+    for length, length_seconds in zip(window_lengths, seconds):
+        if length_seconds <= 0 or 86400 % length_seconds != 0:
+            raise ValueError(f'Window length {length} must divide a day to be rolled up from base windows')
+    base = to_offset(pd.Timedelta(seconds=int(np.gcd.reduce(seconds))))
+    return f'{base.n}{base.name}'  # with the multiple, the freqstr of an hour ('h') is no valid Timedelta
+
+def circular_components(x):
+    """
+    This function returns the sine and cosine of angles in degrees (NaN for missing angles), the components of the circular mean.
+    """
+    r = np.deg2rad(pd.Series(x).to_numpy(dtype=float, na_value=np.nan))
+    return np.sin(r), np.cos(r)
 
-# Ensure datetime datatypes
-mixed_long["utc_timestamp"] = pd.to_datetime(mixed_long["utc_timestamp"], format="ISO8601", utc=True)
-df["utc_timestamp"] = pd.to_datetime(df["utc_timestamp"], format="ISO8601", utc=True)
+def circular_mean_from_components(mean_sin, mean_cos):
+    """
+    This function combines the mean sine and cosine of the windows into the circular mean in degrees [0, 360), NaN for empty windows.
+    """
+    return np.rad2deg(np.arctan2(mean_sin, mean_cos)) % 360.0
 
-logger.info(f'Loaded filtered data with shape: {df.shape} and raw appended data with shape: {mixed_long.shape}')
+def positive_increments(x, group_ids):
+    """
+    This function computes the increase of a cumulative counter since the previous valid value of the same group, keeping only the
+    positive increments (robust to resets/roll-overs). Summed per group this equals the sum of the positive diffs of the valid values.
 
-logger.info(f'Aggregating with window length: {WINDOW_LENGTH}, minimum coverage: {MIN_WINDOW_COVERAGE}, window side: {WINDOW_SIDE}, and label: {WINDOW_LABEL}...')
+    Args:
+        x: Counter values (NaN for missing values).
+        group_ids: Group number of every row (as returned by ngroup, rows of a group in their original order).
 
-# functions
-def circular_mean_deg(x):
-    x = pd.Series(x).dropna().to_numpy(dtype=float)
-    if x.size == 0:
-        return np.nan
-    r = np.deg2rad(x)
-    s = np.mean(np.sin(r))
-    c = np.mean(np.cos(r))
-    ang = np.rad2deg(np.arctan2(s, c)) % 360.0
-    return ang
-
-def counter_increase(x):
+    Returns:
+        Float array with the positive increment of every row, 0 for the first valid value of a group, non-positive increments and missing values.
+    """
+    values = pd.Series(x).to_numpy(dtype=float, na_value=np.nan)
+    increments = np.zeros(len(values))
+    order = np.argsort(group_ids, kind='stable')
+    order = order[~np.isnan(values[order])]  # valid values, grouped, in their original order within a group
+    d = np.diff(values[order])
+    same_group = group_ids[order[1:]] == group_ids[order[:-1]]
+    increments[order[1:]] = np.where(same_group & (d > 0), d, 0.0)
+    return increments
+
+def boundary_increments(first, last, count, group_ids):
     """
-    Robust to resets: sums only positive increments.
-    Good if the meter can reset/roll over.
+    This function computes the positive increase of a cumulative counter between consecutive base windows of the same output window
+    (first valid value of a base window minus last valid value of the previous non-empty base window).
+
+    Args:
+        first: First valid counter value of every base window (base windows sorted by segment and time).
+        last: Last valid counter value of every base window.
+        count: Number of valid counter values of every base window.
+        group_ids: Output window number of every base window.
+
+    Returns:
+        Float array with the positive increment at the start of every base window, 0 otherwise.
+    """
+    increments = np.zeros(len(first))
+    valid = np.flatnonzero(count > 0)
+    d = first[valid[1:]] - last[valid[:-1]]
+    same_group = group_ids[valid[1:]] == group_ids[valid[:-1]]
+    increments[valid[1:]] = np.where(same_group & (d > 0), d, 0.0)
+    return increments
+
+def window_statistics(df, methods, window_length):
+    """
+    This function computes the sufficient statistics of every column per segment and window (one groupby pass, built-in reductions only).
+
+    Args:
+        df: Filtered data with seg_id and utc_timestamp.
+        methods: Aggregation method of every column (see aggregation_methods).
+        window_length: Length of the (base) windows.
+
+    Returns:
+        DataFrame indexed by (seg_id, utc_timestamp) with (column, statistic) columns and the n_obs column.
+    """
+    keys = [
+        "seg_id",
+        pd.Grouper(key="utc_timestamp", freq=window_length, label=WINDOW_LABEL, closed=WINDOW_SIDE),
+    ]
+
+    # helper columns for the statistics that are not a reduction of the column itself
+    helpers, spec = {}, {}
+    group_ids = None
+    for col, method in methods.items():
+        if method == 'circular_mean':
+            helpers[f'{col} (sin)'], helpers[f'{col} (cos)'] = circular_components(df[col])
+        elif method == 'counter_increase':
+            if group_ids is None:
+                group_ids = df.groupby(keys).ngroup().to_numpy(dtype=float, na_value=-1)
+            helpers[f'{col} (increase)'] = positive_increments(df[col], group_ids)
+        helper_sources = {'sin_sum': f'{col} (sin)', 'cos_sum': f'{col} (cos)', 'increase': f'{col} (increase)'}
+        for statistic in METHOD_STATISTICS[method]:
+            source = helper_sources.get(statistic, col)
+            spec[(col, statistic)] = (source, 'sum' if source != col else statistic)
+
+    g = pd.concat([df, pd.DataFrame(helpers, index=df.index)], axis=1).groupby(keys)
+    logger.info(f'Grouped dataframe into {g.ngroups} base windows of {window_length}')
+
+    statistics = g.agg(**{f'{col}|{statistic}': reduction for (col, statistic), reduction in spec.items()})
+    statistics.columns = pd.MultiIndex.from_tuples(spec)
+    statistics[('n_obs', '')] = g.size()
+    return statistics
+
+def roll_up_statistics(statistics, methods, base_length, window_length):
+    """
+    This function combines the sufficient statistics of the base windows into the statistics of longer windows.
+
+    Args:
+        statistics: Statistics of the base windows (see window_statistics), sorted by segment and time.
+        methods: Aggregation method of every column.
+        base_length: Length of the base windows.
+        window_length: Length of the output windows (a multiple of base_length).
+
+    Returns:
+        DataFrame with the statistics per segment and output window.
+    """
+    window_length, base_length = pd.Timedelta(window_length), pd.Timedelta(base_length)
+    if window_length == base_length:
+        return statistics
+
+    # output window of every base window (label convention of the pd.Grouper bins)
+    base_labels = statistics.index.get_level_values("utc_timestamp")
+    window_starts = (base_labels - (base_length if WINDOW_LABEL == "right" else pd.Timedelta(0))).floor(window_length)
+    window_labels = window_starts + (window_length if WINDOW_LABEL == "right" else pd.Timedelta(0))
+    keys = [statistics.index.get_level_values("seg_id"), pd.Index(window_labels, name="utc_timestamp")]
+
+    statistics = statistics.copy()
+    counter_cols = [col for col, method in methods.items() if method == 'counter_increase']
+    if counter_cols:
+        group_ids = statistics.groupby(keys).ngroup().to_numpy()
+        for col in counter_cols:
+            statistics[(col, 'increase')] += boundary_increments(statistics[(col, 'first')].to_numpy(), statistics[(col, 'last')].to_numpy(),
+                                                                 statistics[(col, 'count')].to_numpy(), group_ids)
+
+    rollup = {column: STATISTIC_ROLLUP[column[1]] for column in statistics.columns if column != ('n_obs', '')}
+    rollup[('n_obs', '')] = 'sum'
+    return statistics.groupby(keys).agg(rollup)
+
+def windows_from_statistics(statistics, methods):
     """
-    x = pd.Series(x).dropna()
-    if len(x) < 2:
-        return np.nan
-    d = x.diff()
-    return d[d > 0].sum()
-
-def parse_numeric_value(x):
-    """Extract first numeric token from strings like '%:  -3.85'."""
-    if pd.isna(x):
-        return np.nan
-    if isinstance(x, (int, float, np.number)):
-        return float(x)
-    m = _num_re.search(str(x))
-    return float(m.group(0)) if m else np.nan
+    This function computes the aggregated value of every column from its sufficient statistics.
+
+    Args:
+        statistics: Statistics per segment and window (see window_statistics and roll_up_statistics).
+        methods: Aggregation method of every column.
+
+    Returns:
+        DataFrame indexed by (seg_id, utc_timestamp) with the aggregated columns and n_obs.
+    """
+    out = {}
+    for col, method in methods.items():
+        if method == 'mean':
+            out[col] = statistics[(col, 'sum')] / statistics[(col, 'count')]
+        elif method == 'circular_mean':
+            count = statistics[(col, 'count')]
+            out[col] = circular_mean_from_components(statistics[(col, 'sin_sum')] / count, statistics[(col, 'cos_sum')] / count)
+        elif method == 'counter_increase':
+            out[col] = statistics[(col, 'increase')].where(statistics[(col, 'count')] >= 2)
+        else:
+            out[col] = statistics[(col, method)]
+    out["n_obs"] = statistics[('n_obs', '')]
+    return pd.DataFrame(out, index=statistics.index)
 
 def add_var_full(long_df,
-                 quantity_col="quantity_name",
-                 source_col="source_name",
+                 catalog,
+                 qid_col="qid_mapping",
                  out_col="var_full"):
     long2 = long_df.copy()
-    long2[out_col] = long2[quantity_col].astype(str).str.strip() + " (" + long2[source_col].astype(str).str.strip() + ")"
+    # "quantity_name (source_name)" from the catalog, joined on the qid codes instead of concatenating strings per row
+    long2[out_col] = qid_attribute(long2[qid_col], catalog, "var_full")
     return long2
 
+# As-of join engine for the long table variables.
+#
+# All requested variables are pivoted into one wide frame (one row per observation time, one column per variable, duplicates collapsed),
+# forward filled (backward joins) or back filled (forward joins) per variable, together with the time of the observation each filled value
+# comes from. One merge_asof of the windows against this frame then attaches every variable at once, and the values whose observation is
+# further away than the tolerance are masked. This is the same as a merge_asof with tolerance per variable (each variable is matched to its
+# own last observation), but the cost does not grow with the number of variables.
+
+def pivot_long_vars(long_df, vars_full, long_time_col="utc_timestamp", long_var_col="var_full", long_value_col="value", collapse_duplicates="mean"):
+    """
+    This function pivots the requested variables of a long table into a wide frame with vectorized numeric parsing.
+
+    Args:
+        long_df: Long table with time, variable and value columns.
+        vars_full: Variables to pivot.
+        collapse_duplicates: How to collapse several values of a variable at the same time ("mean" or "last").
+
+    Returns:
+        DataFrame indexed by the sorted observation times (utc) with one column per variable that has numeric values.
+    """
+    if collapse_duplicates not in ("mean", "last", None):
+        raise ValueError(f'collapse_duplicates must be "mean", "last" or None, got {collapse_duplicates}')
+
+    rows = long_df[long_var_col].isin(vars_full).to_numpy()
+    long2 = pd.DataFrame({
+        long_time_col: pd.to_datetime(long_df.loc[rows, long_time_col], utc=True),
+        long_var_col: long_df.loc[rows, long_var_col].astype(str).to_numpy(),
+        long_value_col: parse_numeric_values(long_df.loc[rows, long_value_col]).to_numpy(),
+    }).dropna()
+
+    # If you have multiple rows at the exact same timestamp for a variable, collapse them (merge_asof would take the last one)
+    collapsed = long2.groupby([long_time_col, long_var_col], sort=True)[long_value_col].agg(collapse_duplicates or "last")
+    return collapsed.unstack(long_var_col)
+
+def asof_join_wide(times, wide, direction="backward", tolerance="1h"):
+    """
+    This function attaches all variables of a wide frame to sorted times with one as-of join.
+
+    Args:
+        times: Sorted utc times to join to (e.g. window_start).
+        wide: Wide frame of the variables (see pivot_long_vars).
+        direction: "backward" (last observation at or before the time) or "forward" (first observation at or after the time).
+        tolerance: Maximum distance between the time and the observation.
+
+    Returns:
+        DataFrame with one row per time (in the order of times) and one column per variable of wide.
+    """
+    if direction not in ("backward", "forward"):
+        raise ValueError(f'direction must be "backward" or "forward", got {direction}')
+
+    times = pd.Series(pd.to_datetime(times, utc=True), name="_time").reset_index(drop=True)
+    if wide.empty:
+        # none of the variables has an observation (e.g. none of them is in the long table)
+        return pd.DataFrame(np.nan, index=times.index, columns=wide.columns)
+    wide = wide.copy()
+    wide.index = pd.DatetimeIndex(wide.index).as_unit(times.dt.unit)
+
+    # fill every variable from its own observations and keep the time of the observation the value comes from
+    observation_times = pd.DataFrame({v: wide.index.where(wide[v].notna()) for v in wide.columns}, index=wide.index)
+    fill = "ffill" if direction == "backward" else "bfill"
+    right = pd.concat([getattr(wide, fill)(), getattr(observation_times, fill)().add_prefix("_observed ")], axis=1)
+
+    joined = pd.merge_asof(times.to_frame(), right, left_on="_time", right_index=True, direction=direction)
+    observed = joined[[f"_observed {v}" for v in wide.columns]]
+    distance = observed.rsub(joined["_time"], axis=0) if direction == "backward" else observed.sub(joined["_time"], axis=0)
+    too_far = ~(distance <= pd.Timedelta(tolerance)).to_numpy(dtype=bool)  # also True where there is no observation (NaT)
+    return joined[list(wide.columns)].mask(too_far)
+
 def join_long_vars_asof(
     out_df,
     long_df,
@@ -119,37 +338,21 @@ def join_long_vars_asof(
     out2[out_time_col] = pd.to_datetime(out2[out_time_col], utc=True)
     out2 = out2.sort_values(out_time_col)
 
-    long2 = long_df.copy()
-    long2[long_time_col] = pd.to_datetime(long2[long_time_col], utc=True)
-    long2[long_value_col] = long2[long_value_col].map(parse_numeric_value)
-    long2 = long2.sort_values(long_time_col)
-
-    tol = pd.Timedelta(tolerance)
+    wide = pivot_long_vars(long_df, vars_full, long_time_col, long_var_col, long_value_col, collapse_duplicates)
+    joined = asof_join_wide(out2[out_time_col], wide, direction=direction, tolerance=tolerance)
+    joined.index = out2.index
 
+    # same columns as a merge_asof per variable: existing columns are kept as <v>_x next to the joined <v>_y
     for v in vars_full:
-        tmp = long2.loc[long2[long_var_col] == v, [long_time_col, long_value_col]].dropna()
-        if tmp.empty:
+        if v not in joined.columns:
             out2[v] = np.nan
-            continue
-
-        # If you have multiple rows at the exact same timestamp for a variable, collapse them
-        if collapse_duplicates == "mean":
-            tmp = tmp.groupby(long_time_col, as_index=False)[long_value_col].mean()
-        elif collapse_duplicates == "last":
-            tmp = tmp.groupby(long_time_col, as_index=False)[long_value_col].last()
-
-        tmp = tmp.rename(columns={long_value_col: v})
-
-        out2 = pd.merge_asof(
-            out2,
-            tmp,
-            left_on=out_time_col,
-            right_on=long_time_col,
-            direction=direction,
-            tolerance=tol,
-        ).drop(columns=[long_time_col])
+        elif v in out2.columns:
+            out2 = out2.rename(columns={v: f"{v}_x"})
+            out2[f"{v}_y"] = joined[v]
+        else:
+            out2[v] = joined[v]
 
-    return out2
+    return out2.reset_index(drop=True)
 
 def asof_attach_vars(out_df, long_df, vars_full,
                      out_time_col="window_start",
@@ -165,35 +368,16 @@ def asof_attach_vars(out_df, long_df, vars_full,
     out2[out_time_col] = pd.to_datetime(out2[out_time_col], utc=True)
     out2 = out2.sort_values(out_time_col)
 
-    long2 = long_df.sort_values(long_time_col)
+    wide = pivot_long_vars(long_df, vars_full, long_time_col, var_col, value_col, collapse_duplicates="mean")
+    joined = asof_join_wide(out2[out_time_col], wide, direction=direction, tolerance=tolerance)
+    joined.index = out2.index
 
     for v in vars_full:
-        tmp = (long2.loc[long2[var_col].eq(v), [long_time_col, value_col]]
-                    .dropna()
-                    .groupby(long_time_col, as_index=False)[value_col].mean()
-                    .rename(columns={value_col: v}))
-
-        out2 = pd.merge_asof(
-            out2,
-            tmp,
-            left_on=out_time_col,
-            right_on=long_time_col,
-            direction=direction,
-            tolerance=pd.Timedelta(tolerance),
-            suffixes=("", "__new"),
-        )  # merge_asof supports direction/tolerance for time alignment [web:82][web:85]
-
+        new = joined[v] if v in joined.columns else pd.Series(np.nan, index=out2.index)
         # fill only NaNs in the existing column
-        if v in out2.columns and f"{v}__new" in out2.columns:
-            out2[v] = out2[v].combine_first(out2[f"{v}__new"])
-            out2 = out2.drop(columns=[f"{v}__new"])
-        else:
-            # if column didn't exist before, just rename "__new" into place
-            out2 = out2.rename(columns={f"{v}__new": v})
+        out2[v] = out2[v].combine_first(new) if v in out2.columns else new
 
-        out2 = out2.drop(columns=[long_time_col])
-
-    return out2
+    return out2.reset_index(drop=True)
 
 def coalesce_xy_columns(df):
     df = df.copy()
@@ -211,157 +395,225 @@ def coalesce_xy_columns(df):
     return df
 
 def prep_long_noon_table(long_df,
+                    catalog,
                     time_col="utc_timestamp",
-                    quantity_col="quantity_name",
-                    source_col="source_name",
+                    qid_col="qid_mapping",
                     value_col="value"):
     long2 = long_df.copy()
     long2[time_col] = pd.to_datetime(long2[time_col], utc=True)
 
-    # full name matches your out naming convention
-    long2["var_full"] = (
-        long2[quantity_col].astype(str).str.strip()
-        + " (" + long2[source_col].astype(str).str.strip() + ")"
-    )
+    # full name matches your out naming convention (looked up in the catalog per qid)
+    long2["var_full"] = qid_attribute(long2[qid_col], catalog, "var_full")
 
     # parse numeric values (handles strings like "%:  -3.85")
-    long2[value_col] = long2[value_col].map(parse_numeric_value)
+    long2[value_col] = parse_numeric_values(long2[value_col])
     return long2
 
 
-# --- Aggregate ---
-
-# get the aggregation methods
-agg_map = SENSOR_DATA_AGGREGATION_METHODS
-angle_cols = ANGLE_COLUMNS
-
-# Change angles to circular mean instead of arithmetic mean
-for c in angle_cols:
-    agg_map[c] = circular_mean_deg
-    logger.info(f'set column "{c}" to use circular mean aggregation')
-
-# Change cumulative counters to use counter_increase (or counter_delta if you want net change including resets)
-for col in CUMULATIVE_COLS:
-    if col in agg_map:
-        agg_map[col] = counter_increase   
-        logger.info(f'set column "{col}" to use counter_increase aggregation, since it is cumulative')
-
-# --- Grouping: seg_id + 15-min bins ---
-g = df.groupby(
-    [
-        "seg_id",
-        pd.Grouper(key="utc_timestamp", freq=WINDOW_LENGTH, label=WINDOW_LABEL, closed=WINDOW_SIDE),
-    ]
-) 
-logger.info(f'Grouped dataframe into {g.ngroups} observations')
+def join_external_data(out, weather_long, noon_long, window_length):
+    """
+    This function joins the weather and noon report data to the aggregated windows of one resolution and drops the rows with missing values.
 
-# aggregate into the multi-index output object using the specified aggregation methods
-out = g.agg(agg_map)
+    Args:
+        out: Aggregated windows indexed by (seg_id, utc_timestamp), after the coverage filter.
+        weather_long: Weather rows of the long table with the var_full column.
+        noon_long: Noon report rows of the long table (see prep_long_noon_table).
+        window_length: Length of the windows.
 
-# Define the sampling frequency and expected observations per window
-dt_seconds = 15.0
-expected_n = int(pd.Timedelta(WINDOW_LENGTH).total_seconds() / dt_seconds)
-logger.info(f'Expected number of observations per window based on sampling frequency of {dt_seconds}s: {expected_n}')
+    Returns:
+        The aggregated DataFrame with the weather and noon report columns.
+    """
+    # --- Add weather data ----
 
-# calculate coverage for each window
-support = g.size().rename("n_obs")
-out = out.join(support)
-out["coverage"] = out["n_obs"] / expected_n
-logger.info(f'Number of windows with sufficient coverage (>= {MIN_WINDOW_COVERAGE*100:.0f}%): {(out["coverage"] >= MIN_WINDOW_COVERAGE).sum()} ({(out["coverage"] >= MIN_WINDOW_COVERAGE).mean() * 100:.2f}%)')
+    # Define weather cols
+    weather_cols = [c for c in out.columns if c.startswith("Vessel External Conditions")]
+    logger.info(f'Merging in {len(weather_cols)} weather columns')
 
-# Filter weak/partial windows (e.g., last partial chunk of a segment)
-out = out[out["coverage"] >= MIN_WINDOW_COVERAGE]
+    # forward fill weather values 
+    max_forward_fill = int(pd.Timedelta("1h").total_seconds() / pd.Timedelta(window_length).total_seconds()) 
+    logger.info(f'Max observations for forward fill of weather values: {max_forward_fill}')
 
-# --- Add weather data ----
+    out[weather_cols] = (
+        out.groupby("seg_id")[weather_cols]
+           .ffill(
+               limit=max_forward_fill
+               )
+    )
 
-# Define weather cols
-weather_cols = [c for c in out.columns if c.startswith("Vessel External Conditions")]
-logger.info(f'Merging in {len(weather_cols)} weather columns')
+    # Bring seg_id + window_start back as columns
+    out = out.reset_index().rename(columns={"utc_timestamp": "window_start"})
 
-# forward fill weather values 
-max_forward_fill = int(pd.Timedelta("1h").total_seconds() / pd.Timedelta(WINDOW_LENGTH).total_seconds()) 
-logger.info(f'Max observations for forward fill of weather values: {max_forward_fill}')
+    # Choose variables to join
+    weather_cols_in_out = [c for c in out.columns if c.startswith("Vessel External Conditions")]
+    logger.info(f'weather columns in out: {weather_cols_in_out} (including 2 on board sensors)')
 
-out[weather_cols] = (
-    out.groupby("seg_id")[weather_cols]
-       .ffill(
-           limit=max_forward_fill
-           )
-)
+    # Subtract weather columns measured on board
+    weather_cols_in_out = [c for c in weather_cols_in_out if c not in ["Vessel External Conditions Wind Relative Speed (knots)", "Vessel External Conditions Wind Relative Angle (degrees)"]]
+    logger.info(f'weather columns to join from long: {weather_cols_in_out} (excluding 2 on board sensors)')
 
-# Bring seg_id + window_start back as columns
-out = out.reset_index().rename(columns={"utc_timestamp": "window_start"})
+    # Execute the join
+    weather_vars = sorted(weather_long["quantity_name"].dropna().unique())
+    logger.info(f"weather variables to join: {weather_vars}")
 
-weather_long = mixed_long[mixed_long["qid_mapping"].str.startswith("4")]
-logger.info(f"weather_long shape: {weather_long.shape}")
+    out_with_weather = join_long_vars_asof(
+        out_df=out,
+        long_df=weather_long,
+        vars_full=weather_cols_in_out,
+        out_time_col="window_start",     # adjust if yours is named differently
+        tolerance=WEATHER_JOIN_TOLERANCE,
+    )
 
-# add full variable names to align with synchronized table
-weather_long = add_var_full(weather_long) 
-logger.info(f'added column with full variable names to weather_long')
+    out_with_weather = coalesce_xy_columns(out_with_weather)
 
-# Choose variables to join
-weather_cols_in_out = [c for c in out.columns if c.startswith("Vessel External Conditions")]
-logger.info(f'weather columns in out: {weather_cols_in_out} (including 2 on board sensors)')
+    logger.info(f'Joined weather variables in and coalesced double weather columns. Total NaNs in weather columns after join: {out_with_weather[weather_cols_in_out].isna().sum().sum()}')
 
-# Subtract weather columns measured on board
-weather_cols_in_out = [c for c in weather_cols_in_out if c not in ["Vessel External Conditions Wind Relative Speed (knots)", "Vessel External Conditions Wind Relative Angle (degrees)"]]
-logger.info(f'weather columns to join from long: {weather_cols_in_out} (excluding 2 on board sensors)')
+    # --- Add noon report data ---
 
-# Execute the join
-weather_vars = sorted(weather_long["quantity_name"].dropna().unique())
-logger.info(f"weather variables to join: {weather_vars}")
+    # define the noon variables of interest
+    noon_vars = ["Fwd Draft (Noon Report)", "Mid Draft (Noon Report)", "Aft Draft (Noon Report)"]
+    logger.info(f"noon report variables to join: {noon_vars}")
 
-out_with_weather = join_long_vars_asof(
-    out_df=out,
-    long_df=weather_long,
-    vars_full=weather_cols_in_out,
-    out_time_col="window_start",     # adjust if yours is named differently
-    tolerance="1h",                  
-)
+    # attach noon report values to the table
+    out_with_weather_and_noon = asof_attach_vars(out_with_weather, noon_long, noon_vars, tolerance=NOON_REPORT_JOIN_TOLERANCE)
+    logger.info(f'Joined noon report variables in. Total NaNs in noon report columns after join: {out_with_weather_and_noon[noon_vars].isna().sum().sum()}')
 
-out_with_weather = coalesce_xy_columns(out_with_weather)
+    logger.info(f'Final shape after joining weather and noon report data: {out_with_weather_and_noon.shape}')
 
-logger.info(f'Joined weather variables in and coalesced double weather columns. Total NaNs in weather columns after join: {out_with_weather[weather_cols_in_out].isna().sum().sum()}')
+    # --- Last cleaning ---
 
-# --- Add noon report data ---
+    # drop rows with NaN values if less than 1% of observations
+    total_nans = out_with_weather_and_noon.isna().sum().sum()
+    total_cells = out_with_weather_and_noon.size
+    nan_pct = total_nans / total_cells * 100
+    logger.info(f"Total NaNs in out_with_weather_and_noon: {total_nans} ({nan_pct:.2f}%)")
+    if nan_pct < 1.0:
+        out_with_weather_and_noon = out_with_weather_and_noon.dropna()
+        logger.info(f"Dropped NaN rows, new shape: {out_with_weather_and_noon.shape}") 
+    else:
+        out_with_weather_and_noon = out_with_weather_and_noon.dropna()
+        logger.warning(f'expected less than 1% NaNs at this point, but got {nan_pct:.2f}%. Consider reviewing the join steps and NaN handling.')
 
-# get only the noon report values from the appended table
-noon_long = mixed_long[mixed_long["qid_mapping"].str.startswith("0")]
-noon_long = prep_long_noon_table(noon_long)
-noon_long = noon_long[noon_long["source_name"].eq("Noon Report")].copy()
-logger.info(f"noon_long shape: {noon_long.shape}")
+    return out_with_weather_and_noon
 
-# define the noon variables of interest
-noon_vars = ["Fwd Draft (Noon Report)", "Mid Draft (Noon Report)", "Aft Draft (Noon Report)"]
-logger.info(f"noon report variables to join: {noon_vars}")
 
-# attach noon report values to the table
-out_with_weather_and_noon = asof_attach_vars(out_with_weather, noon_long, noon_vars, tolerance="24h")
-logger.info(f'Joined noon report variables in. Total NaNs in noon report columns after join: {out_with_weather_and_noon[noon_vars].isna().sum().sum()}')
+def aggregate(df, mixed_long, catalog, window_lengths=AGGREGATION_WINDOW_LENGTHS):
+    """
+    This function aggregates the filtered data into windows of every window length per segment and joins the weather and noon report data (pipeline stage).
+    The data is grouped once into base windows, every window length is rolled up from their sufficient statistics.
 
-logger.info(f'Final shape after joining weather and noon report data: {out_with_weather_and_noon.shape}')
+    Args:
+        df: Filtered data (as written by pre_agg_clean.py) with utc_timestamp as tz-aware datetimes.
+        mixed_long: Compact long table incl. noon reports (see long_table.load_long_table).
+        catalog: Metadata catalog (see metadata.load_catalog).
+        window_lengths: Window lengths to aggregate to (e.g. ["5min", "15min", "1h"]), each must divide a day.
 
-# --- Last cleaning ---
+    Returns:
+        Dict of window length to aggregated DataFrame.
+    """
+    window_lengths = list(dict.fromkeys(window_lengths))
+    base_length = base_window_length(window_lengths)
+    logger.info(f'Aggregating with window lengths: {window_lengths} (base window: {base_length}), minimum coverage: {MIN_WINDOW_COVERAGE}, window side: {WINDOW_SIDE}, and label: {WINDOW_LABEL}...')
+
+    # --- Sufficient statistics per segment and base window ---
+    methods = aggregation_methods()
+    # columns can be missing in the filtered data, e.g. when pre_agg_clean.py dropped them for containing only 0 values
+    missing = [col for col in methods if col not in df.columns]
+    if missing:
+        logger.warning(f'Columns {missing} not found in dataframe, skipping their aggregation')
+        methods = {col: method for col, method in methods.items() if col in df.columns}
+    base_statistics = window_statistics(df, methods, base_length)
+
+    # --- Long table rows to join (prepared once for all resolutions) ---
+    weather_long = mixed_long[mixed_long["qid_mapping"].str.startswith("4")]
+    logger.info(f"weather_long shape: {weather_long.shape}")
+
+    # add full variable names to align with synchronized table
+    weather_long = add_var_full(weather_long, catalog)
+    logger.info(f'added column with full variable names to weather_long')
+
+    # get only the noon report values from the appended table
+    noon_long = mixed_long[mixed_long["qid_mapping"].str.startswith("0")]
+    noon_long = prep_long_noon_table(noon_long, catalog)
+    noon_long = noon_long[noon_long["source_name"].eq("Noon Report")].copy()
+    logger.info(f"noon_long shape: {noon_long.shape}")
+
+    # Define the sampling frequency
+    dt_seconds = 15.0
+
+    aggregated = {}
+    for window_length in window_lengths:
+        logger.info(f'--- Window length {window_length} ---')
+
+        # aggregate into the multi-index output object from the rolled up statistics
+        out = windows_from_statistics(roll_up_statistics(base_statistics, methods, base_length, window_length), methods)
+        logger.info(f'Aggregated into {len(out)} windows of {window_length}')
+
+        # expected observations per window
+        expected_n = int(pd.Timedelta(window_length).total_seconds() / dt_seconds)
+        logger.info(f'Expected number of observations per window based on sampling frequency of {dt_seconds}s: {expected_n}')
+
+        # calculate coverage for each window
+        out["coverage"] = out["n_obs"] / expected_n
+        logger.info(f'Number of windows with sufficient coverage (>= {MIN_WINDOW_COVERAGE*100:.0f}%): {(out["coverage"] >= MIN_WINDOW_COVERAGE).sum()} ({(out["coverage"] >= MIN_WINDOW_COVERAGE).mean() * 100:.2f}%)')
+
+        # Filter weak/partial windows (e.g., last partial chunk of a segment)
+        out = out[out["coverage"] >= MIN_WINDOW_COVERAGE]
+
+        aggregated[window_length] = join_external_data(out, weather_long, noon_long, window_length)
+
+    return aggregated
+
+
+if __name__ == '__main__':
+    # Create the aggregated directory if it doesn't exist
+    if not os.path.exists(aggregated_dir):
+        os.makedirs(aggregated_dir)
+        logger.info(f'Created aggregated directory: {aggregated_dir}')
+    else:
+        logger.info(f'Aggregated directory already exists: {aggregated_dir}')
+
+    # start logger
+
+    # Create the filtering output directory for filtering results if it doesn't exist
+    if not os.path.exists(aggregation_output_dir):
+        os.makedirs(aggregation_output_dir)
+        logger.info(f'Created aggregation output directory: {aggregation_output_dir}')
+    else:
+        logger.info(f'Aggregation output directory already exists: {aggregation_output_dir}')
+
+    log_path = os.path.join(aggregation_output_dir, f'pre_agg_cleaning_log_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log')
+
+    logger.add(
+        log_path,
+        level='INFO',
+        format='{time:YYYY-MM-DD HH:mm:ss} | {level} | {message}'
+    )
 
-# drop rows with NaN values if less than 1% of observations
-total_nans = out_with_weather_and_noon.isna().sum().sum()
-total_cells = out_with_weather_and_noon.size
-nan_pct = total_nans / total_cells * 100
-logger.info(f"Total NaNs in out_with_weather_and_noon: {total_nans} ({nan_pct:.2f}%)")
-if nan_pct < 1.0:
-    out_with_weather_and_noon = out_with_weather_and_noon.dropna()
-    logger.info(f"Dropped NaN rows, new shape: {out_with_weather_and_noon.shape}") 
-else:
-    out_with_weather_and_noon = out_with_weather_and_noon.dropna()
-    logger.warning(f'expected less than 1% NaNs at this point, but got {nan_pct:.2f}%. Consider reviewing the join steps and NaN handling.')
+    # load dataframes
+    df = pd.read_csv(
+        os.path.join(filtered_dir, 'filtered.csv'),
+    #    nrows=20000
+        )
 
-# ---- Saving ----
+    # Ensure datetime datatypes
+    df["utc_timestamp"] = pd.to_datetime(df["utc_timestamp"], format="ISO8601", utc=True).dt.as_unit("ns")  # same resolution as the appended store
 
-# Save the aggregated table to a csv file with the window length in the name
-output_path = os.path.join(aggregated_dir, f'aggregated_{WINDOW_LENGTH}.csv')
-out_with_weather_and_noon.to_csv(output_path, index=False)
-logger.info(f'Saved aggregated table to {output_path}')
+    # only read the weather and noon report rows the joins can reach: the windows lie within the days of the filtered data
+    # (window lengths divide a day) and look back at most the largest join tolerance
+    lookback = max(pd.Timedelta(WEATHER_JOIN_TOLERANCE), pd.Timedelta(NOON_REPORT_JOIN_TOLERANCE))
+    start = df["utc_timestamp"].min().floor("D") - lookback
+    end = df["utc_timestamp"].max().floor("D") + pd.Timedelta(days=1, nanoseconds=1)
+    catalog = load_catalog()
+    mixed_long = load_long_table(long_table_dir, catalog, qid_prefixes=[WEATHER_QID_PREFIX, NOON_REPORT_QID_PREFIX], start=start, end=end)
 
+    logger.info(f'Loaded filtered data with shape: {df.shape} and raw appended data with shape: {mixed_long.shape}')
 
+    aggregated = aggregate(df, mixed_long, catalog)
 
+    # ---- Saving ----
 
+    # Save the aggregated tables to csv files with the window length in the name
+    for window_length, out_with_weather_and_noon in aggregated.items():
+        output_path = os.path.join(aggregated_dir, f'aggregated_{window_length}.csv')
+        out_with_weather_and_noon.to_csv(output_path, index=False)
+        logger.info(f'Saved aggregated table to {output_path}')
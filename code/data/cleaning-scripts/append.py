@@ -1,16 +1,20 @@
 import os
 import glob
+import argparse
 import pandas as pd
 import numpy as np
 from loguru import logger
-from config import EXPECTED_SENSOR_OBSERVATIONS
+from config import EXPECTED_SENSOR_OBSERVATIONS, MERGE_BLOCK_ROWS, MERGE_CHUNK_ROWS
 from multiprocessing import Pool, cpu_count
+from appended_store import LONG_TABLE_DIR_NAME, NOON_REPORT_QID_PREFIX, clear_qid_prefixes, existing_qid_prefixes, write_long_table
+from long_table import compact_long_from_codes, extend_qid_lookup, full_precision_qids, qid_codes, utc_timestamps_ns
+from merge_ingest import kway_merge, sort_source, time_deltas
+from ingest_manifest import SENSOR_MANIFEST_NAME, empty_manifest, last_timestamps_array, load_manifest, plan_ingest, save_manifest, update_manifest
+from metadata import load_catalog
 
 # Get the directory where THIS script is located
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
-# -- STEP 1: append all monthly observation files into a single dataframe   --
-
 # Defining prerequisites for appending
 columns = [
     'utc_timestamp',
@@ -19,68 +23,129 @@ columns = [
 ]
 parent_dir = os.path.dirname(os.getcwd())
 appended_data_dir = os.path.join(script_dir, '..', 'appended')
-sensor_dictionary_path = os.path.join(script_dir, '..', 'metadata', 'Metrics registration.csv')
+long_table_dir = os.path.join(appended_data_dir, LONG_TABLE_DIR_NAME)
+raw_data_dir = os.path.join(script_dir, '..', 'raw', 'unzipped')
+manifest_path = os.path.join(long_table_dir, SENSOR_MANIFEST_NAME)
 
-# Parallel file reading function
+# Parallel file reading function: every file is sorted by time locally, so that the files can be k-way merged afterwards
 def read_csv_file(file_path):
-    df = pd.read_csv(file_path, names=columns, parse_dates=['utc_timestamp'], date_format='ISO8601')
+    df = pd.read_csv(file_path, names=columns, parse_dates=['utc_timestamp'], date_format='ISO8601', dtype={'qid_mapping': 'category', 'value': 'float64'})
     logger.info(f'Read file: {file_path} with shape: {df.shape}')
-    return df
-
-# Get all CSV files from month directories (1-12 only)
-all_files = []
-for month in range(1, 13):
-    input_pattern = os.path.join(script_dir, '..', 'raw', 'unzipped', str(month), '*.csv')
-    all_files.extend(glob.glob(input_pattern))
-logger.info(f'Found {len(all_files)} files to process')
-
-# Read files in parallel using all CPU cores minus 1
-with Pool(cpu_count() - 1) as pool:
-    dfs = pool.map(read_csv_file, all_files)
-
-# Concatenate all dataframes at once (much faster than iterative concat)
-appended_df = pd.concat(dfs, ignore_index=True)
-logger.info(f'Successfully appended all files. Total shape: {appended_df.shape}')
-
-# check if there is the right number of sensor observations
-if appended_df.shape[0] != EXPECTED_SENSOR_OBSERVATIONS or appended_df.shape[1] != len(columns):
-    logger.error(f'dataframe shape ({appended_df.shape[0]}) does not match expected ({EXPECTED_SENSOR_OBSERVATIONS},{len(columns)})')
-else:
-    logger.info(f'dataframe shape ({appended_df.shape[0]}) is as expected: ({EXPECTED_SENSOR_OBSERVATIONS},{len(columns)})')
-
-# -- STEP 2: Add columns from metrics registration file --
-sensor_dict_df = pd.read_csv(sensor_dictionary_path)
-
-# set the value for "unit" of Vessel Propeller Shaft Revolutions to "revs", because it was missing in the original file from Mærsk
-sensor_dict_df.loc[sensor_dict_df['quantity_name'] == 'Vessel Propeller Shaft Revolutions', 'unit'] = 'revs'
-
-# save it to a csv file again to keep the correction
-sensor_dict_df.to_csv(sensor_dictionary_path, index=False)
-
-logger.info(f'number of variables in sensor dictionary: {sensor_dict_df["qid_mapping"].nunique()}')
-logger.info(f' is 2::0::25::0_1::2::0::3::0_1::0::6::0_8 in sensor dictionary? {"2::0::25::0_1::2::0::3::0_1::0::6::0_8" in sensor_dict_df["qid_mapping"].values}')
-
-# Merge sensor metadata onto the appended dataframe
-appended_df = appended_df.merge(
-    sensor_dict_df[['qid_mapping', 'quantity_name', 'source_name', 'unit']], 
-    on='qid_mapping', 
-    how='left'
-)
-
-logger.info(f'number of variables after merge: {appended_df["qid_mapping"].nunique()}')
-logger.info(f'Added sensor metadata columns. Final shape: {appended_df.shape}')
-
-# convert uct_timestamp to datetime if not already
-appended_df['utc_timestamp'] = pd.to_datetime(appended_df['utc_timestamp']).dt.tz_convert('UTC')
-
-# Sort by timestamp for consistency
-appended_df = appended_df.sort_values(by='utc_timestamp').reset_index(drop=True)
-
-# add a column for time delta between observations for each variable (measuring only the difference between a given observation and the last observation of that qid_mapping)
-logger.info(f'shape before adding time_delta: {appended_df.shape}')
-appended_df['time_delta_sec'] = appended_df.groupby('qid_mapping')['utc_timestamp'].diff().dt.total_seconds()
-logger.info(f'Added time_delta column to appended dataframe. Shape is now: {appended_df.shape}')
-
-# Save this version of the appended df (excl. noon report data) to the folder
-os.makedirs(appended_data_dir, exist_ok=True)
-appended_df.to_csv(os.path.join(appended_data_dir, 'excl_noon_reports.csv'), index=False)
+    source = sort_source({
+        'utc_timestamp': utc_timestamps_ns(df['utc_timestamp']),
+        'qid_code': df['qid_mapping'].cat.codes.to_numpy(),
+        'value': df['value'].to_numpy(),
+    })
+    return df['qid_mapping'].cat.categories.to_numpy(dtype=object), source
+
+def read_csv_files(keys):
+    # Read files in parallel using all CPU cores minus 1
+    with Pool(max(1, cpu_count() - 1)) as pool:
+        return dict(zip(keys, pool.map(read_csv_file, [os.path.join(raw_data_dir, key) for key in keys])))
+
+def append(full=False):
+    """
+    This function appends the monthly raw observation files to the long table store (pipeline stage).
+    Only files that are not in the ingest manifest yet are appended, unless full is True.
+
+    Args:
+        full: If True, all raw files are re-ingested and the sensor/weather partitions are rebuilt.
+
+    Returns:
+        Number of appended observations.
+    """
+    # -- STEP 1: Load the metadata catalog (the corrected metrics registration incl. the noon report qids, see metadata.py) --
+    catalog = load_catalog()
+
+    logger.info(f'number of variables in metadata catalog: {catalog["qid_mapping"].nunique()}')
+    logger.info(f' is 2::0::25::0_1::2::0::3::0_1::0::6::0_8 in metadata catalog? {"2::0::25::0_1::2::0::3::0_1::0::6::0_8" in catalog["qid_mapping"].values}')
+
+    # -- STEP 2: find the monthly observation files that have not been ingested yet --
+
+    # Get all CSV files from month directories (1-12 only)
+    all_files = []
+    for month in range(1, 13):
+        input_pattern = os.path.join(raw_data_dir, str(month), '*.csv')
+        all_files.extend(glob.glob(input_pattern))
+    logger.info(f'Found {len(all_files)} files')
+
+    # compare the files with the ingest manifest (size, modification time and sha256 hash)
+    manifest = None if full else load_manifest(manifest_path)
+    fingerprints, new_files, changed_files = plan_ingest(all_files, raw_data_dir, manifest)
+    full_rebuild = manifest is None or len(changed_files) > 0
+    if changed_files:
+        logger.warning(f'{len(changed_files)} already ingested file(s) were changed or removed, rebuilding the whole long table: {changed_files}')
+    if not full_rebuild and not new_files:
+        logger.info('All raw files are already ingested, nothing to append')
+        return 0
+
+    files_to_read = list(fingerprints) if full_rebuild else new_files
+    logger.info(f'{"Full rebuild" if full_rebuild else "Incremental append"}: reading {len(files_to_read)} file(s)')
+    files = read_csv_files(files_to_read)
+
+    # new observations can only be appended behind the existing ones, otherwise the store would not be time ordered anymore
+    if not full_rebuild:
+        min_new_timestamp = min((source['utc_timestamp'][0] for _, source in files.values() if len(source['utc_timestamp'])), default=None)
+        if min_new_timestamp is not None and manifest['max_timestamp'] is not None and min_new_timestamp < manifest['max_timestamp']:
+            logger.warning('New files contain observations older than the already ingested ones, rebuilding the whole long table')
+            full_rebuild = True
+            files.update(read_csv_files([key for key in fingerprints if key not in files]))
+            files = {key: files[key] for key in fingerprints}
+    if full_rebuild:
+        manifest = empty_manifest()
+
+    rows_per_file = {key: len(source['utc_timestamp']) for key, (_, source) in files.items()}
+    n_observations = sum(file['rows'] for file in manifest['files'].values()) + sum(rows_per_file.values())
+    logger.info(f'Successfully read all files. Total number of observations: {n_observations}')
+
+    # check if there is the right number of sensor observations
+    if n_observations != EXPECTED_SENSOR_OBSERVATIONS:
+        logger.error(f'dataframe shape ({n_observations}) does not match expected ({EXPECTED_SENSOR_OBSERVATIONS},{len(columns)})')
+    else:
+        logger.info(f'dataframe shape ({n_observations}) is as expected: ({EXPECTED_SENSOR_OBSERVATIONS},{len(columns)})')
+
+    # Add sensor metadata: qid_mapping, quantity_name, source_name and unit become categoricals coded via the qid lookup table
+    # (instead of merging four string columns onto every row), so the file-local qid codes are translated to lookup codes
+    qid_lookup = extend_qid_lookup(catalog, np.unique(np.concatenate([categories for categories, _ in files.values()])))
+    for categories, source in files.values():
+        local_codes = source['qid_code']
+        source['qid_code'] = np.where(local_codes >= 0, qid_codes(categories, qid_lookup)[local_codes], -1).astype(np.int16)
+    ingested_files = list(files)
+    sources = [source for _, source in files.values()]
+    del files
+
+    # the store keeps float32 values, the exact values only for the full precision qids (see appended_store.py)
+    exact_qids = full_precision_qids(qid_lookup)
+    logger.info(f'number of variables after merge: {len(np.unique(np.concatenate([np.unique(source["qid_code"]) for source in sources])))}')
+
+    # -- STEP 3: k-way merge the time sorted files into time sorted chunks, compute time deltas and write to the store --
+    # The merged chunks are written as consecutive part files, so the store holds the table sorted by timestamp without a global sort.
+    # Part files are named part-<batch>-<chunk>, so the files of an incremental append sort behind the existing ones.
+    # time_delta_sec is the difference between a given observation and the last observation of that qid_mapping;
+    # the last timestamp per qid is carried from one chunk to the next (and from the manifest for an incremental append).
+    # For a full rebuild all sensor/weather partitions are replaced, the noon report partitions (written by add_noon_reps.py) are kept.
+    os.makedirs(long_table_dir, exist_ok=True)
+    if full_rebuild:
+        stale_prefixes = existing_qid_prefixes(long_table_dir) - {NOON_REPORT_QID_PREFIX}
+        clear_qid_prefixes(long_table_dir, stale_prefixes)
+
+    batch = manifest['batches']
+    last_timestamps = last_timestamps_array(manifest, qid_lookup)
+    n_written = 0
+    for chunk_number, chunk in enumerate(kway_merge(sources, MERGE_BLOCK_ROWS, MERGE_CHUNK_ROWS)):
+        time_delta_sec = time_deltas(chunk['utc_timestamp'], chunk['qid_code'], last_timestamps)
+        chunk_df = compact_long_from_codes(chunk['utc_timestamp'], chunk['qid_code'], chunk['value'], qid_lookup, time_delta_sec)
+        write_long_table(chunk_df, long_table_dir, part_name=f'part-{batch:04d}-{chunk_number:05d}', replace=False, full_precision_qids=exact_qids)
+        n_written += len(chunk_df)
+
+    logger.info(f'Added sensor metadata and time_delta columns. Appended shape: ({n_written}, {len(chunk_df.columns) if n_written else 0})')
+    save_manifest(update_manifest(manifest, fingerprints, ingested_files, rows_per_file, last_timestamps, qid_lookup), manifest_path)
+    logger.info(f'Saved appended dataframe (excl. noon reports) to {long_table_dir}')
+    return n_written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Appends the monthly raw observation files to the long table store. Only files that are not in the ingest manifest yet are appended, unless --full is given.')
+    parser.add_argument('--full', action='store_true', help='re-ingest all raw files instead of only the new ones')
+    args = parser.parse_args()
+    append(full=args.full)
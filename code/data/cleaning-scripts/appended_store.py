@@ -0,0 +1,352 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from loguru import logger
+
+# Columnar storage of the appended long table (utc_timestamp, qid_mapping, value, quantity_name, source_name, unit, time_delta_sec).
+# The table is written as a hive-partitioned parquet dataset:
+#
+#   appended/long_table/month=2024-01/qid_prefix=2/part-00000.parquet
+#
+# utc_timestamp is stored as int64 nanoseconds since epoch (UTC) and the string columns are dictionary-encoded,
+# so reading the table back does not involve any CSV or ISO8601 parsing.
+#
+# value is stored as float32 for every qid. The full precision qids given to write_long_table (cumulative counters, see
+# long_table.full_precision_qids) additionally keep their exact value in value_float64, which is null for all other rows
+# (their row groups hold no float64 values). read_long_table puts the exact values back into the value column (full_precision=True).
+#
+# Within a part file the rows are clustered by qid (time ordered per qid) and every qid gets its own row groups. The row range of
+# every qid is persisted in the key-value metadata of the file footer (QID_INDEX_METADATA_KEY, {qid: [first_row, end_row]}), so a read
+# for a few qids (e.g. only the weather or noon report variables) only decodes the row groups of these qids. Together with the month
+# and qid prefix partitions this pushes qid, qid prefix and time range predicates down to the files (see read_long_table).
+# Because of this clustering a read table is not in time order: it consists of one time-ordered run per qid and part file.
+# read_long_table(time_ordered=True) merges these runs by time.
+
+LONG_TABLE_DIR_NAME = 'long_table'
+NOON_REPORT_QID_PREFIX = '0'
+WEATHER_QID_PREFIX = '4'
+DICTIONARY_COLUMNS = ['qid_mapping', 'quantity_name', 'source_name', 'unit']
+QID_INDEX_METADATA_KEY = b'qid_row_ranges'
+FULL_PRECISION_VALUE_COLUMN = 'value_float64'
+PARTITIONING = ds.partitioning(
+    pa.schema([('month', pa.string()), ('qid_prefix', pa.string())]),
+    flavor='hive',
+)
+
+
+def qid_prefix(qids):
+    """Returns the first '::'-separated token of each qid (e.g. '4' for weather, '0' for noon reports)."""
+    return pd.Series(qids, dtype=object).str.split('::').str[0]
+
+
+def timestamps_to_int64(timestamps):
+    """Converts tz-aware timestamps to int64 nanoseconds since epoch (UTC)."""
+    return timestamps.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy(dtype='datetime64[ns]').view('int64')
+
+
+def _partition_keys(df):
+    """Computes the month ('YYYY-MM') and qid prefix partition keys for every row without formatting timestamps row by row."""
+    ts = df['utc_timestamp']
+    month_key = (ts.dt.year * 100 + ts.dt.month).to_numpy()
+
+    qid_cat = df['qid_mapping'].astype('category')
+    codes = qid_cat.cat.codes.to_numpy()
+    if (codes < 0).any():
+        # code -1 would index the prefix of the last category
+        raise ValueError(f'{(codes < 0).sum()} rows without qid_mapping cannot be assigned to a qid prefix partition')
+    prefix_per_category = qid_prefix(qid_cat.cat.categories).to_numpy()
+    prefix_key = prefix_per_category[codes]
+    return month_key, prefix_key
+
+
+def _to_arrow(df, full_precision_qids=()):
+    """
+    Converts a long table slice to an arrow table with int64 timestamps, dictionary-encoded string columns and float32 values.
+    The exact values of the full precision qids are added as FULL_PRECISION_VALUE_COLUMN (null for the other qids).
+    """
+    out = {}
+    for col in df.columns:
+        if col == 'value':
+            values = df[col].to_numpy()
+            out[col] = pa.array(values.astype(np.float32, copy=False))
+            full_precision_rows = df['qid_mapping'].isin(full_precision_qids).to_numpy()
+            out[FULL_PRECISION_VALUE_COLUMN] = pa.array(values.astype(np.float64, copy=False), mask=~full_precision_rows, type=pa.float64())
+        elif col == 'utc_timestamp':
+            out[col] = pa.array(timestamps_to_int64(df[col]), type=pa.int64())
+        elif col in DICTIONARY_COLUMNS:
+            # int32 indices for every file, so that all partitions share one dataset schema
+            values = df[col].astype('category')
+            codes = values.cat.codes.to_numpy().astype('int32')
+            out[col] = pa.DictionaryArray.from_arrays(
+                pa.array(codes, mask=codes < 0, type=pa.int32()),
+                pa.array(values.cat.categories.astype(str).to_numpy(dtype=object), type=pa.string()),
+            )
+        else:
+            out[col] = pa.array(df[col].to_numpy())
+    return pa.table(out)
+
+
+def _write_part_file(df, file_path, full_precision_qids=()):
+    """
+    This function writes a part file with the rows clustered by qid (one or more row groups per qid) and the qid row-range index in the footer.
+
+    Args:
+        df: Long table slice of one partition, in time order.
+        file_path: Path of the parquet file.
+        full_precision_qids: qids whose exact values are stored in FULL_PRECISION_VALUE_COLUMN.
+    """
+    qid_cat = df['qid_mapping'].astype('category')
+    codes = qid_cat.cat.codes.to_numpy()
+    order = np.argsort(codes, kind='stable')  # clustered by qid, time order within a qid
+    sorted_codes = codes[order]
+    boundaries = np.flatnonzero(sorted_codes[1:] != sorted_codes[:-1]) + 1
+    starts = np.concatenate([[0], boundaries])
+    ends = np.concatenate([boundaries, [len(order)]])
+
+    table = _to_arrow(df.iloc[order], full_precision_qids)
+    row_ranges = {str(qid_cat.cat.categories[sorted_codes[start]]) if sorted_codes[start] >= 0 else '': [int(start), int(end)]
+                  for start, end in zip(starts, ends)}
+    schema = table.schema.with_metadata({**(table.schema.metadata or {}), QID_INDEX_METADATA_KEY: json.dumps(row_ranges).encode()})
+    with pq.ParquetWriter(file_path, schema) as writer:
+        for start, end in zip(starts, ends):
+            writer.write_table(table.slice(start, end - start).cast(schema))
+
+
+def qid_row_groups(fragment, qids):
+    """
+    This function selects the row groups of a part file that hold the given qids, using the qid row-range index in its footer.
+
+    Args:
+        fragment: Parquet file fragment of the dataset.
+        qids: Qids to read.
+
+    Returns:
+        List of row group ids, or None if the file has no qid index (then the whole file has to be scanned).
+    """
+    metadata = fragment.metadata
+    index = metadata.schema.to_arrow_schema().metadata or {}
+    if QID_INDEX_METADATA_KEY not in index:
+        return None
+    row_ranges = json.loads(index[QID_INDEX_METADATA_KEY])
+    ranges = [row_ranges[qid] for qid in qids if qid in row_ranges]
+
+    group_ends = np.cumsum([metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)])
+    group_starts = group_ends - np.array([metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)])
+    selected = np.zeros(metadata.num_row_groups, dtype=bool)
+    for start, end in ranges:
+        selected |= (group_starts < end) & (group_ends > start)
+    return np.flatnonzero(selected).tolist()
+
+
+def existing_qid_prefixes(store_dir):
+    """Returns the qid prefixes that currently have at least one partition in the store."""
+    if not os.path.isdir(store_dir):
+        return set()
+    prefixes = set()
+    for month_dir in os.listdir(store_dir):
+        month_path = os.path.join(store_dir, month_dir)
+        if not month_dir.startswith('month=') or not os.path.isdir(month_path):
+            continue
+        for prefix_dir in os.listdir(month_path):
+            if prefix_dir.startswith('qid_prefix='):
+                prefixes.add(prefix_dir.split('=', 1)[1])
+    return prefixes
+
+
+def clear_qid_prefixes(store_dir, prefixes):
+    """Deletes all partitions of the given qid prefixes (across all months) from the store."""
+    if not os.path.isdir(store_dir):
+        return
+    for month_dir in os.listdir(store_dir):
+        month_path = os.path.join(store_dir, month_dir)
+        if not month_dir.startswith('month=') or not os.path.isdir(month_path):
+            continue
+        for prefix in prefixes:
+            partition_path = os.path.join(month_path, f'qid_prefix={prefix}')
+            if os.path.isdir(partition_path):
+                shutil.rmtree(partition_path)
+                logger.info(f'Deleted partition: {partition_path}')
+        if not os.listdir(month_path):
+            os.rmdir(month_path)
+
+
+def write_long_table(df, store_dir, clear_prefixes=(), part_name='part-00000', replace=True, full_precision_qids=()):
+    """
+    Writes the long observation table to the partitioned columnar store.
+    Existing partitions of the qid prefixes present in df are replaced, unless replace is False.
+
+    Args:
+        df: Long table with at least utc_timestamp (tz-aware) and qid_mapping columns.
+        store_dir: Root directory of the partitioned dataset.
+        clear_prefixes: Additional qid prefixes whose existing partitions are deleted before writing.
+        part_name: File name (without extension) used for the written part files.
+        replace: If False, the part files are added to the existing partitions (used for writing a table in chunks).
+        full_precision_qids: qids whose exact (float64) values are stored besides the float32 values (see long_table.full_precision_qids).
+
+    Returns:
+        List of written file paths.
+    """
+    # rows without a qid (e.g. noon report columns missing from NOON_REPORT_QIDS) have no partition
+    missing_qid = df['qid_mapping'].isna().to_numpy()
+    if missing_qid.any():
+        logger.warning(f'Dropping {missing_qid.sum()} rows without qid_mapping, they cannot be assigned to a qid prefix partition')
+        df = df[~missing_qid]
+
+    month_key, prefix_key = _partition_keys(df)
+
+    clear_qid_prefixes(store_dir, (set(np.unique(prefix_key)) if replace else set()) | set(clear_prefixes))
+
+    written = []
+    order = np.lexsort((prefix_key, month_key))
+    month_sorted = month_key[order]
+    prefix_sorted = prefix_key[order]
+    boundaries = np.flatnonzero((month_sorted[1:] != month_sorted[:-1]) | (prefix_sorted[1:] != prefix_sorted[:-1])) + 1
+    starts = np.concatenate([[0], boundaries])
+    ends = np.concatenate([boundaries, [len(order)]])
+
+    for start, end in zip(starts, ends):
+        if start == end:
+            continue
+        month = f'{month_sorted[start] // 100:04d}-{month_sorted[start] % 100:02d}'
+        prefix = prefix_sorted[start]
+        rows = np.sort(order[start:end])  # keep the original (time) order within the partition
+        partition_dir = os.path.join(store_dir, f'month={month}', f'qid_prefix={prefix}')
+        os.makedirs(partition_dir, exist_ok=True)
+        file_path = os.path.join(partition_dir, f'{part_name}.parquet')
+        _write_part_file(df.iloc[rows], file_path, full_precision_qids)
+        written.append(file_path)
+
+    logger.info(f'Wrote {len(df)} rows to {len(written)} partition file(s) in {store_dir}')
+    return written
+
+
+def _utc_nanoseconds(timestamp):
+    """Converts a timestamp (tz-naive timestamps are taken as UTC) to int64 nanoseconds since epoch."""
+    timestamp = pd.Timestamp(timestamp)
+    timestamp = timestamp.tz_localize('UTC') if timestamp.tzinfo is None else timestamp.tz_convert('UTC')
+    return timestamp.as_unit('ns').value
+
+
+def _conjunction(expressions):
+    """Combines dataset filter expressions with and (None if there are none)."""
+    combined = None
+    for expression in expressions:
+        combined = expression if combined is None else combined & expression
+    return combined
+
+
+def time_order(timestamps):
+    """
+    This function returns the permutation that puts rows made of a few time-ordered runs in time order (ties keep their order).
+    The stable sort is numpy's timsort, which finds the runs and merges them (O(n log runs) instead of a full sort of the rows).
+
+    Args:
+        timestamps: int64 timestamps of the rows.
+
+    Returns:
+        Array of row positions in time order, or None if the rows are already in time order.
+    """
+    if len(timestamps) < 2 or (timestamps[1:] >= timestamps[:-1]).all():
+        return None
+    return np.argsort(timestamps, kind='stable')
+
+
+def read_long_table(store_dir, qid_prefixes=None, exclude_qid_prefixes=None, columns=None, qids=None, start=None, end=None, time_ordered=False, full_precision=True):
+    """
+    Reads the long observation table from the partitioned columnar store. The predicates are pushed down to the files:
+    qid prefixes and time ranges select partitions, qids select row groups via the qid index of the part files.
+
+    Args:
+        store_dir: Root directory of the partitioned dataset.
+        qid_prefixes: If provided, only partitions with these qid prefixes are read.
+        exclude_qid_prefixes: If provided, partitions with these qid prefixes are skipped.
+        columns: Columns to read (all columns if None).
+        qids: If provided, only the observations of these qids are read.
+        start: If provided, only observations at or after this time are read (tz-naive times are taken as UTC).
+        end: If provided, only observations before this time are read.
+        time_ordered: If True, the time-ordered runs of the part files are merged, so the rows are in time order (see time_order).
+        full_precision: If True, the full precision qids get their exact values, so the value column is float64 if any of them were read.
+            If False, all values are float32.
+
+    Returns:
+        DataFrame with utc_timestamp as tz-aware (UTC) datetimes and the dictionary columns as categoricals.
+        Rows are ordered by partition (month, qid prefix) and part file, and by qid and time within each part file,
+        or by time if time_ordered is True (rows with equal timestamps in the order above).
+    """
+    dataset = ds.dataset(store_dir, format='parquet', partitioning=PARTITIONING)
+
+    # stores written before the exact values got their own column may hold float64 values or no FULL_PRECISION_VALUE_COLUMN,
+    # so promote to a common schema instead of letting the dataset cast everything to the schema of the first file
+    schemas = [fragment.physical_schema for fragment in dataset.get_fragments()]
+    if schemas:
+        schema = pa.unify_schemas(schemas + [dataset.schema], promote_options='permissive')
+        dataset = ds.dataset(store_dir, format='parquet', partitioning=PARTITIONING, schema=schema)
+
+    # partition predicates
+    expressions = []
+    if qid_prefixes is not None:
+        expressions.append(ds.field('qid_prefix').isin([str(p) for p in qid_prefixes]))
+    if exclude_qid_prefixes is not None:
+        expressions.append(~ds.field('qid_prefix').isin([str(p) for p in exclude_qid_prefixes]))
+    if qids is not None:
+        qids = [str(qid) for qid in qids]
+        expressions.append(ds.field('qid_prefix').isin(qid_prefix(qids).unique().tolist()))
+    if start is not None:
+        expressions.append(ds.field('month') >= pd.Timestamp(start).strftime('%Y-%m'))
+    if end is not None:
+        expressions.append(ds.field('month') <= pd.Timestamp(end).strftime('%Y-%m'))
+    partition_expression = _conjunction(expressions)
+
+    # row predicates
+    row_expressions = list(expressions)
+    if qids is not None:
+        row_expressions.append(ds.field('qid_mapping').isin(qids))
+    if start is not None:
+        row_expressions.append(ds.field('utc_timestamp') >= _utc_nanoseconds(start))
+    if end is not None:
+        row_expressions.append(ds.field('utc_timestamp') < _utc_nanoseconds(end))
+    row_expression = _conjunction(row_expressions)
+
+    # qid predicate: only the row groups of the qids (files without qid index are scanned completely)
+    if qids is not None:
+        fragments = []
+        for fragment in dataset.get_fragments(filter=partition_expression):
+            row_groups = qid_row_groups(fragment, qids)
+            if row_groups is None:
+                fragments.append(fragment)
+            elif row_groups:
+                fragments.append(fragment.subset(row_group_ids=row_groups))
+        dataset = ds.FileSystemDataset(fragments, dataset.schema, dataset.format, filesystem=dataset.filesystem)
+
+    if columns is None:
+        columns = [name for name in dataset.schema.names if name not in ('month', 'qid_prefix', FULL_PRECISION_VALUE_COLUMN)]
+    read_exact_values = full_precision and 'value' in columns and FULL_PRECISION_VALUE_COLUMN in dataset.schema.names
+
+    if time_ordered and 'utc_timestamp' not in columns:
+        raise ValueError('utc_timestamp has to be read for time_ordered')
+
+    table = dataset.to_table(columns=columns + ([FULL_PRECISION_VALUE_COLUMN] if read_exact_values else []), filter=row_expression)
+    if read_exact_values:
+        exact_values = table.column(FULL_PRECISION_VALUE_COLUMN)
+        table = table.drop_columns([FULL_PRECISION_VALUE_COLUMN])
+        if exact_values.null_count < len(exact_values):
+            values = pc.if_else(pc.is_valid(exact_values), exact_values, pc.cast(table.column('value'), pa.float64()))
+            table = table.set_column(table.schema.get_field_index('value'), 'value', values)
+    elif not full_precision and 'value' in columns:
+        table = table.set_column(table.schema.get_field_index('value'), 'value', pc.cast(table.column('value'), pa.float32()))
+    if time_ordered:
+        order = time_order(table.column('utc_timestamp').to_numpy())
+        if order is not None:
+            table = table.take(order)
+    df = table.to_pandas()
+    if 'utc_timestamp' in df.columns:
+        df['utc_timestamp'] = pd.to_datetime(df['utc_timestamp'].to_numpy(), unit='ns', utc=True)
+
+    logger.info(f'Read {len(df)} rows from {store_dir}')
+    return df
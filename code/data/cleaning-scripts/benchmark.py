@@ -0,0 +1,466 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import inspect
+import argparse
+import platform
+import functools
+import importlib
+import statistics
+import subprocess
+from datetime import datetime
+from loguru import logger
+from run_pipeline import STAGE_NAMES
+import generate_synthetic_data
+
+# define paths
+script_dir = os.path.dirname(os.path.abspath(__file__))
+default_work_dir = os.path.join(script_dir, '..', 'benchmark')
+benchmark_output_dir = os.path.join(script_dir, '..', '..', 'outputs', 'benchmarks')
+BASELINE_NAME = 'baseline.json'
+
+# Per-stage benchmark suite with stored baselines.
+#
+# Every benchmark size is a synthetic vessel (see generate_synthetic_data.py, about 120k observations per day) written once to
+#   <work_dir>/<size>/data/       raw data, metadata and a copy of the current cleaning scripts (the stages write their outputs here)
+#   <work_dir>/<size>/outputs/    logs of the stages
+#   <work_dir>/<size>/*.log       output of the last benchmarked processes (and hot_functions.jsonl of the profile run)
+# and reused as long as the generator and the size did not change (benchmark_data.json). The scripts are copied again on every run.
+#
+# For every size, all derived data is removed and the stage scripts are run in order, each in its own process (like run_pipeline.py does),
+# measuring the wall time and the peak RSS of the stage process (ru_maxrss from wait4, the largest of the stage process and its workers).
+# Then the pipeline is run once more in-process with timers around the hot functions (HOT_FUNCTIONS); the Pool workers are forked and
+# inherit the timers, every call appends a json line to a log that is summed up per function. Rows per second are the raw observations
+# of the size divided by the wall time for stages, and the rows handed to the function divided by its time for hot functions.
+#
+# The results are saved to code/outputs/benchmarks/benchmark_<run id>.json:
+#   {
+#     "run_id": ..., "git_commit": ..., "machine": {"platform": ..., "python": ..., "cpu_count": ...}, "repeat": ..., "tolerance": ...,
+#     "results": {"<size>": {"rows": ..., "days": ...,
+#                            "stages": {"<stage>": {"wall_seconds": ..., "rows_per_second": ..., "peak_rss_mb": ..., "runs": [...]}, ...},
+#                            "in_process": {"wall_seconds": ..., "rows_per_second": ..., "peak_rss_mb": ...},
+#                            "hot_functions": {"<module>.<function>": {"wall_seconds": ..., "calls": ..., "rows": ..., "rows_per_second": ...}, ...}}}
+#   }
+# and compared with the baseline code/outputs/benchmarks/baseline.json (or --baseline): a wall time or peak RSS more than --tolerance
+# above the baseline is a regression (wall times below --min-seconds in the baseline are too noisy to compare) and makes the script exit
+# with code 1. The baseline is fixed: it is only written by the first run (when there is none yet) and replaced with --update-baseline,
+# so a slow run never becomes the reference of the next one and slowdowns below the tolerance cannot add up unnoticed.
+# The baseline holds the sizes of the run it was made from, other sizes are not compared.
+#
+# Usage (from the repository root):
+#   python code/data/cleaning-scripts/benchmark.py                          # 1M rows, compare with the baseline
+#   python code/data/cleaning-scripts/benchmark.py --sizes 1M 10M --repeat 3 --tolerance 0.1
+#   python code/data/cleaning-scripts/benchmark.py --update-baseline        # accept the results of this run as the new baseline
+#   python code/data/cleaning-scripts/benchmark.py --baseline code/outputs/benchmarks/benchmark_20250101_120000.json
+
+# benchmark size -> days of synthetic data of one vessel
+BENCHMARK_SIZES = {
+    '1M': 8.5,
+    '10M': 85.0,
+    '100M': 850.0,
+    '1B': 8500.0,
+}
+
+# (module, function, rows handed to a call) of the functions timed in the profile run, the rows are computed from the call arguments by name
+HOT_FUNCTIONS = [
+    ('synchronize', 'process_single_segment', lambda arguments: arguments['args'][2] - arguments['args'][1]),  # (i, start_row, end_row, seg_info)
+    ('pre_agg_clean', '_filter_segment_start_and_ends', lambda arguments: len(arguments['df'])),
+    ('pre_agg_clean', '_mark_spikes', lambda arguments: len(arguments['df'])),
+    ('pre_agg_clean', '_filter_by_rolling_stds', lambda arguments: len(arguments['df'])),
+    ('aggregate', 'window_statistics', lambda arguments: len(arguments['df'])),
+    ('aggregate', 'join_long_vars_asof', lambda arguments: len(arguments['out_df'])),
+]
+
+# data derived by the stages (relative to the data root), removed before every benchmark run
+DERIVED_PATHS = [
+    'metadata/Metrics registration.csv',
+    'metadata/catalog.json',
+    'appended',
+    'synchronized',
+    'filtered',
+    'aggregated',
+    'engineered',
+    '.pipeline_cache.json',
+    '../outputs',
+]
+
+COMPARED_METRICS = ['wall_seconds', 'peak_rss_mb']
+
+
+# --- Benchmark data ---
+
+def file_sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def prepare_data(size, work_dir=default_work_dir, days=None, seed=0):
+    """
+    This function makes sure the synthetic data of a benchmark size exists and copies the current cleaning scripts next to it.
+
+    Args:
+        size: Name of the benchmark size (key of BENCHMARK_SIZES, or any name if days is given).
+        work_dir: Directory with one subdirectory per size.
+        days: Days of synthetic data (default: BENCHMARK_SIZES[size]).
+        seed: Seed of the generator.
+
+    Returns:
+        Tuple of the data root and the data description (size, days, seed, generator hash and number of rows).
+    """
+    root = os.path.join(work_dir, size, 'data')
+    marker_path = os.path.join(root, 'benchmark_data.json')
+    description = {
+        'size': size,
+        'days': BENCHMARK_SIZES[size] if days is None else days,
+        'seed': seed,
+        'generator_sha256': file_sha256(generate_synthetic_data.__file__),
+    }
+
+    saved = None
+    if os.path.isfile(marker_path):
+        with open(marker_path) as f:
+            saved = json.load(f)
+    if saved is not None and {key: saved.get(key) for key in description} == description:
+        logger.info(f'Reusing {saved["rows"]} rows of synthetic data for size {size} in {root}')
+        description = saved
+    else:
+        logger.info(f'Generating {description["days"]} days of synthetic data for size {size} in {root}')
+        rows = generate_synthetic_data.generate(root, days=description['days'], seed=seed, overwrite=True)
+        description['rows'] = rows[root]
+        with open(marker_path, 'w') as f:
+            json.dump(description, f, indent=1)
+
+    # always benchmark the current scripts
+    shutil.rmtree(os.path.join(root, 'cleaning-scripts'), ignore_errors=True)
+    generate_synthetic_data.copy_cleaning_scripts(root)
+    return root, description
+
+
+def remove_derived_data(root):
+    """Removes everything the stages wrote to a data root (and its outputs directory), so every run starts from the raw data."""
+    for relative_path in DERIVED_PATHS:
+        path = os.path.normpath(os.path.join(root, relative_path))
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.isfile(path):
+            os.remove(path)
+
+
+# --- Measurements ---
+
+def run_measured(command, cwd, log_path):
+    """
+    This function runs a command and measures it.
+
+    Args:
+        command: Command (list of arguments).
+        cwd: Working directory.
+        log_path: File for the output of the process.
+
+    Returns:
+        Dict with the exit code, the wall time in seconds and the peak RSS in MB of the process (the largest of it and its children).
+    """
+    with open(log_path, 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall_seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    peak_rss_mb = usage.ru_maxrss / (1024**2 if sys.platform == 'darwin' else 1024)
+    return {'exit_code': process.returncode, 'wall_seconds': wall_seconds, 'peak_rss_mb': peak_rss_mb}
+
+
+def benchmark_stages(root, rows, repeat=1):
+    """
+    This function runs all stages of the copied scripts in order (from the raw data) and measures every stage process.
+
+    Args:
+        root: Data root with the raw data and the copied cleaning scripts.
+        rows: Number of raw observations (for the rows per second).
+        repeat: Number of runs, the median wall time and the largest peak RSS are reported.
+
+    Returns:
+        Dict of stage name -> measurements.
+    """
+    runs = {name: [] for name in STAGE_NAMES}
+    for run in range(repeat):
+        remove_derived_data(root)
+        for name in STAGE_NAMES:
+            log_path = os.path.join(os.path.dirname(root), f'{name}.log')
+            measurement = run_measured([sys.executable, os.path.join(root, 'cleaning-scripts', f'{name}.py')], os.path.dirname(root), log_path)
+            if measurement['exit_code'] != 0:
+                raise RuntimeError(f'{name}.py failed with exit code {measurement["exit_code"]} on {root}, see {log_path}')
+            logger.info(f'Run {run + 1}/{repeat}: {name}.py took {measurement["wall_seconds"]:.2f}s, peak RSS {measurement["peak_rss_mb"]:.0f} MB')
+            runs[name].append(measurement)
+
+    stages = {}
+    for name, measurements in runs.items():
+        wall_seconds = statistics.median(m['wall_seconds'] for m in measurements)
+        stages[name] = {
+            'wall_seconds': wall_seconds,
+            'rows_per_second': rows / wall_seconds,
+            'peak_rss_mb': max(m['peak_rss_mb'] for m in measurements),
+            'runs': [m['wall_seconds'] for m in measurements],
+        }
+    return stages
+
+
+def _timed(function, name, count_rows, log_path):
+    """Wraps a function so every call appends its name, duration and rows to the hot function log (also from forked workers)."""
+    signature = inspect.signature(function)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        rows = int(count_rows(signature.bind(*args, **kwargs).arguments))
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        with open(log_path, 'a') as f:
+            f.write(json.dumps({'function': name, 'seconds': seconds, 'rows': rows, 'pid': os.getpid()}) + '\n')
+        return result
+    return wrapper
+
+
+def install_timers(log_path, hot_functions=HOT_FUNCTIONS):
+    """Replaces the hot functions in their modules with timed wrappers (callers look them up as module globals at call time)."""
+    for module_name, function_name, count_rows in hot_functions:
+        module = importlib.import_module(module_name)
+        name = f'{module_name}.{function_name}'
+        setattr(module, function_name, _timed(getattr(module, function_name), name, count_rows, log_path))
+
+
+def profile_hot_functions(log_path):
+    """Runs the pipeline in-process with timed hot functions (called in a subprocess, see benchmark_hot_functions)."""
+    import run_pipeline
+    install_timers(log_path)
+    run_pipeline.run_in_process()
+
+
+def summarize_hot_function_log(log_path):
+    """Sums up the hot function log per function."""
+    functions = {f'{module_name}.{function_name}': {'wall_seconds': 0.0, 'calls': 0, 'rows': 0} for module_name, function_name, _ in HOT_FUNCTIONS}
+    with open(log_path) as f:
+        for line in f:
+            record = json.loads(line)
+            summary = functions[record['function']]
+            summary['wall_seconds'] += record['seconds']
+            summary['calls'] += 1
+            summary['rows'] += record['rows']
+    for name, summary in functions.items():
+        if summary['calls'] == 0:
+            logger.warning(f'{name} was not called in the profile run')
+        summary['rows_per_second'] = summary['rows'] / summary['wall_seconds'] if summary['wall_seconds'] > 0 else None
+    return functions
+
+
+def benchmark_hot_functions(root, rows):
+    """
+    This function runs the pipeline in-process in the copied scripts with timers around the hot functions.
+
+    Args:
+        root: Data root with the raw data and the copied cleaning scripts (the stages have already been run once).
+        rows: Number of raw observations (for the rows per second of the whole run).
+
+    Returns:
+        Tuple of the measurements of the whole in-process run and the dict of hot function -> summed up measurements.
+    """
+    copied_script_dir = os.path.join(root, 'cleaning-scripts')
+    log_path = os.path.join(os.path.dirname(root), 'hot_functions.jsonl')
+    open(log_path, 'w').close()
+
+    output_path = os.path.join(os.path.dirname(root), 'in_process.log')
+    measurement = run_measured([sys.executable, os.path.join(copied_script_dir, 'benchmark.py'), '--profile-hot-functions', log_path], copied_script_dir, output_path)
+    if measurement['exit_code'] != 0:
+        raise RuntimeError(f'The in-process profile run failed with exit code {measurement["exit_code"]} on {root}, see {output_path}')
+    logger.info(f'In-process profile run took {measurement["wall_seconds"]:.2f}s, peak RSS {measurement["peak_rss_mb"]:.0f} MB')
+
+    in_process = {
+        'wall_seconds': measurement['wall_seconds'],
+        'rows_per_second': rows / measurement['wall_seconds'],
+        'peak_rss_mb': measurement['peak_rss_mb'],
+    }
+    return in_process, summarize_hot_function_log(log_path)
+
+
+def benchmark_size(size, work_dir=default_work_dir, days=None, repeat=1, seed=0):
+    """
+    This function benchmarks the stages and the hot functions for one data size.
+
+    Args:
+        size: Name of the benchmark size.
+        work_dir: Directory of the benchmark data.
+        days: Days of synthetic data (default: BENCHMARK_SIZES[size]).
+        repeat: Number of runs of the stages.
+        seed: Seed of the generator.
+
+    Returns:
+        Results of the size (see the description at the top of the file).
+    """
+    root, description = prepare_data(size, work_dir, days, seed)
+    rows = description['rows']
+    stages = benchmark_stages(root, rows, repeat)
+    in_process, hot_functions = benchmark_hot_functions(root, rows)
+    return {'rows': rows, 'days': description['days'], 'stages': stages, 'in_process': in_process, 'hot_functions': hot_functions}
+
+
+# --- Baselines ---
+
+def git_commit():
+    """Returns the current git commit of the repository (None outside of a git checkout)."""
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=script_dir, capture_output=True, text=True)
+    except OSError:
+        return None
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def machine():
+    return {'platform': platform.platform(), 'python': platform.python_version(), 'cpu_count': os.cpu_count()}
+
+
+def save_results(results, output_dir=benchmark_output_dir, name=None):
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, name or f'benchmark_{results["run_id"]}.json')
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=1)
+    logger.info(f'Saved benchmark results to {path}')
+    return path
+
+
+def compare_results(results, baseline, tolerance=0.2, min_seconds=1.0):
+    """
+    This function compares the results with a baseline. Only sizes, stages and hot functions present in both are compared.
+
+    Args:
+        results: Current results.
+        baseline: Baseline results (e.g. the previous saved results).
+        tolerance: Allowed relative increase of the wall time and the peak RSS (0.2 = 20 %).
+        min_seconds: Wall times below this in the baseline are not compared (too noisy).
+
+    Returns:
+        List of regressions (dicts with size, kind, name, metric, baseline, current and ratio).
+    """
+    if baseline['machine'] != results['machine']:
+        logger.warning(f'The baseline was measured on a different machine ({baseline["machine"]}), the comparison may not be meaningful')
+
+    regressions = []
+    for size, size_results in results['results'].items():
+        if size not in baseline['results']:
+            logger.info(f'Size {size} is not in the baseline, nothing to compare')
+            continue
+        size_baseline = baseline['results'][size]
+        if size_baseline['rows'] != size_results['rows']:
+            logger.warning(f'Size {size} has {size_results["rows"]} rows, the baseline had {size_baseline["rows"]}')
+
+        entries = [('stage', name, entry, size_baseline['stages'].get(name)) for name, entry in size_results['stages'].items()]
+        entries.append(('in_process', 'run_in_process', size_results['in_process'], size_baseline.get('in_process')))
+        entries += [('function', name, entry, size_baseline['hot_functions'].get(name)) for name, entry in size_results['hot_functions'].items()]
+
+        for kind, name, current, previous in entries:
+            if previous is None:
+                continue
+            for metric in COMPARED_METRICS:
+                if metric not in current or metric not in previous or not previous[metric]:
+                    continue
+                if metric == 'wall_seconds' and previous[metric] < min_seconds:
+                    continue
+                ratio = current[metric] / previous[metric]
+                message = f'{size} {kind} {name}: {metric} {previous[metric]:.2f} -> {current[metric]:.2f} ({ratio - 1:+.0%})'
+                if ratio > 1 + tolerance:
+                    logger.warning(f'Regression: {message}')
+                    regressions.append({'size': size, 'kind': kind, 'name': name, 'metric': metric, 'baseline': previous[metric], 'current': current[metric], 'ratio': ratio})
+                else:
+                    logger.info(message)
+    return regressions
+
+
+def benchmark(sizes=('1M',), work_dir=default_work_dir, days=None, repeat=1, seed=0, baseline_path=None, tolerance=0.2, min_seconds=1.0, save=True, output_dir=benchmark_output_dir, update_baseline=False):
+    """
+    This function runs the benchmark suite, saves the results and compares them with the baseline.
+    The baseline is only written if there is none yet or update_baseline is True, so it stays fixed between runs.
+
+    Args:
+        sizes: Names of the benchmark sizes.
+        work_dir: Directory of the benchmark data.
+        days: Days of synthetic data for all sizes (default: BENCHMARK_SIZES of every size).
+        repeat: Number of runs of the stages per size.
+        seed: Seed of the generator.
+        baseline_path: Results to compare with (default: baseline.json in output_dir).
+        tolerance: Allowed relative increase of the wall time and the peak RSS.
+        min_seconds: Wall times below this in the baseline are not compared.
+        save: Save the results of this run.
+        output_dir: Directory of the saved results and of the baseline.
+        update_baseline: Replace the baseline in output_dir with the results of this run (also if they contain regressions).
+
+    Returns:
+        Tuple of the results and the list of regressions.
+    """
+    default_baseline_path = os.path.join(output_dir, BASELINE_NAME)
+    baseline_path = baseline_path or default_baseline_path
+    results = {
+        'run_id': datetime.now().strftime('%Y%m%d_%H%M%S'),
+        'git_commit': git_commit(),
+        'machine': machine(),
+        'repeat': repeat,
+        'tolerance': tolerance,
+        'results': {},
+    }
+    for size in sizes:
+        logger.info(f'Benchmarking size {size}')
+        results['results'][size] = benchmark_size(size, work_dir, days, repeat, seed)
+
+    if save:
+        save_results(results, output_dir)
+
+    regressions = []
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        logger.info(f'Comparing with the baseline {baseline_path} (commit {baseline["git_commit"]}, tolerance {tolerance:.0%})')
+        regressions = compare_results(results, baseline, tolerance, min_seconds)
+        logger.info(f'{len(regressions)} regression(s) found')
+    elif baseline_path != default_baseline_path:
+        raise FileNotFoundError(f'Baseline {baseline_path} does not exist')
+    else:
+        logger.info(f'No baseline found, the results of this run become the baseline {default_baseline_path}')
+        update_baseline = True
+
+    if update_baseline:
+        if regressions:
+            logger.warning(f'Replacing the baseline with results containing {len(regressions)} regression(s), as requested')
+        save_results(results, output_dir, BASELINE_NAME)
+    elif regressions:
+        logger.info('The baseline is kept, use --update-baseline to accept the results of this run as the new baseline')
+    return results, regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the pipeline stages and their hot functions on synthetic data and compares the results with a baseline.')
+    parser.add_argument('--sizes', nargs='+', default=['1M'], help=f'benchmark sizes ({", ".join(BENCHMARK_SIZES)}), or any name together with --days')
+    parser.add_argument('--days', type=float, help='days of synthetic data for all sizes (overrides the fixed sizes)')
+    parser.add_argument('--repeat', type=int, default=1, help='runs of the stages per size (the median wall time is reported)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    parser.add_argument('--work-dir', default=default_work_dir, help='directory of the benchmark data (default: code/data/benchmark)')
+    parser.add_argument('--output-dir', default=benchmark_output_dir, help='directory of the saved results (default: code/outputs/benchmarks)')
+    parser.add_argument('--baseline', help='results to compare with (default: code/outputs/benchmarks/baseline.json)')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative increase of wall time and peak RSS (default: 0.2)')
+    parser.add_argument('--min-seconds', type=float, default=1.0, help='do not compare wall times below this in the baseline (default: 1.0)')
+    parser.add_argument('--no-save', action='store_true', help='do not save the results')
+    parser.add_argument('--update-baseline', action='store_true', help='replace the baseline with the results of this run (the baseline is never replaced otherwise)')
+    parser.add_argument('--profile-hot-functions', metavar='LOG', help=argparse.SUPPRESS)  # internal: the in-process profile run
+    args = parser.parse_args()
+
+    if args.profile_hot_functions:
+        profile_hot_functions(args.profile_hot_functions)
+        sys.exit(0)
+
+    unknown_sizes = [size for size in args.sizes if size not in BENCHMARK_SIZES]
+    if unknown_sizes and args.days is None:
+        parser.error(f'unknown sizes {unknown_sizes}, use --days for custom sizes')
+
+    _, regressions = benchmark(args.sizes, args.work_dir, args.days, args.repeat, args.seed, args.baseline, args.tolerance, args.min_seconds, not args.no_save, args.output_dir, args.update_baseline)
+    sys.exit(1 if regressions else 0)
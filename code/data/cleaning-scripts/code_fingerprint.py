@@ -0,0 +1,62 @@
+import os
+import ast
+import hashlib
+
+# Fingerprints of the pipeline code. A stage script depends on its own source, on the local modules (files in cleaning-scripts) it imports
+# (transitively, at any level of the file) and on the config.py constants they use. run_pipeline.py keys the stages with these
+# fingerprints and synchronize.py stores the code hash of its run to decide if a later run can continue it.
+# This module only imports the standard library, so it does not add any local dependencies to the scripts using it.
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def local_dependencies(module_name):
+    """
+    This function collects the local modules (files in cleaning-scripts) a stage script depends on and the config constants they import.
+
+    Args:
+        module_name: Name of the stage script without .py.
+
+    Returns:
+        Tuple of (sorted local module names incl. the script itself, sorted names of the imported config constants).
+    """
+    modules, config_names = set(), set()
+    queue = [module_name]
+    while queue:
+        name = queue.pop()
+        if name in modules:
+            continue
+        modules.add(name)
+        with open(os.path.join(script_dir, f'{name}.py')) as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.ImportFrom) and node.module == 'config':
+                config_names.update(alias.name for alias in node.names)
+            elif isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == 'config':
+                config_names.add(node.attr)
+            elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+                local = node.module.split('.')[0]
+                if local != 'config' and os.path.isfile(os.path.join(script_dir, f'{local}.py')):
+                    queue.append(local)
+            elif isinstance(node, ast.Import):
+                for alias in node.names:
+                    local = alias.name.split('.')[0]
+                    if local != 'config' and os.path.isfile(os.path.join(script_dir, f'{local}.py')):
+                        queue.append(local)
+    return sorted(modules), sorted(config_names)
+
+
+def update_with_modules(digest, modules):
+    """Adds the source code of the local modules to a hash."""
+    for name in modules:
+        with open(os.path.join(script_dir, f'{name}.py'), 'rb') as f:
+            digest.update(f'module {name}\n'.encode())
+            digest.update(f.read())
+
+
+def code_hash(module_name):
+    """Returns the sha256 over the source code of a script and the local modules it imports (the code part of its stage key)."""
+    modules, _ = local_dependencies(module_name)
+    digest = hashlib.sha256()
+    update_with_modules(digest, modules)
+    return digest.hexdigest()
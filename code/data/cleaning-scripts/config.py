@@ -1,5 +1,9 @@
 EXPECTED_SENSOR_OBSERVATIONS = 41079968
 
+# --- Appending ---
+MERGE_BLOCK_ROWS = 1_000_000 # rows looked ahead per file in each round of the k-way merge of the monthly files
+MERGE_CHUNK_ROWS = 5_000_000 # rows per merged chunk written to the long table store
+
 NOON_REPORT_QIDS = {
     'Slip' : "0::0::0::0_0::0::0::0::0_0::0::0::0_1" ,
     'Fwd Draft' : "0::0::0::0_0::0::0::0::0_0::0::0::0_2" ,
@@ -34,7 +38,7 @@ NOON_REPORT_UNITS = {
     'Fuel' : "categorical"
     }
 
-INCLUDED_NOON_REPORT_QIDS = NOON_REPORT_QIDS = [
+INCLUDED_NOON_REPORT_QIDS = [
     "0::0::0::0_0::0::0::0::0_0::0::0::0_2" , # Fwd Draft
     "0::0::0::0_0::0::0::0::0_0::0::0::0_3" ,
     "0::0::0::0_0::0::0::0::0_0::0::0::0_4" ,
@@ -99,6 +103,13 @@ INTENDED_SAMPLING_INTERVALS_SECONDS = {
     "1::0::15::0_1::2::0::3::0_1::0::6::0_8" : 15, # Main Engine Turbocharger Rotational Speed (Transducer RPM)
 }
 
+# Quantities whose values are kept as float64 in the long table (cumulative counters: float32 rounding would destroy the small increments between observations)
+FULL_PRECISION_QUANTITIES = [
+    'Vessel Propeller Shaft Revolutions',
+    'Vessel Propeller Shaft Revolutions (cumulative)',
+    'Vessel Propeller Shaft Mechanical Energy',
+]
+
 NAN_IMPUTATION_STRATEGIES = {
     # Noon Reports
     'Slip': 'forward_fill',
@@ -246,6 +257,9 @@ ROLLING_STD_THRESHOLDS = {
 ROLLING_STD_WINDOW_SIZE = 120 # 120 observations corresponds to 30 minutes at a 15-second sampling interval
 ROLLING_STD_MIN_PERIODS = 60 # require at least 60 observations (15 minutes) to calculate a rolling std, to avoid flagging too many observations at the start of segments
 
+# Segment shards per worker process when the cleaning runs in parallel (more shards balance the load better)
+CLEANING_SHARDS_PER_WORKER = 4
+
 SPEED_THROUGH_WATER_THRESHOLD = 4 # knots. Observations with a speed through water below this threshold will be removed, as they are likely to correspond to maneuvering or other unsteady operations that are not of interest for the analysis.
 
 THRESHOLD_FACTOR = 0.5
@@ -261,8 +275,54 @@ SHAFT_POWER_MAX_DEVIATION = 0.02
 # The highest tolerated deviation between calculated shaft revolutions delta (from rpm) and measured shaft revolutions delta (from cumulative shaft revolutions) in percentage. Observations with a higher deviation will be replaced with NaN.
 SHAFT_REVOLUTIONS_MAX_DEVIATION = 0.05
 
+# Sea temperatures at or below this value are sensor dropouts (based on line graph)
+SEA_TEMPERATURE_DROPOUT_MAX = 6
+# Value given by the seawater velocity sensors (Provider S) during dropouts (based on histogram, rather than 0)
+SEAWATER_VELOCITY_DROPOUT_VALUE = -0.4
+# Valid range of heading and angle values in degrees
+ANGLE_RANGE = (0, 360)
+
+# Dropout, sentinel and consistency rules, evaluated in this order by dropout_rules.py (a rule sees the NaNs of the rules before it).
+# Every rule flags the rows where the predicate (see dropout_rules.PREDICATES) of its columns is true, replaces the 'replace' columns
+# of these rows with NaN and adds the flag column (1 if flagged, 0 if not). 'derive' adds a calculated column before the rule is evaluated.
+# Note that the flag names of the wave angle and seawater velocity rules are the names of the data columns, so the flags replace these columns.
+DROPOUT_RULES = [
+    # if the engine is running, the propeller should be as well (negative propeller rpm means reverse and is kept)
+    {'flag': 'Inconsistent Engine and Propeller RPM', 'predicate': 'zero_while_positive', 'columns': ['Vessel Propeller Shaft Rotational Speed', 'Main Engine Rotational Speed'],
+     'replace': ['Vessel Propeller Shaft Rotational Speed', 'Main Engine Rotational Speed']},
+    # propeller rpm and shaft power must have the same sign
+    {'flag': 'Inconsistent Propeller RPM and Shaft Power', 'predicate': 'opposite_signs', 'columns': ['Vessel Propeller Shaft Rotational Speed', 'Vessel Propeller Shaft Mechanical Power'],
+     'replace': ['Vessel Propeller Shaft Rotational Speed', 'Vessel Propeller Shaft Mechanical Power']},
+    # impossible weather values
+    {'flag': 'Negative Wave Height (Provider MB)', 'predicate': 'below', 'threshold': 0, 'columns': ['Vessel External Conditions Wave Significant Height (Provider MB)']},
+    {'flag': 'Negative Wave Height (Provider S)', 'predicate': 'below', 'threshold': 0, 'columns': ['Vessel External Conditions Wave Significant Height (Provider S)']},
+    {'flag': 'Negative Wind Speed', 'predicate': 'below', 'threshold': 0, 'columns': ['Vessel External Conditions Wind True Speed (Provider MB)']},
+    {'flag': 'Negative Wave Period', 'predicate': 'below', 'threshold': 0, 'columns': ['Vessel External Conditions Wave Period (Provider S)']},
+    {'flag': 'Negative Sea Temperature', 'predicate': 'below', 'threshold': 0, 'columns': ['Vessel External Conditions Sea Water Temperature (Provider S)']},
+    # impossible sensor values
+    {'flag': 'Negative Hull Over Ground Speed', 'predicate': 'below', 'threshold': 0, 'columns': ['Vessel Hull Over Ground Speed']},
+    {'flag': 'Negative Main Engine Rotational Speed', 'predicate': 'below', 'threshold': 0, 'columns': ['Main Engine Rotational Speed']},
+    # sensor dropouts
+    {'flag': 'Sea Temperature Dropout', 'predicate': 'at_most', 'threshold': SEA_TEMPERATURE_DROPOUT_MAX, 'columns': ['Vessel External Conditions Sea Water Temperature (Provider S)']},
+    # impossible angles
+    {'flag': 'Impossible Wind Relative Angle', 'predicate': 'outside', 'threshold': ANGLE_RANGE, 'columns': ['Vessel External Conditions Wind Relative Angle']},
+    {'flag': 'Impossible Vessel Heading', 'predicate': 'outside', 'threshold': ANGLE_RANGE, 'columns': ['Vessel Hull Heading True Angle']},
+    {'flag': 'Impossible Vessel External Conditions Wind True Angle (Provivider MB)', 'predicate': 'outside', 'threshold': ANGLE_RANGE, 'columns': ['Vessel External Conditions Wind True Angle (Provider MB)']},
+    {'flag': 'Vessel External Conditions Wave True Angle (Provider S)', 'predicate': 'outside', 'threshold': ANGLE_RANGE, 'columns': ['Vessel External Conditions Wave True Angle (Provider S)']},
+    # measured shaft power must match the shaft power calculated from torque and rpm
+    {'flag': 'Unreliable Shaft / Torque / RPM relation', 'predicate': 'relative_deviation_above', 'threshold': SHAFT_POWER_MAX_DEVIATION,
+     'derive': {'column': 'Calculated Shaft Power', 'function': 'shaft_power', 'columns': ['Vessel Propeller Shaft Torque', 'Vessel Propeller Shaft Rotational Speed']},
+     'columns': ['Vessel Propeller Shaft Mechanical Power', 'Calculated Shaft Power'],
+     'replace': ['Vessel Propeller Shaft Mechanical Power', 'Vessel Propeller Shaft Torque', 'Vessel Propeller Shaft Rotational Speed']},
+    # seawater velocity dropouts
+    {'flag': 'Vessel External Conditions Eastward Sea Water Velocity (Provider S)', 'predicate': 'equals', 'threshold': SEAWATER_VELOCITY_DROPOUT_VALUE, 'columns': ['Vessel External Conditions Eastward Sea Water Velocity (Provider S)']},
+    {'flag': 'Vessel External Conditions Northward Sea Water Velocity (Provider S)', 'predicate': 'equals', 'threshold': SEAWATER_VELOCITY_DROPOUT_VALUE, 'columns': ['Vessel External Conditions Northward Sea Water Velocity (Provider S)']},
+]
+
 # --- Aggregation ---
-WINDOW_LENGTH = "15min"
+WINDOW_LENGTH = "15min"  # resolution used by the feature engineering
+
+AGGREGATION_WINDOW_LENGTHS = ["5min", WINDOW_LENGTH, "1h"]  # resolutions written by aggregate.py (aggregated_<length>.csv), each must divide a day
 
 MIN_WINDOW_COVERAGE = 0.9
 
@@ -334,4 +394,21 @@ CUMULATIVE_COLS = [
 
 JANUARY_CLEANING_DATE = "2024-01-22"
 
-JULY_CLEANING_DATE = "2024-07-26"
\ No newline at end of file
+JULY_CLEANING_DATE = "2024-07-26"
+
+# Engineered features, computed by engineer_features.py in this order. Every feature is the function (see engineer_features.FEATURE_FUNCTIONS)
+# applied to its input columns (aggregated columns or features defined above it) with the given parameters.
+# Features are computed on request and cached per column (see engineer_features.py), so adding a feature only costs its own computation.
+FEATURES = [
+    {
+        'name': 'Days Since Last Cleaning',
+        'function': 'days_since_last',
+        'columns': ['window_start'],
+        'params': {'dates': [JANUARY_CLEANING_DATE, JULY_CLEANING_DATE]},
+    },
+    {
+        'name': 'Avg Draft (Calculated)',
+        'function': 'mean',
+        'columns': ['Fwd Draft (Noon Report)', 'Aft Draft (Noon Report)'],
+    },
+]
@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+from loguru import logger
+from quality_flags import set_flags
+
+# Rule engine for the dropout, sentinel and consistency rules (DROPOUT_RULES in config.py).
+#
+# A rule is data: the flag name, a predicate from PREDICATES, the columns the predicate reads, an optional threshold, the columns
+# to replace with NaN (default: the columns of the predicate) and optionally a derived column from DERIVED_COLUMNS.
+# All rules are evaluated in one pass over numpy arrays of only the columns they use: every column is read from the DataFrame once,
+# the rules are applied in order to the arrays (so a rule sees the NaNs written by the rules before it), and the replaced columns
+# and derived columns are written back to the DataFrame once at the end. The flags are stored in the quality flag words (see quality_flags.py),
+# except for flags named like an existing column, which replace that column (1 if flagged, 0 if not) as they always did.
+# Adding a rule costs one vectorized predicate on its own columns, not another scan of the table.
+
+PREDICATES = {
+    'below': lambda threshold, x: x < threshold,
+    'at_most': lambda threshold, x: x <= threshold,
+    # the long table stores the values as float32 (see long_table.py), so sentinels are compared at that precision
+    # (-0.4 read back from float32 is -0.4000000059604645 as float64)
+    'equals': lambda threshold, x: x.astype(np.float32) == np.float32(threshold),
+    'outside': lambda threshold, x: (x < threshold[0]) | (x > threshold[1]),
+    # first column is 0 while the second is positive
+    'zero_while_positive': lambda threshold, x, y: (x == 0) & (y > 0),
+    # one column is positive and the other negative
+    'opposite_signs': lambda threshold, x, y: ((x > 0) & (y < 0)) | ((x < 0) & (y > 0)),
+    # first column deviates from the second by more than threshold times the absolute value of the second
+    'relative_deviation_above': lambda threshold, x, y: np.abs(x - y) > threshold * np.abs(y),
+}
+
+DERIVED_COLUMNS = {
+    # shaft power from torque and rotational speed in rpm
+    'shaft_power': lambda torque, rpm: (torque * rpm * 2 * np.pi) / 60,
+}
+
+
+def apply_dropout_rules(df, rules, quality_flags):
+    """
+    This function evaluates the dropout rules, replaces the flagged values with NaN and adds the flag columns.
+
+    Args:
+        df: DataFrame to clean (rules whose columns are missing are skipped).
+        rules: List of rules (see DROPOUT_RULES in config.py).
+        quality_flags: Registry of the quality flags (see quality_flags.py), the flags of the rules are added to it.
+
+    Returns:
+        Tuple of (DataFrame with the replaced values, derived columns and flag words, dict of flag name to number of flagged rows).
+    """
+    arrays = {}   # working copy of every column used by the rules
+    written = {}  # columns to write back, in the order they were first written
+
+    def column(name):
+        if name not in arrays:
+            arrays[name] = df[name].to_numpy(dtype=np.float64, na_value=np.nan, copy=True)
+        return arrays[name]
+
+    def write(name, values):
+        arrays[name] = values
+        written[name] = True
+
+    flags, counts = {}, {}
+    for rule in rules:
+        derive = rule.get('derive')
+        required = rule['columns'] + (derive['columns'] if derive else []) + rule.get('replace', [])
+        missing = [name for name in required if name not in df.columns and name not in arrays and not (derive and name == derive['column'])]
+        if missing:
+            logger.warning(f'Columns {missing} not found in dataframe, skipping rule {rule["flag"]}')
+            continue
+
+        if derive:
+            write(derive['column'], DERIVED_COLUMNS[derive['function']](*[column(name) for name in derive['columns']]))
+
+        with np.errstate(invalid='ignore'):
+            condition = PREDICATES[rule['predicate']](rule.get('threshold'), *[column(name) for name in rule['columns']])
+        for name in rule.get('replace', rule['columns']):
+            values = column(name)
+            values[condition] = np.nan
+            write(name, values)
+
+        num_flagged = condition.sum()
+        replaced = ', '.join(rule.get('replace', rule['columns']))
+        logger.info(f'Replaced {num_flagged} ({num_flagged / len(df) * 100:.5f}% of df) rows with NaN for {rule["flag"]} in {replaced}')
+        if rule['flag'] in df.columns:
+            write(rule['flag'], condition.astype(int))
+        else:
+            flags[rule['flag']] = condition
+        counts[rule['flag']] = num_flagged
+
+    # write back once: existing columns in place, new columns appended in the order they were created
+    existing = [name for name in written if name in df.columns]
+    new = [name for name in written if name not in df.columns]
+    for name in existing:
+        df[name] = arrays[name]
+    df = pd.concat([df, pd.DataFrame({name: arrays[name] for name in new}, index=df.index)], axis=1)
+    set_flags(df, quality_flags, flags)
+    return df, counts
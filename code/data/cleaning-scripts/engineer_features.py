@@ -2,7 +2,12 @@ import pandas as pd
 import numpy as np
 import os
 import re
-from config import WINDOW_LENGTH, JULY_CLEANING_DATE, JANUARY_CLEANING_DATE
+import json
+import hashlib
+import inspect
+import pyarrow as pa
+import pyarrow.parquet as pq
+from config import WINDOW_LENGTH, FEATURES
 from typing import List
 from datetime import datetime
 from loguru import logger
@@ -14,110 +19,310 @@ aggregated_data_path = os.path.join(aggregated_dir, f'aggregated_{WINDOW_LENGTH}
 engineered_dir = os.path.join(script_dir, '..', 'engineered')
 feature_engineering_output_dir = os.path.join(script_dir, '..', '..', 'outputs', 'feature-engineering')
 
-# Create the engineered directory if it doesn't exist
-if not os.path.exists(engineered_dir):
-    os.makedirs(engineered_dir)
-    logger.info(f'Created engineered directory: {engineered_dir}')
-else:
-    logger.info(f'Engineered directory already exists: {engineered_dir}')
+# Feature registry with lazy, cached feature computation.
+#
+# The features are data (FEATURES in config.py): the feature name, a function from FEATURE_FUNCTIONS, the input columns it reads
+# (aggregated columns or features defined before it) and optional parameters. A feature is only computed when it is requested
+# (compute_features or load_engineered), together with the features it depends on.
+# Every computed feature is cached as a single column parquet file per window length:
+#
+#   engineered/features/<WINDOW_LENGTH>/<feature name>.parquet     footer metadata b'feature_key': sha256 of the cache key
+#
+# The cache key covers the feature definition (function source code, input columns, parameters), the window length and the
+# content hashes of the input columns and of window_start (the rows the column is aligned with). A cached column is used as long as
+# its key matches, so adding a feature or requesting a subset of the features only costs the computation of the features that changed.
 
-# start logger
+FEATURE_KEY_METADATA_KEY = b'feature_key'
 
-# Create the feature engineering output directory for filtering results if it doesn't exist
-if not os.path.exists(feature_engineering_output_dir):
-    os.makedirs(feature_engineering_output_dir)
-    logger.info(f'Created feature engineering output directory: {feature_engineering_output_dir}')
-else:
-    logger.info(f'Feature engineering output directory already exists: {feature_engineering_output_dir}')
+# --- Feature Functions ---
 
-log_path = os.path.join(feature_engineering_output_dir, f'pre_agg_cleaning_log_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log')
+def days_since_last(timestamps, dates: List):
+    """
+    This function calculates the days since the last of the given dates for every timestamp (NaN before the first date).
 
-logger.add(
-    log_path,
-    level='INFO',
-    format='{time:YYYY-MM-DD HH:mm:ss} | {level} | {message}'
-)
+    Args:
+        timestamps: Series of timestamps (e.g. window_start).
+        dates: List of dates (e.g. the hull cleaning dates).
 
-# load data
-df = pd.read_csv(aggregated_data_path)
+    Returns:
+        Numpy array with the days since the last date.
+    """
+    dates_ts = pd.to_datetime(dates, utc=True, errors="coerce")
+    dates_ts = pd.Series(dates_ts).dropna().drop_duplicates().sort_values()
 
-# Ensure datetime datatypes
-df["window_start"] = pd.to_datetime(df["window_start"], format="ISO8601", utc=True)
+    if dates_ts.empty:
+        raise ValueError("No valid dates were provided.")
 
-logger.info(f'Loaded data from {aggregated_data_path} with shape {df.shape}')
-
-# --- Functions ---
-
-# --- Key Features ---
-
-def add_days_since_cleaning(df, new_column_name: str, cleaning_dates: List):
-    if "window_start" not in df.columns:
-        raise KeyError("Column 'window_start' is required to calculate days since cleaning.")
-
-    cleaning_ts = pd.to_datetime(cleaning_dates, utc=True, errors="coerce")
-    cleaning_ts = pd.Series(cleaning_ts).dropna().drop_duplicates().sort_values()
-
-    if cleaning_ts.empty:
-        raise ValueError("No valid cleaning dates were provided.")
-
-    timestamps = pd.to_datetime(df["window_start"], utc=True, errors="coerce")
+    timestamps = pd.to_datetime(timestamps, utc=True, errors="coerce")
 
     if timestamps.isna().any():
-        raise ValueError("Column 'window_start' contains invalid datetime values.")
+        raise ValueError(f"Column '{timestamps.name}' contains invalid datetime values.")
+
+    # merge_asof needs both keys in the same resolution (window_start is ns in memory, us when parsed from csv)
+    dates_ts = dates_ts.dt.as_unit(timestamps.dt.unit)
 
     timestamps_df = pd.DataFrame(
         {
-            "window_start": timestamps,
-            "_row_order": np.arange(len(df)),
+            "timestamp": timestamps.to_numpy(),
+            "_row_order": np.arange(len(timestamps)),
         }
-    ).sort_values("window_start")
+    ).sort_values("timestamp")
 
-    cleaning_df = pd.DataFrame({"cleaning_date": cleaning_ts}).sort_values("cleaning_date")
+    dates_df = pd.DataFrame({"date": dates_ts}).sort_values("date")
 
     merged = pd.merge_asof(
         timestamps_df,
-        cleaning_df,
-        left_on="window_start",
-        right_on="cleaning_date",
+        dates_df,
+        left_on="timestamp",
+        right_on="date",
         direction="backward",
     )
 
-    merged[new_column_name] = (
-        (merged["window_start"] - merged["cleaning_date"]).dt.total_seconds() / 86400
-    )
+    days = (merged["timestamp"] - merged["date"]).dt.total_seconds() / 86400
+
+    return days.to_numpy()[np.argsort(merged["_row_order"].to_numpy(), kind="stable")]
+
+def row_mean(*columns):
+    """Returns the mean of the given columns per row (NaN if any of them is NaN)."""
+    total = columns[0]
+    for column in columns[1:]:
+        total = total + column
+    return (total / len(columns)).to_numpy()
+
+FEATURE_FUNCTIONS = {
+    'days_since_last': days_since_last,
+    'mean': row_mean,
+}
+
+# --- Cache ---
+
+def feature_cache_dir(window_length=WINDOW_LENGTH):
+    """Returns the directory of the cached feature columns of a window length."""
+    return os.path.join(engineered_dir, 'features', window_length)
+
+def feature_cache_path(cache_dir, name):
+    """Returns the path of the cached column of a feature (the name with anything but letters, digits, '-' and '_' replaced)."""
+    return os.path.join(cache_dir, f"{re.sub(r'[^A-Za-z0-9_-]+', '_', name).strip('_')}.parquet")
+
+def column_fingerprint(values):
+    """Returns the sha256 hash of the values of a column (timestamps in ns, so that parsed and in-memory columns hash alike)."""
+    if isinstance(values.dtype, pd.DatetimeTZDtype) or pd.api.types.is_datetime64_dtype(values):
+        values = values.dt.as_unit("ns")
+    return hashlib.sha256(pd.util.hash_pandas_object(values, index=False).to_numpy().tobytes()).hexdigest()
+
+def feature_key(feature, input_fingerprints, window_length):
+    """Returns the cache key of a feature: the hash of its definition, the window length and the fingerprints of its inputs."""
+    definition = {
+        'name': feature['name'],
+        'function': feature['function'],
+        'source': inspect.getsource(FEATURE_FUNCTIONS[feature['function']]),
+        'columns': feature['columns'],
+        'params': feature.get('params', {}),
+        'window_length': window_length,
+        'inputs': input_fingerprints,
+    }
+    return hashlib.sha256(json.dumps(definition, sort_keys=True, default=str).encode()).hexdigest()
+
+def read_cached_feature(path, key, n_rows):
+    """Returns the cached column of a feature if it was computed with the given key, otherwise None."""
+    if not os.path.isfile(path):
+        return None
+    metadata = pq.read_schema(path).metadata or {}
+    if metadata.get(FEATURE_KEY_METADATA_KEY) != key.encode():
+        return None
+    table = pq.read_table(path)
+    if table.num_rows != n_rows:
+        return None
+    return table.column(0).to_pandas().to_numpy()
+
+def write_cached_feature(path, name, values, key):
+    """Writes the column of a feature with its cache key atomically (a crashed run leaves the previous file in place)."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    table = pa.table({name: values})
+    table = table.replace_schema_metadata({FEATURE_KEY_METADATA_KEY: key.encode()})
+    tmp_path = f'{path}.tmp'
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+# --- Registry ---
+
+def resolve_features(names=None, features=FEATURES):
+    """
+    This function returns the features needed to compute the requested features (incl. the features they depend on).
+
+    Args:
+        names: Names of the requested features (None for all features).
+        features: Feature registry (see FEATURES in config.py).
+
+    Returns:
+        List of the feature definitions in registry order.
+    """
+    registry = {feature['name']: feature for feature in features}
+    unknown = [name for name in (names or []) if name not in registry]
+    if unknown:
+        raise KeyError(f"Unknown features {unknown}. Registered features: {list(registry)}")
+
+    needed = set(registry) if names is None else set()
+    pending = list(names or [])
+    while pending:
+        name = pending.pop()
+        if name in needed:
+            continue
+        needed.add(name)
+        pending.extend(column for column in registry[name]['columns'] if column in registry)
+    return [feature for feature in features if feature['name'] in needed]
+
+def feature_inputs(names=None, features=FEATURES):
+    """Returns the columns (other than features) that the requested features read."""
+    resolved = resolve_features(names, features)
+    feature_names = {feature['name'] for feature in resolved}
+    return list(dict.fromkeys(column for feature in resolved for column in feature['columns'] if column not in feature_names))
+
+def compute_features(df, names=None, window_length=WINDOW_LENGTH, features=FEATURES, cache_dir=None):
+    """
+    This function adds the requested features to the aggregated data, from the cache where possible.
+
+    Args:
+        df: Aggregated data with window_start as tz-aware datetimes (only the input columns of the requested features are needed).
+        names: Names of the features to add (None for all features). The features they depend on are added as well.
+        window_length: Window length of the aggregated data (part of the cache key).
+        features: Feature registry (see FEATURES in config.py).
+        cache_dir: Directory of the cached feature columns (default: feature_cache_dir(window_length)).
+
+    Returns:
+        The DataFrame with the feature columns added.
+    """
+    cache_dir = cache_dir or feature_cache_dir(window_length)
+    fingerprints = {}
+
+    def fingerprint(column):
+        if column not in fingerprints:
+            fingerprints[column] = column_fingerprint(df[column])
+        return fingerprints[column]
+
+    computed, cached = [], []
+    for feature in resolve_features(names, features):
+        name = feature['name']
+        missing = [column for column in feature['columns'] if column not in df.columns]
+        if "window_start" not in df.columns:
+            missing.append("window_start")
+        if missing:
+            raise KeyError(f"Columns {missing} are required to compute feature '{name}'.")
+
+        inputs = {column: fingerprint(column) for column in dict.fromkeys(["window_start"] + feature['columns'])}
+        key = feature_key(feature, inputs, window_length)
+        path = feature_cache_path(cache_dir, name)
+        values = read_cached_feature(path, key, len(df))
+        if values is None:
+            values = FEATURE_FUNCTIONS[feature['function']](*[df[column] for column in feature['columns']], **feature.get('params', {}))
+            write_cached_feature(path, name, values, key)
+            computed.append(name)
+        else:
+            cached.append(name)
+        df[name] = values
+        fingerprints.pop(name, None)
+
+    logger.info(f'Computed features {computed}, loaded cached features {cached} ({cache_dir})')
+    return df
 
-    df[new_column_name] = (
-        merged.sort_values("_row_order")[new_column_name].to_numpy()
-    )
+def load_engineered(columns=None, window_length=WINDOW_LENGTH, features=FEATURES):
+    """
+    This function loads the aggregated data with the engineered features, reading only the columns that are needed
+    and computing only the requested features (e.g. for the modelling notebooks instead of the full engineered csv).
+
+    Args:
+        columns: Aggregated columns and feature names to return (None for all aggregated columns and all features).
+        window_length: Window length of the aggregated data.
+        features: Feature registry (see FEATURES in config.py).
+
+    Returns:
+        DataFrame with window_start and the requested columns.
+    """
+    path = os.path.join(aggregated_dir, f'aggregated_{window_length}.csv')
+    feature_names = {feature['name'] for feature in features}
+    if columns is None:
+        usecols, requested = None, None
+    else:
+        requested = [column for column in columns if column in feature_names]
+        usecols = list(dict.fromkeys(["window_start"] + [column for column in columns if column not in feature_names]
+                                     + feature_inputs(requested, features)))
+
+    df = pd.read_csv(path, usecols=usecols)
+    df["window_start"] = pd.to_datetime(df["window_start"], format="ISO8601", utc=True)
+    logger.info(f'Loaded data from {path} with shape {df.shape}')
+
+    df = compute_features(df, requested, window_length, features)
+    if columns is None:
+        return df
+    return df[list(dict.fromkeys(["window_start"] + list(columns)))]
+
+# --- Pipeline Stage ---
+
+def engineer_features(df, window_length=WINDOW_LENGTH):
+    """
+    This function adds all registered features to the aggregated data (pipeline stage).
+
+    Args:
+        df: Aggregated data with window_start as tz-aware datetimes.
+        window_length: Window length of the aggregated data.
+
+    Returns:
+        The DataFrame with the engineered feature columns added.
+    """
+    columns_before = set(df.columns)
+
+    df = compute_features(df, window_length=window_length)
+
+    if "Days Since Last Cleaning" in df.columns:
+        # get the first value of every day in january to check if the feature is correct
+        first_values_january = df[df["window_start"].dt.month == 1].groupby(df["window_start"].dt.date).first()[["window_start", "Days Since Last Cleaning"]]
+
+        logger.info("Added 'Days Since Last Cleaning' feature. First values in January:")
+        logger.info(first_values_january.head(31))
+
+    columns_after = set(df.columns)
+    new_columns = columns_after - columns_before
+    logger.info(f"Added {len(new_columns)} new columns: {sorted(list(new_columns))}")
 
     return df
 
-def add_mid_draft(df, new_column_name: str, fore_draft_col_name: str, aft_draft_col_name: str):
 
-    df[new_column_name] = (df[fore_draft_col_name] + df[aft_draft_col_name]) / 2
+if __name__ == '__main__':
+    # Create the engineered directory if it doesn't exist
+    if not os.path.exists(engineered_dir):
+        os.makedirs(engineered_dir)
+        logger.info(f'Created engineered directory: {engineered_dir}')
+    else:
+        logger.info(f'Engineered directory already exists: {engineered_dir}')
 
-    return df
+    # start logger
 
-# --- Fringe Features ---
+    # Create the feature engineering output directory for filtering results if it doesn't exist
+    if not os.path.exists(feature_engineering_output_dir):
+        os.makedirs(feature_engineering_output_dir)
+        logger.info(f'Created feature engineering output directory: {feature_engineering_output_dir}')
+    else:
+        logger.info(f'Feature engineering output directory already exists: {feature_engineering_output_dir}')
 
-# --- Executions ---
+    log_path = os.path.join(feature_engineering_output_dir, f'pre_agg_cleaning_log_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log')
 
-columns_before = set(df.columns)
+    logger.add(
+        log_path,
+        level='INFO',
+        format='{time:YYYY-MM-DD HH:mm:ss} | {level} | {message}'
+    )
 
-df = add_days_since_cleaning(df, "Days Since Last Cleaning", [JANUARY_CLEANING_DATE, JULY_CLEANING_DATE])
-df = add_mid_draft(df, "Avg Draft (Calculated)", "Fwd Draft (Noon Report)", "Aft Draft (Noon Report)")
+    # load data
+    df = pd.read_csv(aggregated_data_path)
 
-# get the first value of every day in january to check if the feature is correct
-first_values_january = df[df["window_start"].dt.month == 1].groupby(df["window_start"].dt.date).first()[["window_start", "Days Since Last Cleaning"]]
+    # Ensure datetime datatypes
+    df["window_start"] = pd.to_datetime(df["window_start"], format="ISO8601", utc=True)
 
-logger.info("Added 'Days Since Last Cleaning' feature. First values in January:")
-logger.info(first_values_january.head(31))
+    logger.info(f'Loaded data from {aggregated_data_path} with shape {df.shape}')
 
-# save the dateframe with the new features
-output_path = os.path.join(engineered_dir, f"engineered_features_{WINDOW_LENGTH}.csv")
-df.to_csv(output_path, index=False)
-logger.info(f"Saved data with engineered features to {output_path}")
+    df = engineer_features(df)
 
-columns_after = set(df.columns)
-new_columns = columns_after - columns_before
-logger.info(f"Added {len(new_columns)} new columns: {sorted(list(new_columns))}")
\ No newline at end of file
+    # save the dateframe with the new features
+    output_path = os.path.join(engineered_dir, f"engineered_features_{WINDOW_LENGTH}.csv")
+    df.to_csv(output_path, index=False)
+    logger.info(f"Saved data with engineered features to {output_path}")
@@ -0,0 +1,476 @@
+import os
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool, cpu_count
+from loguru import logger
+from config import INTENDED_SAMPLING_INTERVALS_SECONDS, NOON_REPORT_QIDS, SENSOR_SPIKE_THRESHOLDS, SEA_TEMPERATURE_DROPOUT_MAX, SEAWATER_VELOCITY_DROPOUT_VALUE
+from appended_store import NOON_REPORT_QID_PREFIX, WEATHER_QID_PREFIX, qid_prefix
+
+# define paths
+script_dir = os.path.dirname(os.path.abspath(__file__))
+default_output_dir = os.path.join(script_dir, '..', 'synthetic')
+
+# Synthetic vessel data generator.
+#
+# Writes data in the layout the pipeline reads from code/data, so every stage can be run and benchmarked without the production data:
+#
+#   <root>/raw/unzipped/<month>/<year>_<qid>.csv        sensor and weather observations without header: utc_timestamp,qid_mapping,value
+#   <root>/raw/unzipped/Noon Reports/noon_reports_<year>.csv   one row per day: Date (dd/mm/YYYY) and the noon report quantities
+#   <root>/metadata/Metrics registration.xlsx           qid_mapping, quantity_name, source_name, unit of the sensor and weather qids
+#   <root>/cleaning-scripts/                            copy of the pipeline scripts (optional), they resolve their paths relative to themselves
+#
+# The pipeline handles one vessel, so every vessel is written to its own root (<output>/vessel_<n>, or <output> itself for one vessel).
+# The qids and their sampling intervals are the ones in INTENDED_SAMPLING_INTERVALS_SECONDS (the redundant turbocharger qid is registered
+# without observations and the hull drafts of the alarm monitoring system only have missing values, as in the real data).
+#
+# The observations follow a simple vessel model: sailing legs with a constant course and target speed alternate with port stays, the
+# engine and propeller follow the propeller law (so measured and calculated shaft power agree) and the cumulative counters integrate the
+# rotational speed and power. Slow processes (speed, course, weather, currents) are mean reverting random walks on a 10 minute grid that are
+# interpolated to the sampling times, the sensors add white noise. Defects are added with configurable rates:
+#   outages        gaps in all 15 s sensors (gaps_per_day, exponentially distributed lengths with mean_gap_minutes), and a last one shortly
+#                  before the end that closes the last segment
+#   spikes         single observations of the spike filtered quantities (SENSOR_SPIKE_THRESHOLDS) off by 20-50 % (spike_rate per observation)
+#   duplicates     repeated observations (duplicate_rate per observation, every duplicate is a time gap for synchronize.py)
+#   sentinels      sea temperature dropouts at or below SEA_TEMPERATURE_DROPOUT_MAX and sea water velocity dropouts of exactly
+#                  SEAWATER_VELOCITY_DROPOUT_VALUE (Provider S) (sentinel_rate per observation)
+# The same seed gives the same data. A vessel-day has about 120k observations, so a vessel-year is about 44M rows (the size of the real data)
+# and e.g. --days 8 gives about 1M rows and --vessels 23 --days 365 about 1B rows.
+
+KNOT_SECONDS = 600  # resolution of the slow processes
+CLOSING_OUTAGE_MINUTES = 10  # length of the last outage, it ends 5 minutes before the end of the data
+MAX_CONTINUOUS_RATING_KW = 25000
+PROPELLER_LAW_COEFFICIENT = 0.28  # torque = coefficient * rpm^2
+RPM_PER_KNOT = 6.3
+
+# Registration and signal of every sensor and weather qid: (quantity_name, source_name, unit, signal)
+SYNTHETIC_QUANTITIES = {
+    # Weather data from Provider MB and Provider S
+    "4::0::4::0_1::1::0::7::0_45::0::1::0_8": ('Vessel External Conditions Wave Significant Height', 'Provider MB', 'm', 'wave_height'),
+    "4::0::4::0_1::1::0::7::0_2::0::15::21_8": ('Vessel External Conditions Wind True Angle', 'Provider MB', 'degrees', 'wind_true_angle'),
+    "4::0::4::0_1::1::0::7::0_45::0::2::0_8": ('Vessel External Conditions Swell Significant Height', 'Provider MB', 'm', 'swell_height'),
+    "4::0::4::0_1::1::0::7::0_1::0::4::21_8": ('Vessel External Conditions Wind True Speed', 'Provider MB', 'knots', 'wind_true_speed'),
+    "4::0::4::0_1::1::0::7::0_56::0::3::0_8": ('Vessel External Conditions Eastward Sea Water Velocity', 'Provider MB', 'm/s', 'current_east'),
+    "4::0::4::0_1::1::0::7::0_56::0::4::0_8": ('Vessel External Conditions Northward Sea Water Velocity', 'Provider MB', 'm/s', 'current_north'),
+    "4::0::8::0_1::1::0::7::0_45::0::1::0_8": ('Vessel External Conditions Wave Significant Height', 'Provider S', 'm', 'wave_height'),
+    "4::0::8::0_1::1::0::7::0_2::0::18::21_8": ('Vessel External Conditions Wave True Angle', 'Provider S', 'degrees', 'wave_true_angle'),
+    "4::0::8::0_1::1::0::7::0_40::0::2::0_8": ('Vessel External Conditions Wave Period', 'Provider S', 's', 'wave_period'),
+    "4::0::8::0_1::1::0::7::0_4::0::12::0_8": ('Vessel External Conditions Sea Water Temperature', 'Provider S', 'degC', 'sea_temperature'),
+    "4::0::8::0_1::1::0::7::0_56::0::6::0_8": ('Vessel External Conditions Northward Wind Velocity', 'Provider S', 'm/s', 'wind_north'),
+    "4::0::8::0_1::1::0::7::0_56::0::5::0_8": ('Vessel External Conditions Eastward Wind Velocity', 'Provider S', 'm/s', 'wind_east'),
+    "4::0::8::0_1::1::0::7::0_56::0::3::0_8": ('Vessel External Conditions Eastward Sea Water Velocity', 'Provider S', 'm/s', 'current_east'),
+    "4::0::8::0_1::1::0::7::0_56::0::4::0_8": ('Vessel External Conditions Northward Sea Water Velocity', 'Provider S', 'm/s', 'current_north'),
+
+    # Sensor data
+    "3::0::1::0_1::1::0::2::0_11::0::2::0_8": ('Vessel Hull Aft Draft', 'Control Alarm Monitoring System', 'm', 'missing'),
+    "3::0::1::0_1::1::0::2::0_11::0::1::0_8": ('Vessel Hull Fore Draft', 'Control Alarm Monitoring System', 'm', 'missing'),
+    "3::0::1::0_1::2::0::8::0_1::0::6::0_8": ('Main Engine Rotational Speed', 'Control Alarm Monitoring System', 'rpm', 'engine_rpm'),
+    "3::0::1::0_1::1::0::2::0_11::0::3::0_8": ('Vessel Hull MidP Draft', 'Control Alarm Monitoring System', 'm', 'missing'),
+    "3::0::1::0_1::1::0::2::0_11::0::4::0_8": ('Vessel Hull MidS Draft', 'Control Alarm Monitoring System', 'm', 'missing'),
+    "2::0::1::0_1::1::0::7::0_1::0::4::22_8": ('Vessel External Conditions Wind Relative Speed', 'Instrument Anemometer', 'knots', 'wind_relative_speed'),
+    "2::0::1::0_1::1::0::7::0_2::0::15::22_8": ('Vessel External Conditions Wind Relative Angle', 'Instrument Anemometer', 'degrees', 'wind_relative_angle'),
+    "2::0::4::0_1::1::0::2::0_37::0::2::0_8": ('Vessel Hull Relative To Transducer Water Depth', 'Instrument Echosounder', 'm', 'water_depth'),
+    "2::0::6::1_1::1::0::2::0_1::0::1::0_8": ('Vessel Hull Over Ground Speed', 'Instrument GPS 1', 'knots', 'speed_over_ground'),
+    "2::0::5::0_1::1::0::2::0_6::0::1::0_8": ('Vessel Hull Heading Turn Rate', 'Instrument Gyrocompass', 'deg/min', 'turn_rate'),
+    "2::0::5::0_1::1::0::2::0_2::0::8::21_8": ('Vessel Hull Heading True Angle', 'Instrument Gyrocompass', 'degrees', 'heading'),
+    "2::0::25::0_1::2::0::3::0_1::0::6::0_8": ('Main Engine Turbocharger Rotational Speed', 'Instrument RPM Indicator', 'rpm', None),
+    "2::0::7::0_1::1::0::2::0_1::0::5::11_8": ('Vessel Hull Through Water Longitudinal Speed', 'Instrument Speedlog', 'knots', 'speed_through_water'),
+    "2::0::11::0_1::2::0::8::0_22::0::1::1_8": ('Main Engine Fuel Oil Inlet Mass Flow', 'Instrument Torquemeter', 'kg/hr', 'fuel_mass_flow'),
+    "2::0::11::0_1::1::0::3::0_14::0::1::0_8": ('Vessel Propeller Shaft Mechanical Power', 'Instrument Torquemeter', 'KW', 'shaft_power'),
+    "2::0::11::0_1::1::0::3::0_1::0::6::0_8": ('Vessel Propeller Shaft Rotational Speed', 'Instrument Torquemeter', 'rpm', 'propeller_rpm'),
+    "2::0::11::0_1::1::0::3::0_12::0::2::0_8": ('Vessel Propeller Shaft Torque', 'Instrument Torquemeter', 'N*m', 'torque'),
+    "2::0::11::0_1::1::0::3::0_17::0::1::0_8": ('Vessel Propeller Shaft Thrust Force', 'Instrument Torquemeter', 'KN', 'thrust'),
+    "2::0::11::0_1::1::0::3::0_15::0::1::0_8": ('Vessel Propeller Shaft Mechanical Energy', 'Instrument Torquemeter', 'KWh', 'shaft_energy'),
+    "2::0::11::0_1::1::0::3::0_12::0::1::0_8": ('Vessel Propeller Shaft Revolutions', 'Instrument Torquemeter', 'revs', 'shaft_revolutions'),
+    "1::0::25::0_1::2::0::8::0_20::0::1::0_8": ('Main Engine Fuel Load %', 'Transducer Fuel Load', '%', 'fuel_load'),
+    "1::0::14::0_1::2::0::8::0_3::0::3::0_8": ('Main Engine Scavenging Air Pressure', 'Transducer Pressure', 'bar', 'scavenging_air_pressure'),
+    "1::0::15::0_1::2::0::3::0_1::0::6::0_8": ('Main Engine Turbocharger Rotational Speed', 'Transducer RPM', 'rpm', 'turbocharger_rpm'),
+}
+
+# qids whose observations get sentinel values: qid -> function(rng, n) returning n sentinel values
+SENTINELS = {
+    "4::0::8::0_1::1::0::7::0_4::0::12::0_8": lambda rng, n: rng.uniform(SEA_TEMPERATURE_DROPOUT_MAX - 2, SEA_TEMPERATURE_DROPOUT_MAX, n),
+    "4::0::8::0_1::1::0::7::0_56::0::3::0_8": lambda rng, n: np.full(n, SEAWATER_VELOCITY_DROPOUT_VALUE),
+    "4::0::8::0_1::1::0::7::0_56::0::4::0_8": lambda rng, n: np.full(n, SEAWATER_VELOCITY_DROPOUT_VALUE),
+}
+
+# signals that are wrapped to [0, 360)
+ANGLE_SIGNALS = ['wind_true_angle', 'wave_true_angle', 'wind_relative_angle', 'heading']
+
+
+def registration():
+    """Returns the metrics registration of the synthetic qids (as in Metrics registration.xlsx, before the corrections of metadata.py)."""
+    qids = pd.Series(list(INTENDED_SAMPLING_INTERVALS_SECONDS))
+    qids = qids[qid_prefix(qids) != NOON_REPORT_QID_PREFIX]
+    missing = [qid for qid in qids if qid not in SYNTHETIC_QUANTITIES]
+    if missing:
+        raise KeyError(f'No synthetic signal defined for the qids {missing}')
+    return pd.DataFrame(
+        [(qid, name, source, unit) for qid, (name, source, unit, _) in SYNTHETIC_QUANTITIES.items()],
+        columns=['qid_mapping', 'quantity_name', 'source_name', 'unit'],
+    )
+
+
+def mean_reverting_walk(rng, n, mean, std, correlation):
+    """Returns an AR(1) process of length n with the given stationary mean and standard deviation."""
+    innovations = rng.normal(0, std * np.sqrt(1 - correlation ** 2), n)
+    values = np.empty(n)
+    value = rng.normal(0, std)
+    for i in range(n):
+        value = correlation * value + innovations[i]
+        values[i] = value
+    return mean + values
+
+
+def voyage_schedule(rng, n_knots, mean_leg_days=4.0, mean_port_days=1.0):
+    """
+    This function generates the target speed and course of every knot: sailing legs (10-15 knots, constant course) alternating with port stays.
+
+    Returns:
+        Tuple of (target speed in knots, course in degrees, leg number) per knot.
+    """
+    speed = np.empty(n_knots)
+    course = np.empty(n_knots)
+    leg = np.empty(n_knots, dtype=np.int64)
+    knots_per_day = 86400 // KNOT_SECONDS
+    position, leg_number, sailing = 0, 0, True
+    while position < n_knots:
+        mean_days = mean_leg_days if sailing else mean_port_days
+        length = max(1, int(rng.exponential(mean_days) * knots_per_day))
+        stop = min(n_knots, position + length)
+        speed[position:stop] = rng.uniform(10, 15) if sailing else 0.0
+        course[position:stop] = rng.uniform(0, 360)
+        leg[position:stop] = leg_number
+        position, leg_number, sailing = stop, leg_number + 1, not sailing
+
+    # ramp up and down over an hour instead of jumping between the legs
+    ramp = 3600 // KNOT_SECONDS
+    speed = np.convolve(np.pad(speed, ramp, mode='edge'), np.ones(2 * ramp + 1) / (2 * ramp + 1), mode='valid')
+    return speed, course, leg
+
+
+def slow_processes(rng, start, end):
+    """
+    This function generates the slow processes of a vessel on the knot grid from start to end (both as int64 ns).
+
+    Returns:
+        Dict of process name -> values per knot, incl. 'time' (int64 ns).
+    """
+    time = np.arange(start, end + KNOT_SECONDS * 10**9, KNOT_SECONDS * 10**9, dtype=np.int64)
+    n = len(time)
+    speed, course, leg = voyage_schedule(rng, n)
+    day_of_year = pd.to_datetime(time, utc=True).dayofyear.to_numpy()
+
+    # loaded and ballast legs alternate
+    loaded = leg % 4 < 2
+    fwd_draft = np.where(loaded, 11.5, 7.0) + rng.normal(0, 0.1, leg.max() + 1)[leg]
+    processes = {
+        'time': time,
+        'speed': np.maximum(0.0, speed + mean_reverting_walk(rng, n, 0, 0.2, 0.95) * (speed > 0)),
+        'course': course + mean_reverting_walk(rng, n, 0, 3.0, 0.95),
+        'fwd_draft': fwd_draft,
+        'aft_draft': fwd_draft + np.where(loaded, 0.3, 1.5),
+        'wind_east': mean_reverting_walk(rng, n, 0, 6.0, 0.99),
+        'wind_north': mean_reverting_walk(rng, n, 0, 6.0, 0.99),
+        'current_east': mean_reverting_walk(rng, n, 0, 0.3, 0.99),
+        'current_north': mean_reverting_walk(rng, n, 0, 0.3, 0.99),
+        'wave_height': np.maximum(0.1, mean_reverting_walk(rng, n, 1.5, 0.7, 0.99)),
+        'swell_height': np.maximum(0.1, mean_reverting_walk(rng, n, 1.0, 0.5, 0.995)),
+        'wave_period': np.maximum(2.0, mean_reverting_walk(rng, n, 7.0, 1.5, 0.99)),
+        'sea_temperature': 17 + 6 * np.sin(2 * np.pi * (day_of_year - 120) / 365) + mean_reverting_walk(rng, n, 0, 0.5, 0.995),
+        'air_pressure': mean_reverting_walk(rng, n, 1013, 8, 0.995),
+        'water_depth': np.maximum(5.0, mean_reverting_walk(rng, n, 80, 30, 0.99)),
+    }
+    # cumulative counters at the knots (integrated from the noise free rotational speed and power)
+    rpm, _, power = propulsion(processes['speed'], processes['wave_height'])
+    dt_minutes = KNOT_SECONDS / 60
+    processes['revolutions'] = 5e7 + np.concatenate([[0.0], np.cumsum((rpm[1:] + rpm[:-1]) / 2 * dt_minutes)])
+    processes['energy'] = 1e7 + np.concatenate([[0.0], np.cumsum((power[1:] + power[:-1]) / 2 * dt_minutes / 60)])
+    return processes
+
+
+def propulsion(speed, wave_height):
+    """Returns propeller rpm, torque and shaft power (propeller law, more torque in high waves) for the speed through water in knots."""
+    rpm = RPM_PER_KNOT * speed
+    torque = PROPELLER_LAW_COEFFICIENT * rpm ** 2 * (1 + 0.05 * (wave_height - 1.5))
+    power = torque * rpm * 2 * np.pi / 60
+    return rpm, torque, power
+
+
+def signals(processes, times, rng):
+    """
+    This function evaluates the signals at the given times (int64 ns) by interpolating the slow processes and adding sensor noise.
+
+    Returns:
+        Dict of signal name -> values (see SYNTHETIC_QUANTITIES).
+    """
+    at = {name: np.interp(times, processes['time'], values) for name, values in processes.items() if name != 'time'}
+    n = len(times)
+
+    def noise(std):
+        return rng.normal(0, std, n)
+
+    speed_through_water = np.maximum(0.0, at['speed'] + noise(0.03))
+    rpm, torque, power = propulsion(speed_through_water, at['wave_height'])
+    rpm = np.maximum(0.0, rpm + noise(0.1)) * (speed_through_water > 0)  # the propeller stands still in port
+    torque = torque * (1 + noise(0.002))
+    power = torque * rpm * 2 * np.pi / 60 * (1 + noise(0.002))
+    fuel_load = 100 * power / MAX_CONTINUOUS_RATING_KW
+
+    # current along the course in knots (m/s -> knots)
+    course_rad = np.deg2rad(at['course'])
+    current_along = (at['current_east'] * np.sin(course_rad) + at['current_north'] * np.cos(course_rad)) * 1.944
+    # apparent wind = true wind - vessel motion (m/s), the wind angles are the directions the wind comes from
+    vessel_east = speed_through_water / 1.944 * np.sin(course_rad)
+    vessel_north = speed_through_water / 1.944 * np.cos(course_rad)
+    apparent_east, apparent_north = at['wind_east'] - vessel_east, at['wind_north'] - vessel_north
+    wind_from = np.rad2deg(np.arctan2(-at['wind_east'], -at['wind_north']))
+    apparent_from = np.rad2deg(np.arctan2(-apparent_east, -apparent_north))
+
+    values = {
+        'missing': np.full(n, np.nan),
+        'speed_through_water': speed_through_water,
+        'speed_over_ground': np.maximum(0.0, speed_through_water + current_along + noise(0.05)),
+        'heading': at['course'] + noise(0.2),
+        'turn_rate': noise(1.0),
+        'propeller_rpm': rpm,
+        'engine_rpm': np.maximum(0.0, rpm + noise(0.05)) * (rpm > 0),
+        'torque': torque,
+        'shaft_power': power,
+        'thrust': -0.8 * torque * (1 + noise(0.003)),  # the torquemeter reports the thrust as negative (see pre_agg_clean.py)
+        'fuel_load': fuel_load + noise(0.2),
+        'fuel_mass_flow': 0.175 * power * (1 + noise(0.005)),
+        'scavenging_air_pressure': 0.3 + 0.03 * fuel_load + noise(0.01),
+        'turbocharger_rpm': 3000 + 120 * fuel_load + noise(10),
+        'shaft_revolutions': at['revolutions'],
+        'shaft_energy': at['energy'],
+        'wind_relative_speed': np.hypot(apparent_east, apparent_north) * 1.944 + noise(0.3),
+        'wind_relative_angle': apparent_from - at['course'] + noise(2.0),
+        'water_depth': at['water_depth'] + noise(0.5),
+        'wind_true_speed': np.hypot(at['wind_east'], at['wind_north']) * 1.944,
+        'wind_true_angle': wind_from,
+        'wave_true_angle': wind_from + noise(10.0),
+        'wind_east': at['wind_east'],
+        'wind_north': at['wind_north'],
+        'current_east': at['current_east'],
+        'current_north': at['current_north'],
+        'wave_height': at['wave_height'],
+        'swell_height': at['swell_height'],
+        'wave_period': at['wave_period'],
+        'sea_temperature': at['sea_temperature'],
+    }
+    for name in ANGLE_SIGNALS:
+        values[name] = np.mod(values[name], 360)
+    return values
+
+
+def outages(rng, start, end, gaps_per_day, mean_gap_minutes):
+    """
+    Returns the start and end times (int64 ns) of the sensor outages, sorted and with the ends as running maximum (for overlaps).
+    The last outage (CLOSING_OUTAGE_MINUTES) ends shortly before the end: synchronize.py keeps the segment after the last gap open,
+    so without it the data of a short duration without random outages would not give a single valid segment.
+    """
+    closing_start = max(start + 1, end - (CLOSING_OUTAGE_MINUTES + 5) * 60 * 10**9)
+    n_gaps = rng.poisson(gaps_per_day * (end - start) / (86400 * 10**9))
+    starts = np.sort(rng.integers(start, closing_start, n_gaps))
+    ends = np.minimum(starts + (rng.exponential(mean_gap_minutes, n_gaps) * 60 * 10**9).astype(np.int64), closing_start)
+    starts = np.append(starts, closing_start)
+    ends = np.append(ends, closing_start + CLOSING_OUTAGE_MINUTES * 60 * 10**9)
+    return starts, np.maximum.accumulate(ends)
+
+
+def in_outage(times, outage_starts, outage_ends):
+    """Returns a mask of the times that fall into an outage."""
+    index = np.searchsorted(outage_starts, times, side='right') - 1
+    return (index >= 0) & (times < outage_ends[np.maximum(index, 0)]) if len(outage_starts) else np.zeros(len(times), dtype=bool)
+
+
+def month_bounds(start, end):
+    """Returns the (start, end) timestamps of the calendar month chunks between start and end."""
+    edges = [start] + [t for t in pd.date_range(start.normalize(), end, freq='MS', tz='UTC') if start < t < end] + [end]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def write_observations(path, times, qid, values):
+    """Writes observations without header in the raw format (utc_timestamp as 2024-01-30T00:00:00.000Z, qid_mapping, value)."""
+    timestamps = np.char.add(np.datetime_as_string(times.view('datetime64[ns]'), unit='ms'), 'Z')
+    pd.DataFrame({'utc_timestamp': timestamps, 'qid_mapping': qid, 'value': values}).to_csv(path, header=False, index=False, float_format='%.10g')
+
+
+def noon_reports(processes, start, end, rng):
+    """
+    This function generates the daily noon reports (at 12:00 UTC) between start and end in the raw noon report format, and the last one
+    before start (the noon report values are joined backward, so the first windows need a report of the day before).
+
+    Returns:
+        DataFrame with Date (dd/mm/YYYY) and one column per noon report quantity (NOON_REPORT_QIDS).
+    """
+    times = pd.date_range(start.normalize() - pd.Timedelta(hours=12), end, freq='D', tz='UTC')
+    times = times[times > start - pd.Timedelta(days=1)]
+    at = {name: np.interp(times.as_unit('ns').asi8, processes['time'], values) for name, values in processes.items() if name != 'time'}
+    _, _, power = propulsion(at['speed'], at['wave_height'])
+    wind_speed = np.hypot(at['wind_east'], at['wind_north'])
+    columns = {
+        'Date': times.strftime('%d/%m/%Y'),
+        'Slip': [f'%:  {slip:.2f}' for slip in rng.normal(-3, 2, len(times))],
+        'Fwd Draft': at['fwd_draft'].round(2),
+        'Mid Draft': ((at['fwd_draft'] + at['aft_draft']) / 2).round(2),
+        'Aft Draft': at['aft_draft'].round(2),
+        'Displacement': (20000 + 5000 * (at['fwd_draft'] + at['aft_draft']) / 2).round(0),
+        'Air Temp': (at['sea_temperature'] + rng.normal(1, 2, len(times))).round(1),
+        'Bar Pressure': at['air_pressure'].round(0),
+        'Sea State': np.clip(np.round(at['wave_height'] * 1.5), 0, 9).astype(int),
+        'Wind Force': np.clip(np.round((wind_speed / 0.836) ** (2 / 3)), 0, 12).astype(int),
+        'Sea Temp': at['sea_temperature'].round(1),
+        'Sea Direction': np.mod(np.rad2deg(np.arctan2(-at['wind_east'], -at['wind_north'])), 360).round(0),
+        'Wind Direction': np.mod(np.rad2deg(np.arctan2(-at['wind_east'], -at['wind_north'])) + rng.normal(0, 10, len(times)), 360).round(0),
+        'Consumption for Propulsion': (0.175 * power * 24 / 1000).round(2),
+        'Fuel': 'VLSFO',
+    }
+    return pd.DataFrame({name: columns[name] for name in ['Date'] + list(NOON_REPORT_QIDS)})
+
+
+def copy_cleaning_scripts(root):
+    """Copies the pipeline scripts to <root>/cleaning-scripts, so the pipeline can be run on the synthetic data."""
+    target = os.path.join(root, 'cleaning-scripts')
+    shutil.copytree(script_dir, target, ignore=shutil.ignore_patterns('__pycache__', '*.ipynb'), dirs_exist_ok=True)
+    logger.info(f'Copied the cleaning scripts to {target}')
+
+
+def generate_vessel(root, start, days, seed, gaps_per_day=0.5, mean_gap_minutes=30.0, spike_rate=1e-3, duplicate_rate=1e-5, sentinel_rate=0.05):
+    """
+    This function writes the raw data and the metrics registration of one synthetic vessel.
+
+    Args:
+        root: Data directory of the vessel (gets raw/unzipped and metadata, like code/data).
+        start: First timestamp (tz-aware).
+        days: Duration in days.
+        seed: Seed of the random generator (the same seed gives the same data).
+        gaps_per_day: Mean number of outages of the 15 s sensors per day.
+        mean_gap_minutes: Mean length of an outage in minutes.
+        spike_rate: Probability that an observation of a spike filtered quantity is a spike.
+        duplicate_rate: Probability that an observation is written twice.
+        sentinel_rate: Probability that an observation of the sea temperature or sea water velocity (Provider S) is a dropout sentinel.
+
+    Returns:
+        Number of written sensor and weather observations.
+    """
+    rng = np.random.default_rng(seed)
+    end = start + pd.Timedelta(days=days)
+    start_ns, end_ns = start.value, end.value
+    raw_dir = os.path.join(root, 'raw', 'unzipped')
+    os.makedirs(os.path.join(root, 'metadata'), exist_ok=True)
+    registration().to_excel(os.path.join(root, 'metadata', 'Metrics registration.xlsx'), sheet_name='Sheet1', index=False)
+
+    processes = slow_processes(rng, start_ns, end_ns)
+    outage_starts, outage_ends = outages(rng, start_ns, end_ns, gaps_per_day, mean_gap_minutes)
+    spike_names = set(SENSOR_SPIKE_THRESHOLDS)
+    qids = pd.Series(list(SYNTHETIC_QUANTITIES))
+    weather_qids = set(qids[qid_prefix(qids) == WEATHER_QID_PREFIX])
+
+    n_rows = 0
+    for chunk_start, chunk_end in month_bounds(start, end):
+        month_dir = os.path.join(raw_dir, str(chunk_start.month))
+        os.makedirs(month_dir, exist_ok=True)
+        evaluated = {}  # signals per sampling interval
+        for qid, (name, _, _, signal) in SYNTHETIC_QUANTITIES.items():
+            if signal is None:
+                continue
+            interval = INTENDED_SAMPLING_INTERVALS_SECONDS[qid] * 10**9
+            if interval not in evaluated:
+                first = start_ns + -(-(chunk_start.value - start_ns) // interval) * interval
+                times = np.arange(first, chunk_end.value, interval, dtype=np.int64)
+                evaluated[interval] = (times, signals(processes, times, rng))
+            times, values = evaluated[interval][0], evaluated[interval][1][signal].copy()
+
+            keep = np.ones(len(times), dtype=bool)
+            if qid not in weather_qids:
+                keep = ~in_outage(times, outage_starts, outage_ends)
+            if name in spike_names:
+                spikes = rng.random(len(times)) < spike_rate
+                values[spikes] *= 1 + rng.choice([-1, 1], spikes.sum()) * rng.uniform(0.2, 0.5, spikes.sum())
+            if qid in SENTINELS:
+                sentinels = rng.random(len(times)) < sentinel_rate
+                values[sentinels] = SENTINELS[qid](rng, sentinels.sum())
+            rows = np.flatnonzero(keep)
+            rows = np.sort(np.concatenate([rows, rows[rng.random(len(rows)) < duplicate_rate]]), kind='stable')
+
+            path = os.path.join(month_dir, f'{chunk_start.year}_{qid.replace(":", "_")}.csv')
+            write_observations(path, times[rows], qid, values[rows])
+            n_rows += len(rows)
+        logger.info(f'Wrote {chunk_start:%Y-%m} of {root} ({n_rows} observations so far)')
+
+    noon_dir = os.path.join(raw_dir, 'Noon Reports')
+    os.makedirs(noon_dir, exist_ok=True)
+    reports = noon_reports(processes, start, end, rng)
+    years = pd.to_datetime(reports['Date'], format='%d/%m/%Y').dt.year
+    for year, year_reports in reports.groupby(years):
+        year_reports.to_csv(os.path.join(noon_dir, f'noon_reports_{year}.csv'), index=False)
+    logger.info(f'Wrote {len(reports)} noon reports and {n_rows} observations to {root}')
+    return n_rows
+
+
+def _generate_vessel(args):
+    root, kwargs = args
+    return generate_vessel(root, **kwargs)
+
+
+def generate(output_dir=default_output_dir, start='2024-01-01', days=30.0, n_vessels=1, seed=0, overwrite=False, with_scripts=False, **rates):
+    """
+    This function writes synthetic raw data of one or more vessels (see the description at the top of the file).
+
+    Args:
+        output_dir: Output directory (the data root of the vessel for one vessel, otherwise one vessel_<n> root per vessel).
+        start: First timestamp (UTC).
+        days: Duration per vessel in days.
+        n_vessels: Number of vessels (generated in parallel).
+        seed: Seed of the first vessel (vessel n uses seed + n).
+        overwrite: Replace existing raw data in the vessel roots, otherwise existing raw data raises an error.
+        with_scripts: Also copy the cleaning scripts into every vessel root.
+        **rates: Defect rates passed on to generate_vessel (gaps_per_day, mean_gap_minutes, spike_rate, duplicate_rate, sentinel_rate).
+
+    Returns:
+        Dict of vessel root -> number of written observations.
+    """
+    start = pd.Timestamp(start, tz='UTC') if pd.Timestamp(start).tzinfo is None else pd.Timestamp(start).tz_convert('UTC')
+    roots = [output_dir] if n_vessels == 1 else [os.path.join(output_dir, f'vessel_{n}') for n in range(n_vessels)]
+    for root in roots:
+        raw_dir = os.path.join(root, 'raw')
+        if os.path.exists(raw_dir):
+            if not overwrite:
+                raise FileExistsError(f'{raw_dir} already exists, use overwrite to replace it')
+            shutil.rmtree(raw_dir)
+        if with_scripts:
+            copy_cleaning_scripts(root)
+
+    logger.info(f'Generating {days} days of synthetic data for {n_vessels} vessel(s) from {start} in {output_dir}')
+    args = [(root, dict(start=start, days=days, seed=seed + n, **rates)) for n, root in enumerate(roots)]
+    if n_vessels > 1:
+        with Pool(max(1, min(cpu_count() - 1, n_vessels))) as pool:
+            rows = pool.map(_generate_vessel, args)
+    else:
+        rows = [_generate_vessel(args[0])]
+    logger.info(f'Generated {sum(rows)} observations in total')
+    return dict(zip(roots, rows))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes synthetic vessel data in the raw/unzipped layout the pipeline reads (about 120k observations per vessel-day).')
+    parser.add_argument('--output-dir', default=default_output_dir, help='output directory (default: code/data/synthetic)')
+    parser.add_argument('--start', default='2024-01-01', help='first timestamp (UTC)')
+    parser.add_argument('--days', type=float, default=30.0, help='duration per vessel in days')
+    parser.add_argument('--vessels', type=int, default=1, help='number of vessels, each is written to its own vessel_<n> directory')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--gaps-per-day', type=float, default=0.5, help='mean number of sensor outages per day')
+    parser.add_argument('--mean-gap-minutes', type=float, default=30.0, help='mean length of a sensor outage in minutes')
+    parser.add_argument('--spike-rate', type=float, default=1e-3, help='share of spikes in the spike filtered quantities')
+    parser.add_argument('--duplicate-rate', type=float, default=1e-5, help='share of duplicated observations')
+    parser.add_argument('--sentinel-rate', type=float, default=0.05, help='share of dropout sentinels in sea temperature and sea water velocity (Provider S)')
+    parser.add_argument('--overwrite', action='store_true', help='replace existing raw data in the output directory')
+    parser.add_argument('--with-scripts', action='store_true', help='copy the cleaning scripts next to the data, so the pipeline can be run on it')
+    args = parser.parse_args()
+
+    generate(args.output_dir, start=args.start, days=args.days, n_vessels=args.vessels, seed=args.seed, overwrite=args.overwrite,
+             with_scripts=args.with_scripts, gaps_per_day=args.gaps_per_day, mean_gap_minutes=args.mean_gap_minutes,
+             spike_rate=args.spike_rate, duplicate_rate=args.duplicate_rate, sentinel_rate=args.sentinel_rate)
@@ -0,0 +1,126 @@
+import os
+import json
+import hashlib
+import numpy as np
+from loguru import logger
+from long_table import qid_codes
+from merge_ingest import NAT_INT64
+
+# Manifest of the raw files that were ingested into the long table store, used for incremental appends.
+# The manifest is a json file in the store directory (files starting with '_' are ignored by the parquet dataset):
+#
+#   {
+#     "batches": 2,                                   number of ingest runs since the last full rebuild
+#     "files": {"1/file.csv": {"size": ..., "mtime_ns": ..., "sha256": ..., "rows": ...}, ...},
+#     "max_timestamp": ...,                           newest ingested utc_timestamp (int64 ns)
+#     "last_timestamps": {"<qid>": ..., ...}          newest ingested utc_timestamp per qid (int64 ns), for time_delta_sec
+#   }
+
+SENSOR_MANIFEST_NAME = '_manifest_sensors.json'
+NOON_REPORT_MANIFEST_NAME = '_manifest_noon_reports.json'
+
+
+def file_sha256(file_path, block_size=1 << 20):
+    """Returns the sha256 hex digest of a file, read in blocks."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_fingerprint(file_path, known=None):
+    """
+    Returns size, modification time and sha256 hash of a file.
+    The hash of a known manifest entry is reused if size and modification time did not change.
+    """
+    stat = os.stat(file_path)
+    if known is not None and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+        return dict(known)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': file_sha256(file_path)}
+
+
+def load_manifest(manifest_path):
+    """Loads the ingest manifest. Returns None if there is none yet."""
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, manifest_path):
+    """Writes the ingest manifest atomically (a crashed run leaves the previous manifest in place)."""
+    tmp_path = f'{manifest_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+    logger.info(f'Saved ingest manifest with {len(manifest["files"])} file(s) to {manifest_path}')
+
+
+def empty_manifest():
+    """Returns the manifest of an empty store."""
+    return {'batches': 0, 'files': {}, 'max_timestamp': None, 'last_timestamps': {}}
+
+
+def plan_ingest(file_paths, root_dir, manifest):
+    """
+    This function compares the raw files with the manifest to find out which files have to be ingested.
+
+    Args:
+        file_paths: Paths of all raw files that should be in the store.
+        root_dir: Directory the manifest keys are relative to.
+        manifest: Loaded manifest (or None).
+
+    Returns:
+        Tuple of (fingerprints of all files keyed by relative path, relative paths of new files,
+        relative paths of files that were changed or removed since they were ingested).
+    """
+    known_files = manifest['files'] if manifest is not None else {}
+    fingerprints = {}
+    new_files, changed_files = [], []
+    for file_path in file_paths:
+        key = os.path.relpath(file_path, root_dir)
+        known = known_files.get(key)
+        fingerprints[key] = file_fingerprint(file_path, known)
+        if known is None:
+            new_files.append(key)
+        elif fingerprints[key]['sha256'] != known['sha256']:
+            changed_files.append(key)
+    changed_files.extend(key for key in known_files if key not in fingerprints)
+    return fingerprints, new_files, changed_files
+
+
+def last_timestamps_array(manifest, lookup):
+    """Returns the last ingested timestamp per qid code of the lookup table (NAT_INT64 for qids that were not ingested yet)."""
+    last_timestamps = np.full(len(lookup), NAT_INT64, dtype=np.int64)
+    if manifest is None or not manifest['last_timestamps']:
+        return last_timestamps
+    qids = list(manifest['last_timestamps'].keys())
+    codes = qid_codes(qids, lookup)
+    known = codes >= 0
+    last_timestamps[codes[known]] = np.array(list(manifest['last_timestamps'].values()), dtype=np.int64)[known]
+    return last_timestamps
+
+
+def update_manifest(manifest, fingerprints, ingested_files, rows_per_file, last_timestamps, lookup):
+    """
+    Returns the manifest after an ingest run.
+
+    Args:
+        manifest: Manifest before the run (empty_manifest() for a full rebuild).
+        fingerprints: Fingerprints of all raw files keyed by relative path (see plan_ingest).
+        ingested_files: Relative paths of the files ingested in this run.
+        rows_per_file: Number of ingested rows per relative path.
+        last_timestamps: Last timestamp per qid code after the run (see merge_ingest.time_deltas).
+        lookup: qid lookup table the codes refer to.
+    """
+    files = dict(manifest['files'])
+    for key in ingested_files:
+        files[key] = {**fingerprints[key], 'rows': int(rows_per_file[key])}
+    seen = np.flatnonzero(last_timestamps != NAT_INT64)
+    return {
+        'batches': manifest['batches'] + 1,
+        'files': files,
+        'max_timestamp': int(last_timestamps[seen].max()) if len(seen) else manifest['max_timestamp'],
+        'last_timestamps': {str(lookup['qid_mapping'].iloc[code]): int(last_timestamps[code]) for code in seen},
+    }
@@ -0,0 +1,190 @@
+import numpy as np
+import pandas as pd
+from loguru import logger
+from appended_store import qid_prefix, read_long_table, timestamps_to_int64
+from config import NOON_REPORT_QIDS, NOON_REPORT_UNITS, FULL_PRECISION_QUANTITIES
+
+# Compact in-memory schema of the long observation table that every stage loading the appended data uses:
+#
+#   utc_timestamp   datetime64[ns, UTC]  (int64 nanoseconds under the hood, no per-row Python objects)
+#   qid_mapping     category             (codes index into the qid lookup table)
+#   quantity_name   category
+#   source_name     category
+#   unit            category
+#   value           float32              (float64 if the table holds exact values of full precision qids, see value_dtype)
+#   time_delta_sec  float32
+#
+# The name columns are derived from the qid codes via the lookup table, so they never hold per-row strings.
+# The value dtype is decided per qid: qids of FULL_PRECISION_QUANTITIES (cumulative counters) keep float64 values, all other qids float32.
+# The store keeps every value as float32 and the exact values of the full precision qids in an extra column (see appended_store.py),
+# so a table without full precision qids, or read without their exact values (full_precision=False), has float32 values.
+
+LOOKUP_COLUMNS = ['qid_mapping', 'quantity_name', 'source_name', 'unit']
+NUMERIC_TOKEN = r'[-+]?\d*\.?\d+(?:[eE][-+]?\d+)?'
+NAME_COLUMNS = ['quantity_name', 'source_name', 'unit']
+
+
+def build_qid_lookup(sensor_dict_df, noon_report_qids=NOON_REPORT_QIDS, noon_report_units=NOON_REPORT_UNITS):
+    """
+    Builds the qid lookup table (one row per qid, the row position is the qid code) from the metrics registration and the noon report config.
+
+    Args:
+        sensor_dict_df: DataFrame with the metrics registration (qid_mapping, quantity_name, source_name, unit).
+        noon_report_qids: Mapping of noon report quantity names to their dummy qids.
+        noon_report_units: Mapping of noon report quantity names to their units.
+
+    Returns:
+        DataFrame with the columns qid_mapping, quantity_name, source_name and unit.
+    """
+    sensors = sensor_dict_df[LOOKUP_COLUMNS].drop_duplicates(subset='qid_mapping')
+    noon = pd.DataFrame({
+        'qid_mapping': list(noon_report_qids.values()),
+        'quantity_name': list(noon_report_qids.keys()),
+        'source_name': 'Noon Report',
+        'unit': [noon_report_units.get(name) for name in noon_report_qids.keys()],
+    })
+    noon = noon[~noon['qid_mapping'].isin(sensors['qid_mapping'])]
+    lookup = pd.concat([sensors, noon], ignore_index=True)
+    return lookup.astype(object)
+
+
+def load_long_table(store_dir, lookup, qid_prefixes=None, exclude_qid_prefixes=None, qids=None, start=None, end=None, time_ordered=False, full_precision=True):
+    """
+    Reads the long table from the columnar store (see appended_store.read_long_table for the predicates, time_ordered and full_precision)
+    and converts it to the compact schema. lookup is the qid lookup table, usually the metadata catalog (see metadata.load_catalog),
+    so the qid codes are catalog positions.
+    """
+    df = read_long_table(store_dir, qid_prefixes=qid_prefixes, exclude_qid_prefixes=exclude_qid_prefixes, qids=qids, start=start, end=end,
+                         time_ordered=time_ordered, full_precision=full_precision)
+    compact_df, _ = to_compact_long(df, lookup, dtype=None if full_precision else np.float32)
+    return compact_df
+
+
+def filter_qid_prefixes(df, qid_prefixes=None, exclude_qid_prefixes=None):
+    """Selects the rows of an in-memory long table by qid prefix, like the partition filters of read_long_table."""
+    categories = df['qid_mapping'].cat.categories
+    keep = np.ones(len(categories), dtype=bool)
+    prefixes = qid_prefix(categories).to_numpy()
+    if qid_prefixes is not None:
+        keep &= np.isin(prefixes, [str(p) for p in qid_prefixes])
+    if exclude_qid_prefixes is not None:
+        keep &= ~np.isin(prefixes, [str(p) for p in exclude_qid_prefixes])
+    codes = df['qid_mapping'].cat.codes.to_numpy()
+    return df[(codes >= 0) & keep[np.maximum(codes, 0)]].reset_index(drop=True)
+
+
+def extend_qid_lookup(lookup, qids):
+    """Appends qids that are not yet in the lookup table (with unknown names), so codes of existing qids stay unchanged."""
+    known = set(lookup['qid_mapping'])
+    unknown = [qid for qid in pd.unique(pd.Series(qids, dtype=object).dropna()) if qid not in known]
+    if not unknown:
+        return lookup
+    logger.warning(f'{len(unknown)} qid(s) not found in the qid lookup table, adding them without names: {unknown}')
+    extension = pd.DataFrame({'qid_mapping': unknown}).reindex(columns=LOOKUP_COLUMNS)
+    return pd.concat([lookup, extension], ignore_index=True).astype(object)
+
+
+def qid_codes(qids, lookup):
+    """Returns the int16 lookup codes of the given qids (-1 for qids that are not in the lookup table)."""
+    categorical = pd.Categorical(qids, categories=lookup['qid_mapping'])
+    return categorical.codes.astype(np.int16)
+
+
+def full_precision_qids(lookup, full_precision_quantities=FULL_PRECISION_QUANTITIES):
+    """
+    Returns the qids whose values are kept as float64: the qids of the quantities in full_precision_quantities
+    (e.g. cumulative counters, where float32 rounding destroys the increments between observations).
+    lookup is a qid lookup table, or a compact long table (then only the full precision qids observed in it are returned).
+    """
+    return list(pd.unique(lookup.loc[lookup['quantity_name'].isin(full_precision_quantities), 'qid_mapping'].astype(object)))
+
+
+def value_dtype(qid_codes_array, lookup):
+    """Returns the value dtype of a long table with the given qid codes: float64 if it holds full precision qids, float32 otherwise."""
+    full_precision_codes = qid_codes(full_precision_qids(lookup), lookup)
+    return np.float64 if np.isin(qid_codes_array, full_precision_codes).any() else np.float32
+
+
+def to_compact_long(df, lookup, dtype=None):
+    """
+    Converts a long observation table to the compact schema.
+
+    Args:
+        df: Long table with utc_timestamp, qid_mapping, value and optionally time_delta_sec columns.
+            Any existing quantity_name/source_name/unit columns are replaced by the lookup values.
+        lookup: qid lookup table (see build_qid_lookup). qids missing from it are appended with unknown names.
+        dtype: Value dtype. Decided with value_dtype if None.
+
+    Returns:
+        Tuple of (compact DataFrame, possibly extended lookup table).
+    """
+    lookup = extend_qid_lookup(lookup, df['qid_mapping'].unique())
+    codes = qid_codes(df['qid_mapping'], lookup)
+    values = pd.to_numeric(df['value'], errors='coerce').to_numpy()
+    if values.dtype not in (np.float32, np.float64):
+        values = values.astype(np.float64)
+    time_delta_sec = df['time_delta_sec'].to_numpy(dtype=np.float32) if 'time_delta_sec' in df.columns else None
+    return compact_long_from_codes(utc_timestamps_ns(df['utc_timestamp']), codes, values, lookup, time_delta_sec, dtype), lookup
+
+
+def parse_numeric_values(values):
+    """
+    Extracts the numeric values of a column, vectorized. Numeric columns are converted to float (the values of the store are numeric already),
+    other values are converted to numbers and the first numeric token is extracted from the ones that are no number
+    (handles noon report strings like '%:  -3.85'). Values without a number become NaN.
+    """
+    values = pd.Series(values)
+    if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+        return values.astype(float)
+    numeric = pd.to_numeric(values, errors='coerce').astype(float)
+    unparsed = numeric.isna() & values.notna()
+    if unparsed.any():
+        extracted = values[unparsed].astype(str).str.extract(f'({NUMERIC_TOKEN})', expand=False)
+        numeric[unparsed] = pd.to_numeric(extracted, errors='coerce')
+    return numeric
+
+
+def utc_timestamps_ns(timestamps):
+    """Returns timestamps as int64 nanoseconds since epoch (UTC). Naive timestamps are interpreted as UTC."""
+    if timestamps.dt.tz is None:
+        timestamps = timestamps.dt.tz_localize('UTC')
+    return timestamps_to_int64(timestamps)
+
+
+def compact_long_from_codes(timestamps_ns, codes, values, lookup, time_delta_sec=None, dtype=None):
+    """
+    Builds a compact long table from plain arrays.
+
+    Args:
+        timestamps_ns: int64 nanoseconds since epoch (UTC).
+        codes: qid codes into the lookup table.
+        values: Observation values.
+        lookup: qid lookup table (see build_qid_lookup) that covers all codes.
+        time_delta_sec: Optional time deltas in seconds.
+        dtype: Value dtype. Decided with value_dtype if None.
+
+    Returns:
+        DataFrame in the compact schema.
+    """
+    compact = {
+        'utc_timestamp': pd.to_datetime(timestamps_ns, unit='ns', utc=True),
+        'qid_mapping': pd.Categorical.from_codes(codes, categories=lookup['qid_mapping']),
+    }
+    for col in NAME_COLUMNS:
+        compact[col] = _categorical_from_lookup(codes, lookup[col])
+    if dtype is None:
+        dtype = value_dtype(codes, lookup)
+    compact['value'] = values.astype(dtype, copy=False)
+    if time_delta_sec is not None:
+        compact['time_delta_sec'] = time_delta_sec.astype(np.float32, copy=False)
+
+    compact_df = pd.DataFrame(compact)
+    logger.info(f'Converted long table to compact schema: {len(compact_df)} rows, {compact_df.memory_usage(deep=True).sum() / 1e6:.1f} MB (value dtype: {compact_df["value"].dtype})')
+    return compact_df
+
+
+def _categorical_from_lookup(codes, lookup_column):
+    """Creates a categorical column of lookup values for the given qid codes without materializing per-row strings."""
+    value_codes, categories = pd.factorize(lookup_column.astype(object))
+    row_codes = np.where(codes >= 0, value_codes[np.maximum(codes, 0)], -1)
+    return pd.Categorical.from_codes(row_codes, categories=categories)
@@ -0,0 +1,121 @@
+import numpy as np
+
+# Streaming k-way merge of locally sorted observation files.
+#
+# Every source is a dict of equally long numpy arrays that is sorted by 'utc_timestamp' (int64 nanoseconds).
+# The merge advances through the sources in blocks: the watermark is the smallest timestamp that a source has not
+# looked beyond yet, and everything strictly older than the watermark can be emitted, because no source can still
+# produce an older row. Only the emitted rows are sorted, so the full table is never sorted in one go.
+# Ties are ordered by source and by position within the source, i.e. the output equals a stable sort of the
+# concatenated sources.
+
+NAT_INT64 = np.iinfo(np.int64).min
+
+
+def sort_source(source):
+    """Sorts the arrays of a single source by timestamp (stable). Sources that are already sorted are returned unchanged."""
+    ts = source['utc_timestamp']
+    if len(ts) < 2 or (ts[1:] >= ts[:-1]).all():
+        return source
+    order = np.argsort(ts, kind='stable')
+    return {key: values[order] for key, values in source.items()}
+
+
+def kway_merge(sources, block_rows, chunk_rows):
+    """
+    This function merges timestamp-sorted sources into timestamp-sorted chunks.
+
+    Args:
+        sources: List of dicts of numpy arrays (same keys for every source), each sorted by 'utc_timestamp'.
+        block_rows: Number of rows a source is looked ahead per merge round.
+        chunk_rows: Minimum number of rows per yielded chunk (the last chunk may be smaller).
+
+    Yields:
+        Dicts of numpy arrays with the same keys as the sources, sorted by 'utc_timestamp'.
+    """
+    sources = [source for source in sources if len(source['utc_timestamp']) > 0]
+    lengths = np.array([len(source['utc_timestamp']) for source in sources], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+    cursors = np.zeros(len(sources), dtype=np.int64)
+    lookahead = np.full(len(sources), block_rows, dtype=np.int64)
+
+    pending = []
+    pending_rows = 0
+    while (cursors < lengths).any():
+        # the watermark is the last looked-ahead timestamp of every source that still has rows beyond its lookahead
+        bounds = np.full(len(sources), np.iinfo(np.int64).max, dtype=np.int64)
+        for i, source in enumerate(sources):
+            end = cursors[i] + lookahead[i]
+            if end < lengths[i]:
+                bounds[i] = source['utc_timestamp'][end - 1]
+        watermark = bounds.min()
+
+        parts, ranks = [], []
+        for i, source in enumerate(sources):
+            if cursors[i] >= lengths[i]:
+                continue
+            ts = source['utc_timestamp']
+            if watermark == np.iinfo(np.int64).max:
+                stop = lengths[i]
+            else:
+                stop = cursors[i] + np.searchsorted(ts[cursors[i]:lengths[i]], watermark, side='left')
+            if stop > cursors[i]:
+                parts.append({key: values[cursors[i]:stop] for key, values in source.items()})
+                ranks.append(np.arange(offsets[i] + cursors[i], offsets[i] + stop, dtype=np.int64))
+                cursors[i] = stop
+
+        if not parts:
+            # every looked-ahead row shares the watermark timestamp, so look further ahead in the bounding sources
+            lookahead[bounds == watermark] *= 2
+            continue
+        lookahead[:] = block_rows
+
+        merged = {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
+        order = np.lexsort((np.concatenate(ranks), merged['utc_timestamp']))
+        pending.append({key: values[order] for key, values in merged.items()})
+        pending_rows += len(order)
+
+        if pending_rows >= chunk_rows:
+            yield {key: np.concatenate([part[key] for part in pending]) for key in pending[0]}
+            pending, pending_rows = [], 0
+
+    if pending:
+        yield {key: np.concatenate([part[key] for part in pending]) for key in pending[0]}
+
+
+def time_deltas(timestamps, codes, last_timestamps):
+    """
+    This function computes the time since the previous observation of the same qid for a timestamp-sorted chunk.
+    The last timestamp per qid is carried between chunks in last_timestamps, which is updated in place.
+
+    Args:
+        timestamps: int64 nanosecond timestamps of the chunk, sorted.
+        codes: Integer qid codes of the chunk (indices into last_timestamps, -1 for unknown qids).
+        last_timestamps: int64 array with the last seen timestamp per qid code (NAT_INT64 if the qid was not seen yet).
+
+    Returns:
+        float32 array of time deltas in seconds (NaN for the first observation of a qid).
+    """
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    sorted_ts = timestamps[order]
+
+    previous = np.empty_like(sorted_ts)
+    previous[1:] = sorted_ts[:-1]
+    group_start = np.ones(len(sorted_codes), dtype=bool)
+    group_start[1:] = sorted_codes[1:] != sorted_codes[:-1]
+    previous[group_start] = last_timestamps[np.maximum(sorted_codes[group_start], 0)]
+    previous[sorted_codes < 0] = NAT_INT64  # rows without a known qid have no previous observation
+
+    deltas = ((sorted_ts - previous) / 1e9).astype(np.float32)
+    deltas[previous == NAT_INT64] = np.nan
+
+    group_end = np.ones(len(sorted_codes), dtype=bool)
+    group_end[:-1] = group_start[1:]
+    group_end &= sorted_codes >= 0
+    last_timestamps[sorted_codes[group_end]] = sorted_ts[group_end]
+
+    result = np.empty_like(deltas)
+    result[order] = deltas
+    return result
+
@@ -1,13 +1,39 @@
 import pandas as pd
+import numpy as np
 import os
+import json
 from loguru import logger
+from config import NOON_REPORT_QIDS, NOON_REPORT_UNITS
+from appended_store import WEATHER_QID_PREFIX, qid_prefix
+from ingest_manifest import file_fingerprint
+from long_table import build_qid_lookup
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(script_dir)
 input_path = os.path.join(parent_dir, 'metadata', 'Metrics registration.xlsx')
 output_path = os.path.join(parent_dir, 'metadata', 'Metrics registration.csv')
+catalog_path = os.path.join(parent_dir, 'metadata', 'catalog.json')
 sheet_name = 'Sheet1'
 
+# Compiled metadata catalog shared by all stages.
+#
+# The catalog is built once from the metrics registration (with the corrections below) and the noon report config and saved as json:
+#
+#   {
+#     "source": {"registration": {"size": ..., "mtime_ns": ..., "sha256": ...}, "noon_report_qids": {...}, "noon_report_units": {...}, "version": 1},
+#     "catalog": {"qid_mapping": [...], "quantity_name": [...], ...}      one entry per qid, the position is the qid code
+#   }
+#
+# The rows are the qid lookup table of the long table (see long_table.build_qid_lookup), so the position of a qid in the catalog is its
+# code in the compact long table, and the names every stage derives from a qid are precomputed per qid:
+#   column_name            name of the qid column in the synchronized/filtered data (weather quantities get the provider in brackets)
+#   column_name_with_unit  column_name with the unit in brackets (as in the aggregated data)
+#   var_full               "quantity_name (source_name)" (the weather and noon report variable names joined by aggregate.py)
+# Stages look names up per qid (or per category of a categorical qid column) instead of building strings row by row.
+# The xlsx is only parsed again when it (or the noon report config) changes.
+
+CATALOG_VERSION = 1
+
 def correct_vessel_propeller_shaft_revolutions_unit(df):
     # set the value for "unit" of Vessel Propeller Shaft Revolutions to "revs"
     df.loc[df['quantity_name'] == 'Vessel Propeller Shaft Revolutions', 'unit'] = 'revs'
@@ -24,16 +50,136 @@ def remove_redundant_turbocharger_qid(df):
     logger.info(f'Removed redundant qid for main engine turbocharger rotational speed. Shape: {initial_shape} -> {df.shape}')
     return df
 
-def convert_xlsx_to_csv(input_path, output_path):
+def metadata(input_path=input_path):
+    """
+    This function reads the metrics registration from the Excel file and applies the corrections.
+
+    Args:
+        input_path: Path to the metrics registration Excel file.
+
+    Returns:
+        DataFrame with the corrected metrics registration.
+    """
     # Read the Excel file from the specified sheet
     df = pd.read_excel(input_path, sheet_name=sheet_name)
 
     # Correct the unit for Vessel Propeller Shaft Revolutions
     df = correct_vessel_propeller_shaft_revolutions_unit(df)
     df = remove_redundant_turbocharger_qid(df)
+    return df
 
+def convert_xlsx_to_csv(input_path, output_path):
     # Convert to CSV
-    df.to_csv(output_path, index=False)
+    metadata(input_path).to_csv(output_path, index=False)
+
+def build_catalog(registration_df):
+    """
+    This function compiles the catalog (one row per qid, incl. the noon report qids) from the corrected metrics registration.
+
+    Args:
+        registration_df: Corrected metrics registration (see metadata).
+
+    Returns:
+        DataFrame with the lookup columns (qid_mapping, quantity_name, source_name, unit) and the derived name columns.
+    """
+    catalog = build_qid_lookup(registration_df)
+    names = catalog['quantity_name'].astype(str)
+    sources = catalog['source_name'].astype(str)
+
+    # weather quantities are measured by several providers, so their columns get the provider in brackets
+    is_weather = (qid_prefix(catalog['qid_mapping']) == WEATHER_QID_PREFIX).to_numpy()
+    catalog['column_name'] = (names + ' (' + sources + ')').where(is_weather, names)
+
+    # units in brackets behind the column names that are quantity names (the last registration entry of a name wins)
+    unit_by_name = dict(zip(registration_df['quantity_name'], registration_df['unit']))
+    catalog['column_name_with_unit'] = [
+        f'{column} ({unit_by_name[column]})' if column in unit_by_name and pd.notna(unit_by_name[column]) else column
+        for column in catalog['column_name']
+    ]
+
+    catalog['var_full'] = names.str.strip() + ' (' + sources.str.strip() + ')'
+    return catalog.astype(object)
+
+def catalog_source(input_path=input_path, known=None):
+    """Returns what the catalog is built from: the fingerprint of the registration file and the noon report config."""
+    return {
+        'registration': file_fingerprint(input_path, known),
+        'noon_report_qids': NOON_REPORT_QIDS,
+        'noon_report_units': NOON_REPORT_UNITS,
+        'version': CATALOG_VERSION,
+    }
+
+def _same_source(saved_source, source):
+    """Compares two catalog sources by the content hash of the registration file (not its modification time) and the config."""
+    def content(s):
+        return {**s, 'registration': s['registration']['sha256']}
+    return content(saved_source) == content(source)
+
+def save_catalog(catalog, source, catalog_path=catalog_path):
+    """Saves the catalog and its source to json (missing values as null)."""
+    columns = {col: [None if pd.isna(value) else value for value in catalog[col]] for col in catalog.columns}
+    with open(catalog_path, 'w') as f:
+        json.dump({'source': source, 'catalog': columns}, f, indent=1)
+    logger.info(f'Saved metadata catalog with {len(catalog)} qids to {catalog_path}')
+
+def load_catalog(catalog_path=catalog_path, input_path=input_path, output_path=output_path):
+    """
+    This function returns the metadata catalog (pipeline stage). The saved catalog is used if it was built from the current
+    registration file and config, otherwise the xlsx is parsed again and the catalog (and the registration csv) are rewritten.
+
+    Args:
+        catalog_path: Path of the catalog json.
+        input_path: Path to the metrics registration Excel file.
+        output_path: Path of the corrected registration csv (written together with the catalog).
+
+    Returns:
+        The catalog DataFrame (see build_catalog).
+    """
+    saved = None
+    if os.path.isfile(catalog_path):
+        with open(catalog_path) as f:
+            saved = json.load(f)
+
+    if not os.path.isfile(input_path):
+        if saved is None:
+            raise FileNotFoundError(f'Neither the metrics registration {input_path} nor a metadata catalog {catalog_path} exists')
+        logger.warning(f'Metrics registration {input_path} not found, using the saved metadata catalog')
+        return pd.DataFrame(saved['catalog']).astype(object)
+
+    source = catalog_source(input_path, known=saved['source']['registration'] if saved is not None else None)
+    if saved is not None and _same_source(saved['source'], source) and os.path.isfile(output_path):
+        logger.info(f'Metadata catalog is up to date, loaded {len(saved["catalog"]["qid_mapping"])} qids from {catalog_path}')
+        return pd.DataFrame(saved['catalog']).astype(object)
+
+    logger.info(f'Metadata catalog is missing or outdated, building it from {input_path}')
+    registration_df = metadata(input_path)
+    registration_df.to_csv(output_path, index=False)
+    catalog = build_catalog(registration_df)
+    save_catalog(catalog, source, catalog_path)
+    return catalog
+
+def qid_attribute(qids, catalog, column):
+    """
+    This function looks up a catalog column for every row of a qid column, without per-row strings: the catalog is looked up once per
+    distinct qid (the categories of a categorical column) and the rows are joined on the category codes.
+
+    Args:
+        qids: qid column (categorical, e.g. qid_mapping of the compact long table, or any other dtype).
+        catalog: Metadata catalog (see load_catalog).
+        column: Catalog column to look up (e.g. 'var_full'). Unknown qids get missing values.
+
+    Returns:
+        Categorical Series with the catalog values, aligned with qids.
+    """
+    qids = pd.Series(qids)
+    if not isinstance(qids.dtype, pd.CategoricalDtype):
+        qids = qids.astype('category')
+    category_values = qids.cat.categories.map(dict(zip(catalog['qid_mapping'], catalog[column]))).astype(object)
+    value_codes, categories = pd.factorize(category_values)
+    codes = qids.cat.codes.to_numpy()
+    row_codes = np.where(codes >= 0, value_codes[np.maximum(codes, 0)], -1) if len(value_codes) else np.full(len(codes), -1)
+    return pd.Series(pd.Categorical.from_codes(row_codes, categories=categories), index=qids.index)
 
 # Execute
-convert_xlsx_to_csv(input_path, output_path)
\ No newline at end of file
+if __name__ == '__main__':
+    load_catalog()
@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+
+# Compact storage of the quality flags of the cleaning stage (dropout, repeated value and spike flags).
+#
+# Instead of one int64 column per flag, every flag is one bit of a uint64 flag word. The flag words are ordinary columns of the
+# DataFrame ('_quality_flags_0', '_quality_flags_1', ...; 64 flags per word), so they follow every row filter and reordering
+# of the cleaning without extra bookkeeping, and the frame only grows by one column per 64 flags.
+# The registry is a dict of flag name to bit number (in the order the flags were created), passed along like the count dicts.
+# At the end of the cleaning the flags that are used later (e.g. the Imputed Spike flags summed by aggregate.py) are exported
+# as int columns with export_flags.
+
+FLAG_WORD_PREFIX = '_quality_flags_'
+FLAGS_PER_WORD = 64
+
+
+def _flag_word(bit):
+    """Returns the name of the flag word column and the bit within it."""
+    return f'{FLAG_WORD_PREFIX}{bit // FLAGS_PER_WORD}', np.uint64(bit % FLAGS_PER_WORD)
+
+
+def set_flags(df, quality_flags, flags):
+    """
+    This function stores flags in the flag words of df (in place) and registers the new ones. Every flag word is written once.
+
+    Args:
+        df: DataFrame of the cleaning stage.
+        quality_flags: Registry of flag name to bit number.
+        flags: Dict of flag name to boolean array or Series (aligned with the rows of df) that is True where the flag is set.
+    """
+    words = {}
+    for name, mask in flags.items():
+        if name not in quality_flags:
+            quality_flags[name] = len(quality_flags)
+        word, bit = _flag_word(quality_flags[name])
+        if word not in words:
+            words[word] = df[word].to_numpy(dtype=np.uint64, copy=True) if word in df.columns else np.zeros(len(df), dtype=np.uint64)
+        words[word] &= ~(np.uint64(1) << bit)
+        words[word] |= np.asarray(mask, dtype=bool).astype(np.uint64) << bit
+    for word, values in words.items():
+        df[word] = values
+
+
+def flag_mask(df, quality_flags, name):
+    """Returns the boolean array of a flag for the rows of df."""
+    word, bit = _flag_word(quality_flags[name])
+    return ((df[word].to_numpy(dtype=np.uint64) >> bit) & np.uint64(1)).astype(bool)
+
+
+def flag_counts(df, quality_flags, names=None):
+    """
+    This function counts the set flags of all (or the given) flags, one bit count pass per flag word.
+
+    Returns:
+        Dict of flag name to number of rows where the flag is set.
+    """
+    names = list(quality_flags) if names is None else list(names)
+    counts = {}
+    for word in sorted({_flag_word(quality_flags[name])[0] for name in names}):
+        words = df[word].to_numpy(dtype=np.uint64).astype('<u8')
+        bit_counts = np.unpackbits(words.view(np.uint8).reshape(-1, 8), axis=1, bitorder='little').sum(axis=0, dtype=np.int64)
+        for name in names:
+            name_word, bit = _flag_word(quality_flags[name])
+            if name_word == word:
+                counts[name] = bit_counts[int(bit)]
+    return {name: counts[name] for name in names}
+
+
+def export_flags(df, quality_flags, names):
+    """
+    This function adds the given flags as int columns (1 if set, 0 if not) and removes the flag words.
+
+    Args:
+        df: DataFrame of the cleaning stage.
+        quality_flags: Registry of flag name to bit number.
+        names: Flags to export (in this column order).
+
+    Returns:
+        DataFrame with the exported flag columns instead of the flag words.
+    """
+    flag_columns = {name: flag_mask(df, quality_flags, name).astype(int) for name in names}
+    df = df.drop(columns=[col for col in df.columns if col.startswith(FLAG_WORD_PREFIX)])
+    return pd.concat([df, pd.DataFrame(flag_columns, index=df.index)], axis=1)
@@ -0,0 +1,150 @@
+import numpy as np
+import pandas as pd
+
+# Segment aware rolling statistics (count, mean, std) for many columns in one pass.
+#
+# The rolling windows never cross a segment boundary, like df.groupby('seg_id')[col].rolling(window, min_periods).
+# Instead of running pandas rolling per segment and per column, the columns are stacked into one 2-D array with the segments
+# as contiguous row blocks and the cumulative sums of count, value and squared value are computed once for all columns.
+# The statistics of any window are then differences of the cumulative sums, so the expensive part does not depend on the
+# window size and is reused when the same data is evaluated with several window sizes (see rolling_statistics).
+#
+# The values are centered on their segment mean before summing, which keeps the cumulative sums small and the variance
+# (sum of squares - square of sums) accurate over long segments.
+# Like pandas, the mean and std are NaN if the window has fewer than min_periods valid values, and the std uses ddof=1.
+
+ROLLING_STATISTICS = ('count', 'mean', 'std')
+
+
+def segment_starts(seg_ids):
+    """
+    This function finds the contiguous segment blocks of a seg_id array.
+
+    Args:
+        seg_ids: seg_id per row, every segment has to be one contiguous block of rows.
+
+    Returns:
+        Tuple of (first row of every segment, first row of the segment of every row).
+    """
+    n_rows = len(seg_ids)
+    starts = np.flatnonzero(np.r_[True, seg_ids[1:] != seg_ids[:-1]]) if n_rows else np.array([], dtype=np.int64)
+    lengths = np.diff(np.r_[starts, n_rows])
+    return starts, np.repeat(starts, lengths)
+
+
+def segment_layout(seg_ids):
+    """
+    This function arranges the rows so that every segment is one contiguous block, like groupby puts all rows of a segment together.
+
+    Args:
+        seg_ids: seg_id per row.
+
+    Returns:
+        Tuple of (stable row order that sorts the segments or None if the segments are already contiguous blocks in ascending order,
+        first row of the segment of every row in that order).
+    """
+    order = None
+    if len(seg_ids) > 1 and np.any(seg_ids[1:] < seg_ids[:-1]):
+        order = np.argsort(seg_ids, kind='stable')
+        seg_ids = seg_ids[order]
+    return order, segment_starts(seg_ids)[1]
+
+
+def restore_order(result, order):
+    """Puts rows computed in the order of segment_layout back into the original row order."""
+    if order is None:
+        return result
+    unsorted = np.empty_like(result)
+    unsorted[order] = result
+    return unsorted
+
+
+def segment_prefix_sums(df, columns, segment_column='seg_id'):
+    """
+    This function computes the window independent part of the rolling statistics: the cumulative count, sum and sum of
+    squares of every column, restarted at every segment.
+
+    Args:
+        df: DataFrame with the columns and the segment column.
+        columns: Columns to compute the statistics of.
+        segment_column: Column with the segment ids.
+
+    Returns:
+        Dict with the cumulative sums, the segment start and mean of every row and a cache for the statistics per window (used by rolling_statistics).
+    """
+    columns = list(columns)
+    order, row_start = segment_layout(df[segment_column].to_numpy())
+    starts = np.unique(row_start)
+
+    values = df[columns].to_numpy(dtype=np.float64, na_value=np.nan)
+    if order is not None:
+        values = values[order]
+    valid = ~np.isnan(values)
+    values = np.where(valid, values, 0.0)
+
+    # center every segment on its mean
+    offset = np.zeros_like(values)
+    if len(starts):
+        segment_counts = np.add.reduceat(valid, starts, axis=0)
+        segment_means = np.add.reduceat(values, starts, axis=0) / np.maximum(segment_counts, 1)
+        offset = segment_means[np.searchsorted(starts, row_start)]
+        values = np.where(valid, values - offset, 0.0)
+
+    # cumulative sums with a leading row of zeros, so the sum of rows lo..hi-1 is cumsum[hi] - cumsum[lo]
+    def cumulative(array):
+        return np.concatenate([np.zeros((1, len(columns))), np.cumsum(array, axis=0)])
+
+    return {
+        'index': df.index,
+        'columns': columns,
+        'order': order,
+        'row_start': row_start,
+        'offset': offset,
+        'count': cumulative(valid.astype(np.float64)),
+        'sum': cumulative(values),
+        'sumsq': cumulative(values * values),
+        'cache': {},
+    }
+
+
+def rolling_statistics(prefix_sums, window, min_periods, statistics=ROLLING_STATISTICS):
+    """
+    This function computes rolling statistics of all columns from the segment prefix sums.
+    The result is cached per (window, min_periods), so the statistics are only computed once per window size.
+
+    Args:
+        prefix_sums: Output of segment_prefix_sums.
+        window: Number of rows in the window (the window ends at the current row).
+        min_periods: Minimum number of valid values in the window, otherwise the statistic is NaN.
+        statistics: Statistics to return (any of 'count', 'mean' and 'std').
+
+    Returns:
+        Dict of statistic name to DataFrame with the index of the input and one column per input column.
+    """
+    key = (window, min_periods)
+    if key not in prefix_sums['cache']:
+        n_rows = len(prefix_sums['row_start'])
+        hi = np.arange(1, n_rows + 1)
+        lo = np.maximum(prefix_sums['row_start'], hi - window)
+
+        count = prefix_sums['count'][hi] - prefix_sums['count'][lo]
+        total = prefix_sums['sum'][hi] - prefix_sums['sum'][lo]
+        total_sq = prefix_sums['sumsq'][hi] - prefix_sums['sumsq'][lo]
+        enough = count >= max(min_periods, 1)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            centered_mean = total / count
+            variance = np.maximum(total_sq - total * centered_mean, 0.0) / (count - 1)
+        results = {
+            # like pandas, min_periods of the count refers to the rows in the window, not to the valid values
+            'count': np.where((hi - lo)[:, None] >= min_periods, count, np.nan),
+            'mean': np.where(enough, centered_mean + prefix_sums['offset'], np.nan),
+            'std': np.where(enough & (count > 1), np.sqrt(variance), np.nan),
+        }
+        prefix_sums['cache'][key] = results
+
+    results = prefix_sums['cache'][key]
+    return {
+        statistic: pd.DataFrame(restore_order(results[statistic], prefix_sums['order']), index=prefix_sums['index'], columns=prefix_sums['columns'])
+        for statistic in statistics
+    }
@@ -0,0 +1,312 @@
+import os
+import sys
+import glob
+import json
+import fnmatch
+import hashlib
+import argparse
+import subprocess
+from datetime import datetime
+from loguru import logger
+import config
+from code_fingerprint import local_dependencies, update_with_modules
+
+# Runs the data pipeline stages in order and skips stages whose outputs are still valid.
+#
+# Every stage gets a content-addressed key: a sha256 over
+#   - the source code of the stage script and of the local modules it imports (transitively, config.py excluded),
+#   - the values of the config.py constants that the script and these modules import,
+#   - the content hashes of the stage input files (raw files or outputs of upstream stages).
+# A stage is skipped if its key equals the key recorded after its last successful run and all its outputs exist.
+# Because upstream outputs are part of the downstream keys, a changed upstream output invalidates the downstream stages.
+#
+# Usage (from the repository root):
+#   python code/data/cleaning-scripts/run_pipeline.py                      # run all stages that are not up to date
+#   python code/data/cleaning-scripts/run_pipeline.py --from aggregate     # only consider aggregate and the stages after it
+#   python code/data/cleaning-scripts/run_pipeline.py --only synchronize --force
+#   python code/data/cleaning-scripts/run_pipeline.py --in-process --checkpoint   # chain the stages in memory, also write the intermediate csv files
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+data_dir = os.path.dirname(script_dir)
+cache_path = os.path.join(data_dir, '.pipeline_cache.json')
+
+# --- Stage graph ---
+# inputs and outputs are glob patterns relative to code/data (directories are expanded recursively).
+# Incremental stages only process the data that is new since their previous run; they are run with --full when forced.
+METRICS_REGISTRATION_CSV = 'metadata/Metrics registration.csv'
+METADATA_CATALOG = 'metadata/catalog.json'
+SENSOR_PARTITIONS = 'appended/long_table/month=*/qid_prefix=[1-9]*/*.parquet'
+NOON_REPORT_PARTITIONS = 'appended/long_table/month=*/qid_prefix=0/*.parquet'
+ALL_PARTITIONS = 'appended/long_table/month=*/qid_prefix=*/*.parquet'
+SYNCHRONIZED_DATASET = ['synchronized/_segment_index.json', 'synchronized/month=*/*.parquet']
+
+STAGES = [
+    {
+        'name': 'metadata',
+        'inputs': ['metadata/Metrics registration.xlsx'],
+        'outputs': [METRICS_REGISTRATION_CSV, METADATA_CATALOG],
+    },
+    {
+        'name': 'append',
+        'inputs': [f'raw/unzipped/{month}/*.csv' for month in range(1, 13)] + [METADATA_CATALOG],
+        'outputs': ['appended/long_table/_manifest_sensors.json', SENSOR_PARTITIONS],
+        'incremental': True,
+    },
+    {
+        'name': 'add_noon_reps',
+        'inputs': ['raw/unzipped/Noon Reports/*.csv', METADATA_CATALOG],
+        'outputs': ['appended/long_table/_manifest_noon_reports.json', NOON_REPORT_PARTITIONS, 'appended/noon_reports_only.csv'],
+        'incremental': True,
+    },
+    {
+        'name': 'synchronize',
+        'inputs': [SENSOR_PARTITIONS, METADATA_CATALOG],
+        'outputs': SYNCHRONIZED_DATASET,
+        'incremental': True,
+    },
+    {
+        'name': 'pre_agg_clean',
+        'inputs': SYNCHRONIZED_DATASET + [METADATA_CATALOG],
+        'outputs': ['filtered/filtered.csv'],
+    },
+    {
+        'name': 'aggregate',
+        'inputs': ['filtered/filtered.csv', ALL_PARTITIONS, METADATA_CATALOG],
+        'outputs': [f'aggregated/aggregated_{window_length}.csv' for window_length in dict.fromkeys(config.AGGREGATION_WINDOW_LENGTHS)],
+    },
+    {
+        'name': 'engineer_features',
+        'inputs': [f'aggregated/aggregated_{config.WINDOW_LENGTH}.csv'],
+        'outputs': [f'engineered/engineered_features_{config.WINDOW_LENGTH}.csv'],
+    },
+]
+STAGE_NAMES = [stage['name'] for stage in STAGES]
+
+
+# --- Fingerprinting ---
+def expand_paths(patterns):
+    """Returns the sorted files (relative to code/data) matching the glob patterns. Directories are expanded recursively."""
+    paths = set()
+    for pattern in patterns:
+        for match in glob.glob(os.path.join(data_dir, pattern)):
+            if os.path.isdir(match):
+                for root, _, files in os.walk(match):
+                    paths.update(os.path.join(root, f) for f in files)
+            else:
+                paths.add(match)
+    return sorted(os.path.relpath(path, data_dir) for path in paths)
+
+
+def file_hash(rel_path, hash_cache):
+    """
+    Returns the sha256 of a file. Hashes are cached by (size, mtime_ns), so unchanged files are only hashed once,
+    which keeps fingerprinting the raw data cheap.
+    """
+    stat = os.stat(os.path.join(data_dir, rel_path))
+    cached = hash_cache.get(rel_path)
+    if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(os.path.join(data_dir, rel_path), 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    hash_cache[rel_path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+    return digest.hexdigest()
+
+
+def stage_key(stage, hash_cache):
+    """Computes the content-addressed key of a stage (see the comment at the top of this file)."""
+    modules, config_names = local_dependencies(stage['name'])
+    digest = hashlib.sha256()
+    update_with_modules(digest, modules)
+    for name in config_names:
+        digest.update(f'config {name}={getattr(config, name, None)!r}\n'.encode())
+    for rel_path in expand_paths(stage['inputs']):
+        digest.update(f'input {rel_path}={file_hash(rel_path, hash_cache)}\n'.encode())
+    return digest.hexdigest()
+
+
+def patterns_overlap(a, b):
+    """Checks whether two path patterns can match the same file (one matches the other, or one is a directory containing the other)."""
+    return a == b or fnmatch.fnmatchcase(a, b) or fnmatch.fnmatchcase(b, a) or a.startswith(b.rstrip('/') + '/') or b.startswith(a.rstrip('/') + '/')
+
+
+def reads_outputs_of(stage, upstream):
+    """Checks whether a stage reads any output of the upstream stage."""
+    return any(patterns_overlap(inp, out) for inp in stage['inputs'] for out in upstream['outputs'])
+
+
+def outputs_exist(stage):
+    """Checks that every output pattern of a stage matches at least one file."""
+    return all(expand_paths([pattern]) for pattern in stage['outputs'])
+
+
+# --- Cache state ---
+def load_cache():
+    if not os.path.isfile(cache_path):
+        return {'stages': {}, 'hashes': {}}
+    with open(cache_path) as f:
+        return json.load(f)
+
+
+def save_cache(cache):
+    tmp_path = f'{cache_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, cache_path)
+
+
+# --- Running ---
+def select_stages(from_stage=None, only=None):
+    """Returns the stages to consider: the --only stages, or all stages starting at --from (default: all stages)."""
+    if only:
+        return [stage for stage in STAGES if stage['name'] in only]
+    start = STAGE_NAMES.index(from_stage) if from_stage else 0
+    return STAGES[start:]
+
+
+def run_stage(stage, full=False):
+    """
+    Runs a stage script in a subprocess (from the repository root, like run_data_pipeline.sh did). Returns True on success.
+    If full is True, incremental stages are run with --full, so they rebuild their outputs from all data.
+    """
+    script_path = os.path.join(script_dir, f'{stage["name"]}.py')
+    arguments = ['--full'] if full and stage.get('incremental') else []
+    start = datetime.now()
+    result = subprocess.run([sys.executable, script_path] + arguments, cwd=os.path.dirname(os.path.dirname(data_dir)))
+    logger.info(f'{stage["name"]}.py finished with exit code {result.returncode} after {(datetime.now() - start).total_seconds():.1f}s')
+    return result.returncode == 0
+
+
+def run_pipeline(from_stage=None, only=None, force=False, dry_run=False):
+    """
+    This function runs the selected pipeline stages in order, skipping stages that are up to date.
+
+    Args:
+        from_stage: Name of the first stage to consider.
+        only: List of stage names to consider (overrides from_stage).
+        force: Run the selected stages even if they are up to date (incremental stages rebuild their outputs from all data).
+        dry_run: Only log which stages would run.
+
+    Returns:
+        True if all selected stages are up to date or ran successfully.
+    """
+    cache = load_cache()
+    would_run = []  # dry run: stages that would run, their outputs are about to change
+    for stage in select_stages(from_stage, only):
+        name = stage['name']
+        key = stage_key(stage, cache['hashes'])
+        up_to_date = cache['stages'].get(name, {}).get('key') == key and outputs_exist(stage)
+        upstream_changed = any(reads_outputs_of(stage, upstream) for upstream in would_run)
+        if up_to_date and not force and not upstream_changed:
+            logger.info(f'{name}: up to date, skipping')
+            continue
+        if dry_run:
+            logger.info(f'{name}: would run (upstream changed)' if up_to_date and not force else f'{name}: would run')
+            would_run.append(stage)
+            continue
+
+        logger.info(f'{name}: running{" (full)" if force and stage.get("incremental") else ""}')
+        if not run_stage(stage, full=force):
+            logger.error(f'{name}: failed, stopping the pipeline')
+            save_cache(cache)
+            return False
+
+        # the key is recomputed after the run, because a stage may rewrite its own inputs: the stages reading the metadata catalog
+        # rebuild it with metadata.load_catalog if it is outdated (e.g. --only append after the metrics registration changed)
+        cache['stages'][name] = {'key': stage_key(stage, cache['hashes']), 'finished': datetime.now().isoformat(timespec='seconds')}
+        save_cache(cache)
+    logger.info('data pipeline finished')
+    return True
+
+
+# --- In-process mode ---
+def run_in_process(checkpoint=False):
+    """
+    This function runs all stages in one process and hands the DataFrames from stage to stage in memory.
+    The long table store is always written (the ingest is incremental and synchronize/aggregate read from it),
+    the synchronized segments, filtered.csv and the aggregated csv files are only written if checkpoint is True.
+    The stage cache is not used or updated in this mode.
+
+    Args:
+        checkpoint: Also write the intermediate outputs of synchronize, pre_agg_clean and aggregate.
+
+    Returns:
+        The engineered DataFrame (also saved like engineer_features.py does).
+    """
+    from appended_store import NOON_REPORT_QID_PREFIX
+    from long_table import full_precision_qids, load_long_table, filter_qid_prefixes
+    import metadata
+    import append
+    import add_noon_reps
+    import synchronize
+    import pre_agg_clean
+    import aggregate
+    import engineer_features
+
+    pipeline_start = datetime.now()
+
+    # ingest (checkpointed in the long table store)
+    catalog = metadata.load_catalog()  # only parses the xlsx if it changed
+    append.append()
+    add_noon_reps.add_noon_reps()
+    # float32 values, the exact values of the full precision qids are loaded separately (like synchronize.py does)
+    mixed_long = load_long_table(aggregate.long_table_dir, catalog, time_ordered=True, full_precision=False)  # synchronize needs the sensor rows in time order
+    exact_qids = full_precision_qids(catalog)
+    full_precision = load_long_table(aggregate.long_table_dir, catalog, exclude_qid_prefixes=[NOON_REPORT_QID_PREFIX], qids=exact_qids, time_ordered=True) if exact_qids else None
+    logger.info(f'Loaded long table with shape {mixed_long.shape}')
+
+    # synchronize (the segments are only written to the synchronized dataset if checkpointing)
+    synchronized_data_dir = synchronize.synchronized_data_dir if checkpoint else None
+    sensor_long = filter_qid_prefixes(mixed_long, exclude_qid_prefixes=[NOON_REPORT_QID_PREFIX])
+    segments, sync_metadata = synchronize.synchronize(sensor_long, synchronized_data_dir=synchronized_data_dir, full_precision=full_precision)
+    del sensor_long, full_precision
+    sync_metadata['ingest'] = synchronize.ingest_state(aggregate.long_table_dir)
+    synchronize.save_synchronization_metadata(sync_metadata, synchronize.sync_output_dir, pipeline_start.strftime('%Y%m%d_%H%M%S'))
+
+    # pre-aggregation cleaning
+    df = pre_agg_clean.prepare_synchronized_data(segments, catalog)
+    del segments
+    df = pre_agg_clean.pre_agg_clean(df, catalog, n_workers=max(1, os.cpu_count() - 1))
+    if checkpoint:
+        os.makedirs(pre_agg_clean.filtered_data_dir, exist_ok=True)
+        df.to_csv(os.path.join(pre_agg_clean.filtered_data_dir, 'filtered.csv'), index=False)
+        logger.info(f'Saved filtered data checkpoint to {pre_agg_clean.filtered_data_dir}')
+
+    # aggregation
+    df['utc_timestamp'] = df['utc_timestamp'].dt.as_unit('ns')  # same resolution as the appended store
+    aggregated = aggregate.aggregate(df, mixed_long, catalog)
+    del mixed_long
+    if checkpoint:
+        os.makedirs(aggregate.aggregated_dir, exist_ok=True)
+        for window_length, aggregated_df in aggregated.items():
+            aggregated_df.to_csv(os.path.join(aggregate.aggregated_dir, f'aggregated_{window_length}.csv'), index=False)
+        logger.info(f'Saved aggregated data checkpoints to {aggregate.aggregated_dir}')
+    df = aggregated[config.WINDOW_LENGTH]
+
+    # feature engineering (final output, always saved)
+    df = engineer_features.engineer_features(df)
+    os.makedirs(engineer_features.engineered_dir, exist_ok=True)
+    output_path = os.path.join(engineer_features.engineered_dir, f'engineered_features_{config.WINDOW_LENGTH}.csv')
+    df.to_csv(output_path, index=False)
+    logger.info(f'Saved data with engineered features to {output_path}')
+
+    logger.info(f'in-process data pipeline finished after {(datetime.now() - pipeline_start).total_seconds():.1f}s')
+    return df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the data pipeline stages in order, skipping stages whose inputs, code and config did not change.')
+    selection = parser.add_mutually_exclusive_group()
+    selection.add_argument('--from', dest='from_stage', choices=STAGE_NAMES, help='start at this stage (earlier stages are not considered)')
+    selection.add_argument('--only', nargs='+', choices=STAGE_NAMES, help='only consider these stages')
+    parser.add_argument('--force', action='store_true', help='run the selected stages even if they are up to date (incremental stages with --full)')
+    parser.add_argument('--dry-run', action='store_true', help='only show which stages would run')
+    parser.add_argument('--in-process', action='store_true', help='run all stages in one process, passing the data in memory (ignores the stage cache)')
+    parser.add_argument('--checkpoint', action='store_true', help='with --in-process: also write the intermediate synchronized, filtered and aggregated files')
+    args = parser.parse_args()
+
+    if args.in_process:
+        run_in_process(checkpoint=args.checkpoint)
+        sys.exit(0)
+    sys.exit(0 if run_pipeline(args.from_stage, args.only, args.force, args.dry_run) else 1)
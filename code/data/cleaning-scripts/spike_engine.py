@@ -0,0 +1,78 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from rolling_engine import segment_layout, restore_order
+
+# Hampel spike detection (rolling median + rolling MAD) for many columns at once.
+#
+# An observation x_i is a spike if |x_i - median_i| > threshold * MAD_i, where median_i is the rolling median of the column and
+# MAD_i is the rolling median of |x - median| (both per segment, window ending at the current row). This reproduces
+# df.groupby('seg_id')[col].rolling(window, min_periods).median() applied twice, but for all columns in one pass:
+# the columns are one 2-D array with the segments as contiguous row blocks, and the windows of all rows and columns are
+# sorted together in C (a window is a few rows, so sorting it is cheaper than maintaining a sorted structure per segment).
+# Window positions before the segment start count as missing values, like the rows pandas does not see within a group.
+
+# maximum number of window values sorted at once (bounds the memory of a chunk)
+MAX_WINDOW_VALUES_PER_CHUNK = 4_000_000
+
+
+def rolling_median(values, row_start, window, min_periods):
+    """
+    This function computes the rolling median of every column of a 2-D array within segments.
+
+    Args:
+        values: 2-D float array (rows x columns) with the segments as contiguous row blocks, NaN for missing values.
+        row_start: First row of the segment of every row.
+        window: Number of rows in the window (the window ends at the current row).
+        min_periods: Minimum number of valid values in the window, otherwise the median is NaN.
+
+    Returns:
+        2-D float64 array with the rolling medians.
+    """
+    n_rows, n_columns = values.shape
+    padded = np.concatenate([np.full((window - 1, n_columns), np.nan), values.astype(np.float64)])
+    windows = sliding_window_view(padded, window, axis=0)  # rows x columns x window, position j is row i - window + 1 + j
+    offsets = np.arange(window) - (window - 1)
+
+    medians = np.empty((n_rows, n_columns))
+    chunk_rows = max(1, MAX_WINDOW_VALUES_PER_CHUNK // max(1, n_columns * window))
+    for start in range(0, n_rows, chunk_rows):
+        end = min(n_rows, start + chunk_rows)
+        chunk = windows[start:end].copy()
+        outside_segment = (np.arange(start, end)[:, None] + offsets) < row_start[start:end, None]
+        chunk[np.broadcast_to(outside_segment[:, None, :], chunk.shape)] = np.nan
+
+        # NaN are sorted to the end, the valid values of a window are the first count values
+        chunk.sort(axis=2)
+        count = window - np.isnan(chunk).sum(axis=2)
+        lower = np.take_along_axis(chunk, np.maximum(count - 1, 0)[..., None] // 2, axis=2)[..., 0]
+        upper = np.take_along_axis(chunk, np.minimum(count // 2, window - 1)[..., None], axis=2)[..., 0]
+        medians[start:end] = np.where(count >= max(min_periods, 1), (lower + upper) / 2, np.nan)
+    return medians
+
+
+def hampel_spike_mask(df, columns, thresholds, window, min_periods, segment_column='seg_id'):
+    """
+    This function marks the spikes of all columns with the Hampel filter (rolling median + rolling MAD per segment).
+
+    Args:
+        df: DataFrame with the columns and the segment column.
+        columns: Columns to check for spikes.
+        thresholds: Threshold (number of MADs) per column, in the order of the columns.
+        window: Number of rows in the rolling windows.
+        min_periods: Minimum number of valid values in a window.
+        segment_column: Column with the segment ids.
+
+    Returns:
+        Boolean 2-D array (rows x columns) that is True for the spikes, in the row order of df.
+    """
+    order, row_start = segment_layout(df[segment_column].to_numpy())
+    values = df[list(columns)].to_numpy(dtype=np.float64, na_value=np.nan)
+    if order is not None:
+        values = values[order]
+
+    median = rolling_median(values, row_start, window, min_periods)
+    deviation = np.abs(values - median)
+    mad = rolling_median(deviation, row_start, window, min_periods)
+    with np.errstate(invalid='ignore'):
+        spikes = deviation > np.asarray(thresholds, dtype=np.float64) * mad
+    return restore_order(spikes, order)
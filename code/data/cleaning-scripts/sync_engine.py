@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+
+# Array based synchronization of one segment onto the time grids of all sampling rates in a single pass.
+#
+# The qids are grouped by their intended sampling interval (any interval in INTENDED_SAMPLING_INTERVALS_SECONDS, e.g. 15s, 1h, 1 day).
+# Every rate group has its own time grid (segment start + k * interval, up to the segment end). The qids of a group are
+# interpolated with np.interp straight from their sorted (timestamp, value) arrays onto the grid of the group.
+#
+# The interpolation reproduces the former pivot + DataFrame.interpolate(method='linear', limit_area='inside') per rate group:
+#   - interpolate(method='linear') interpolates over row positions, not over time. The rows were the union of the observation
+#     timestamps of the group and the grid timestamps, so the x coordinate of a point is its position in that union.
+#   - limit_area='inside': grid points before the first or after the last valid observation of a qid stay NaN.
+#   - duplicated (timestamp, qid) observations: the first non-NaN value is used (pivot_table(aggfunc='first')),
+#     and timestamps without any valid value of the group do not count as rows (pivot_table drops all-NaN rows).
+# The result is the outer join of the grids: one row per grid timestamp of any group, NaN where a qid's group has no grid point.
+
+
+def rate_groups(qids, qid_categories, sampling_intervals):
+    """
+    This function groups qids by their intended sampling interval.
+
+    Args:
+        qids: qids to synchronize (qids without a sampling interval are dropped).
+        qid_categories: Categories the qid codes of the observation arrays refer to.
+        sampling_intervals: Dict of qid to intended sampling interval in seconds.
+
+    Returns:
+        List of (interval in seconds, qids, qid codes) tuples, sorted by interval (this is also the column order of the result).
+    """
+    categories = pd.Index(qid_categories)
+    groups = []
+    for interval in sorted({sampling_intervals[qid] for qid in qids if qid in sampling_intervals}):
+        group_qids = [qid for qid in qids if sampling_intervals.get(qid) == interval]
+        groups.append((int(interval), group_qids, categories.get_indexer(group_qids)))
+    return groups
+
+
+def time_grid(start_ns, end_ns, interval_seconds):
+    """Returns the int64 ns timestamps start, start + interval, ... up to (and including) end."""
+    step = np.int64(interval_seconds) * 1_000_000_000
+    return start_ns + np.arange((end_ns - start_ns) // step + 1, dtype=np.int64) * step
+
+
+def _interpolate_group(timestamps, codes, values, group_codes, grid):
+    """
+    Interpolates the qids of one rate group onto its grid.
+
+    Returns:
+        Tuple of (2d float64 array with one column per group qid, boolean array that is True for the qids that were
+        columns of the former pivot, i.e. that keep the value dtype).
+    """
+    in_group = np.isin(codes, group_codes)
+    group_ts, group_codes_obs, group_values = timestamps[in_group], codes[in_group], values[in_group]
+    valid = ~np.isnan(group_values)
+
+    # sort by (qid, timestamp), stable so the first of duplicated observations stays first
+    order = np.lexsort((group_ts, group_codes_obs))
+    sorted_ts, sorted_codes = group_ts[order], group_codes_obs[order]
+    duplicated = (sorted_ts[1:] == sorted_ts[:-1]) & (sorted_codes[1:] == sorted_codes[:-1])
+    has_duplicates = bool(duplicated.any())
+
+    # rows of the former pivot: observation timestamps (with a valid value if pivot_table was used) and grid timestamps
+    index_ts = group_ts[valid] if has_duplicates else group_ts
+    union = np.union1d(index_ts, grid)
+    grid_pos = np.searchsorted(union, grid).astype(np.float64)
+
+    # valid observations per qid, first value per timestamp
+    order = order[valid[order]]
+    sorted_ts, sorted_codes, sorted_values = group_ts[order], group_codes_obs[order], group_values[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (sorted_ts[1:] != sorted_ts[:-1]) | (sorted_codes[1:] != sorted_codes[:-1])
+    sorted_ts, sorted_codes, sorted_values = sorted_ts[first], sorted_codes[first], sorted_values[first]
+    obs_pos = np.searchsorted(union, sorted_ts).astype(np.float64)
+    bounds = np.searchsorted(sorted_codes, group_codes, side='left'), np.searchsorted(sorted_codes, group_codes, side='right')
+
+    result = np.full((len(grid), len(group_codes)), np.nan)
+    for column, (lo, hi) in enumerate(zip(*bounds)):
+        if lo == hi:
+            continue
+        xp, fp = obs_pos[lo:hi], sorted_values[lo:hi]
+        inside = (grid_pos >= xp[0]) & (grid_pos <= xp[-1])
+        result[inside, column] = np.interp(grid_pos[inside], xp, fp)
+
+    # the former pivot had a column for every qid with an observation (pivot) or with a valid observation (pivot_table)
+    observed_codes = group_codes_obs[valid] if has_duplicates else group_codes_obs
+    return result, np.isin(group_codes, observed_codes)
+
+
+def synchronize_segment(timestamps, codes, values, seg_id, start_ns, end_ns, groups):
+    """
+    This function synchronizes the observations of one segment onto the time grids of all rate groups.
+
+    Args:
+        timestamps: int64 ns timestamps of the segment observations (sorted).
+        codes: qid codes of the observations.
+        values: Observed values.
+        seg_id: Segment id (added as a column).
+        start_ns: Segment start (int64 ns).
+        end_ns: Segment end (int64 ns).
+        groups: Rate groups (see rate_groups).
+
+    Returns:
+        DataFrame with utc_timestamp, seg_id and one column per qid (in the order of the groups).
+    """
+    grids = [time_grid(start_ns, end_ns, interval) for interval, _, _ in groups]
+    all_grid_ts = grids[0]
+    for grid in grids[1:]:
+        all_grid_ts = np.union1d(all_grid_ts, grid)
+
+    columns = {
+        'utc_timestamp': pd.to_datetime(all_grid_ts, utc=True),
+        'seg_id': np.full(len(all_grid_ts), seg_id, dtype=np.int64),
+    }
+    for (_, group_qids, group_codes), grid in zip(groups, grids):
+        group_result, keeps_dtype = _interpolate_group(timestamps, codes, values, group_codes, grid)
+        rows = np.searchsorted(all_grid_ts, grid)
+        for column, qid in enumerate(group_qids):
+            dtype = values.dtype if keeps_dtype[column] else np.float64
+            qid_values = np.full(len(all_grid_ts), np.nan, dtype=dtype)
+            qid_values[rows] = group_result[:, column]
+            columns[qid] = qid_values
+    return pd.DataFrame(columns)
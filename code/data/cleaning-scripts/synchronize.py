@@ -1,349 +1,488 @@
 import pandas as pd
 import numpy as np
+import pyarrow as pa
 import os
+import sys
 import json
+import glob
 import time
+import hashlib
+import argparse
 from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
 from config import INTENDED_SAMPLING_INTERVALS_SECONDS, THRESHOLD_FACTOR, MIN_SEGMENT_LENGTH_SECONDS, DROP_TRANDUCER_DEPTH
+from appended_store import LONG_TABLE_DIR_NAME, NOON_REPORT_QID_PREFIX, time_order, timestamps_to_int64
+from long_table import full_precision_qids, load_long_table
+from metadata import load_catalog
+from ingest_manifest import SENSOR_MANIFEST_NAME, load_manifest
+from code_fingerprint import code_hash
+from sync_engine import rate_groups, synchronize_segment
+from synchronized_store import load_segment_index, segment_schema, write_segments
+from time_gaps import nominal_intervals, detect_time_gaps, gap_index, segments_from_gaps, save_gap_index, load_gap_index
 from loguru import logger
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 appended_data_dir = os.path.join(script_dir, '..', 'appended')
+long_table_dir = os.path.join(appended_data_dir, LONG_TABLE_DIR_NAME)
 synchronized_data_dir = os.path.join(script_dir, '..', 'synchronized')
 sync_output_dir = os.path.join(script_dir, '..', '..', 'outputs', 'synchronization')
 
-script_start = time.perf_counter()
-
-# create synchronized data directory if it does not exist
-if not os.path.exists(synchronized_data_dir):
-    os.makedirs(synchronized_data_dir)
-else:
-    logger.info(f'synchronized data directory already exists: {synchronized_data_dir}')
-
-    # clear the directory
-    for filename in os.listdir(synchronized_data_dir):
-        file_path = os.path.join(synchronized_data_dir, filename)
-        try:
-            if os.path.isfile(file_path):
-                os.unlink(file_path)
-                logger.info(f'Deleted file: {file_path}')
-        except Exception as e:
-            logger.error(f'Error deleting file {file_path}: {e}')
-    logger.info(f'Cleared synchronized data directory: {synchronized_data_dir}')
-
-# create output directory if it doesnt already exist
-if not os.path.exists(sync_output_dir):
-    os.makedirs(sync_output_dir)
-else:
-    logger.info(f'synchronized data directory already exists: {sync_output_dir}')
-
-# load the appended dataframe
-df = pd.read_csv(
-    os.path.join(appended_data_dir, 'excl_noon_reports.csv'),
-    parse_dates=['utc_timestamp'],
-#    nrows=1000000 # for testing, remove this line for full dataset
-    )
-
-logger.info(f'QIDs in appended data: {df["qid_mapping"].unique()}')
-
-# find the start and end time of the dataset
-df['utc_timestamp'] = pd.to_datetime(df['utc_timestamp'], format='ISO8601')
-df_start_time = df['utc_timestamp'].min()
-df_end_time = df['utc_timestamp'].max()
-total_duration = df_end_time - df_start_time
-logger.info(f'Dataset time range: {df_start_time} to {df_end_time} (duration: {total_duration})')
-
-# If chosen in config file, drop all transducer depth variables (this is way more unreliable and creates a lot of unnecessary time gaps, for a relatively low return in terms of data value)
-if DROP_TRANDUCER_DEPTH:
-    # Drop rows where qid_mapping is the transducer depth variable (in-place)
-    initial_shape = df.shape
-    df.drop(df[df['qid_mapping'] == '2::0::4::0_1::1::0::2::0_37::0::2::0_8'].index, inplace=True)
-    logger.info(f'Dropped transducer depth variable. Shape: {initial_shape} -> {df.shape}')
-else:
-    logger.info(f'Keeping transducer depth variable. Variables: {df["qid_mapping"].unique()}')
-
-logger.info(f'Synchronizing dataframe with shape: {df.shape}')
-logger.info(f'number of unique time stamps: {df["utc_timestamp"].nunique()}')
-logger.info(f'Threshold factor for synchronization: {THRESHOLD_FACTOR}')
-logger.info(f'distribution of intended sampling intervals: {pd.Series(INTENDED_SAMPLING_INTERVALS_SECONDS).value_counts()}')
-
-# -- PART 1 -- identify time observations within gaps based on intended sampling intervals and a tolerance threshold
-
-# Map each qid to its intended sampling interval
-df['nominal_dt'] = df['qid_mapping'].map(INTENDED_SAMPLING_INTERVALS_SECONDS)
+# --- Segment workers ---
+# The long table arrays (sorted by time) are placed in shared memory once and every worker attaches to them in its initializer,
+# so a segment task only consists of its row range in these arrays and its seg_info (instead of a pickled slice of the table and grids).
+# The values are float32. If the exact observations of the full precision qids are given (see synchronize), they are shared as well
+# and replace the float32 observations of these qids in every segment, so only the segments are converted to float64.
+_worker_state = {}
+
+def _to_shared_memory(array):
+    """Copies an array into a new shared memory block. Returns the block and the (name, shape, dtype) spec to attach to it."""
+    shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+def _init_segment_worker(array_specs, groups, schema, full_precision_codes):
+    """Pool initializer: attaches to the shared long table arrays and stores the settings shared by all segments."""
+    _worker_state['shm'] = {name: SharedMemory(name=shm_name) for name, (shm_name, _, _) in array_specs.items()}
+    _worker_state['arrays'] = {
+        name: np.ndarray(shape, dtype=np.dtype(dtype), buffer=_worker_state['shm'][name].buf)
+        for name, (_, shape, dtype) in array_specs.items()
+    }
+    _worker_state['settings'] = (groups, schema, full_precision_codes)
+
+def _with_exact_values(timestamps, codes, values, start_ns, end_ns, full_precision_codes):
+    """Replaces the observations of the full precision qids in a segment by their exact observations (the values become float64)."""
+    arrays = _worker_state['arrays']
+    first = np.searchsorted(arrays['exact_timestamp'], start_ns, side='left')
+    end = np.searchsorted(arrays['exact_timestamp'], end_ns, side='right')
+    keep = ~np.isin(codes, full_precision_codes)
+    if first == end and keep.all():
+        return timestamps, codes, values
+    timestamps = np.concatenate([timestamps[keep], arrays['exact_timestamp'][first:end]])
+    codes = np.concatenate([codes[keep], arrays['exact_qid_code'][first:end]])
+    values = np.concatenate([values[keep].astype(np.float64), arrays['exact_value'][first:end]])
+    order = time_order(timestamps)
+    if order is not None:
+        timestamps, codes, values = timestamps[order], codes[order], values[order]
+    return timestamps, codes, values
 
-# Calculate the tolerance threshold using Dalheim & Steen's method:
-# Flag as time gap if |Δt_i - Δt_nominal| > (1/2) * Δt_nominal
-df['tolerance_threshold'] = THRESHOLD_FACTOR * df['nominal_dt']
+def process_single_segment(args):
+    """
+    Process a single segment with interpolation (runs in a worker initialized by _init_segment_worker).
 
-# Create boolean mask identifying time gaps
-# True indicates a time gap (violation of the intended sampling interval)
-df['is_time_gap'] = np.abs(df['time_delta_sec'] - df['nominal_dt']) > df['tolerance_threshold']
+    Args:
+        args: Tuple containing (i, start_row, end_row, seg_info). start_row and end_row are the row range of the segment in the
+              shared long table arrays.
 
-# -- PART 2 -- create continuous windows of unobstructed data 
+    Returns:
+        Tuple of (segment_index, seg_id, shape, segment as arrow table with the synchronized segment schema)
+    """
+    i, start_row, end_row, seg_info = args
+    groups, schema, full_precision_codes = _worker_state['settings']
+    arrays = _worker_state['arrays']
 
-# Collapse to one row per timestamp: True if ANY variable has a time jump at that time
-time_gap_mask = df.groupby('utc_timestamp')['is_time_gap'].any().rename('is_gap_any').sort_index()
+    seg_id = seg_info['seg_id']
+    seg_start_time = seg_info['start_time']
+    seg_end_time = seg_info['end_time']
 
-logger.info(f'created mask with shape: {time_gap_mask.shape}. ')
-logger.info(f'Number of obs marked as time gaps: {time_gap_mask.sum()}')
+    timestamps = arrays['utc_timestamp'][start_row:end_row]
+    codes = arrays['qid_code'][start_row:end_row]
+    values = arrays['value'][start_row:end_row]
+    if 'exact_value' in arrays:
+        timestamps, codes, values = _with_exact_values(timestamps, codes, values, seg_start_time.value, seg_end_time.value, full_precision_codes)
 
-# use time gap mask to create segments (for every TRUE value, there is a time gap)
-# Boolean: this timestamp starts a new segment (first row or follows a gap)
-seg_start = time_gap_mask.shift(fill_value=True)
+    # Interpolate every qid onto the time grid of its sampling interval (one pass over all rate groups, see sync_engine.py)
+    df_segment_combined = synchronize_segment(timestamps, codes, values, seg_id, seg_start_time.value, seg_end_time.value, groups)
 
-# Assign segment ids using cumulative sum
-seg_id = seg_start.cumsum()
+    # arrow tables are sent back to the main process as buffers, which is much cheaper than pickling a DataFrame
+    return i, seg_id, df_segment_combined.shape, pa.Table.from_pandas(df_segment_combined, schema=schema, preserve_index=False)
 
-# Create segments dataframe with gap info and segment ids
-gap_segments = time_gap_mask.to_frame().assign(seg_id=seg_id)
+def _processed_segments(results, segment_args, collected=None):
+    """Logs the processed segments and yields them as (seg_id, start_time, end_time, table) for write_segments (also collects the tables if a list is given)."""
+    for i, seg_id, shape, table in results:
+        logger.info(f'Segment {i+1}/{len(segment_args)} (ID: {seg_id}): shape {shape}')
+        if collected is not None:
+            collected.append(table)
+        seg_info = segment_args[i][3]
+        yield seg_id, seg_info['start_time'], seg_info['end_time'], table
 
-# Create an object that stores the beginning and end of each valid segment
-valid_segments_info = gap_segments.groupby('seg_id').agg(
-    start_time=('is_gap_any', 'idxmin'), 
-    end_time=('is_gap_any', 'idxmax')
-)
+def synchronization_configuration():
+    """
+    Returns the settings the segments depend on. An incremental run is only possible if they did not change since the previous run,
+    so the configuration also contains hashes of the sampling intervals and of the code: this script and the local modules it imports
+    (sync_engine.py, time_gaps.py, synchronized_store.py, ...), the same code the pipeline runner keys the stage with.
+    """
+    sampling_intervals = json.dumps(INTENDED_SAMPLING_INTERVALS_SECONDS, sort_keys=True).encode()
+    return {
+        'tolerance_factor': float(THRESHOLD_FACTOR),
+        'min_segment_length_seconds': int(MIN_SEGMENT_LENGTH_SECONDS),
+        'drop_transducer_depth': bool(DROP_TRANDUCER_DEPTH),
+        'intended_sampling_intervals_sha256': hashlib.sha256(sampling_intervals).hexdigest(),
+        'code_sha256': code_hash('synchronize'),
+    }
 
-# convert start_time and end_time to datetime
-valid_segments_info['start_time'] = pd.to_datetime(valid_segments_info['start_time'],format='ISO8601')
-valid_segments_info['end_time'] = pd.to_datetime(valid_segments_info['end_time'], format='ISO8601')
+def stable_segments(previous_metadata):
+    """Returns the valid segments of a previous run (indexed by seg_id, with tz-aware start_time and end_time), or an empty frame."""
+    records = previous_metadata['valid_segments_info'] if previous_metadata is not None else []
+    segments_info = pd.DataFrame.from_records(records, columns=['seg_id', 'start_time', 'end_time']).set_index('seg_id')
+    segments_info.index = segments_info.index.astype(int)
+    segments_info['start_time'] = pd.to_datetime(segments_info['start_time'], utc=True).dt.as_unit('ns')
+    segments_info['end_time'] = pd.to_datetime(segments_info['end_time'], utc=True).dt.as_unit('ns')
+    return segments_info.sort_index()
 
-# Filter out segments that are too short (i.e. shorter than the minimum segment length defined in config file)
-segment_sizes = valid_segments_info['end_time'] - valid_segments_info['start_time']
-valid_segments_mask = segment_sizes >= pd.Timedelta(seconds=MIN_SEGMENT_LENGTH_SECONDS)
 
-# Apply the filter to keep only valid segments
-valid_segments_info = valid_segments_info[valid_segments_mask]
-
-# calculate the total duration of valid segments
-total_valid_duration = (valid_segments_info['end_time'] - valid_segments_info['start_time']).sum()
-
-
-logger.info(f'valid segments info (shape: {valid_segments_info.shape}):\n{valid_segments_info.head()}')
-logger.info(f'Minimum segment length: {MIN_SEGMENT_LENGTH_SECONDS} seconds')
-logger.info(f'Segments after filtering: {valid_segments_mask.sum()}/{len(valid_segments_mask)} ({valid_segments_mask.sum()/len(valid_segments_mask)*100:.4f}%)')
-logger.info(f'Total duration of valid segments: {total_valid_duration} (seconds) ({total_valid_duration/total_duration*100:.4f}% of total duration)')
+def resume_boundary(previous_metadata):
+    """Returns the end time of the last valid segment of a previous run, after which an incremental run continues (None if there is none)."""
+    stable_segments_info = stable_segments(previous_metadata)
+    return stable_segments_info['end_time'].iloc[-1] if len(stable_segments_info) else None
 
-# For each valid time segment, create 2 dataframes with "empty" time grids: one with 15second-intervals and one with 1-hour intervals
+def synchronize(df, synchronized_data_dir=None, return_segments=True, previous_metadata=None, full_precision=None):
+    """
+    This function synchronizes the long sensor/weather table onto 15s and 1h time grids within continuous segments (pipeline stage).
 
-# Get unique qids from the dataset and filter by intended sampling interval
-unique_qids = df['qid_mapping'].unique()
-logger.info(f'Unique qids in dataset: {len(unique_qids)}')
+    Args:
+        df: Compact long table (excl. noon reports) with utc_timestamp, qid_mapping, value and time_delta_sec columns, preferably in time order
+            (see long_table.load_long_table(time_ordered=True)), otherwise the observation arrays are ordered here. Modified in place.
+        synchronized_data_dir: If provided, the segments are saved to the synchronized dataset in this directory (checkpoint, see synchronized_store.py).
+        return_segments: If False, the segments are only saved and not collected (saves memory in script mode).
+        previous_metadata: Metadata of a previous run on the same (but shorter) data, see resumable_metadata. If provided,
+            the valid segments of the previous run are kept and only the data after the last of them is segmented and interpolated.
+            df (and full_precision) then only need to hold the observations from resume_boundary(previous_metadata) on.
+        full_precision: Compact long table of the full precision qids with their exact values, if df holds their values as float32
+            (see long_table.load_long_table(full_precision=False)). These qids are interpolated from the exact values.
 
-# Filter qids by their intended sampling interval
-qids_15s = [qid for qid in unique_qids if INTENDED_SAMPLING_INTERVALS_SECONDS.get(qid) == 15]
-qids_1h = [qid for qid in unique_qids if INTENDED_SAMPLING_INTERVALS_SECONDS.get(qid) == 3600]
+    Returns:
+        Tuple of (DataFrame with the segments computed in this run in time order (utc_timestamp, seg_id and one column per qid) or None,
+        metadata dict of all segments).
+    """
+    function_start = time.perf_counter()
+
+    logger.info(f'QIDs in appended data: {df["qid_mapping"].unique()}')
+
+    # find the start and end time of the dataset
+    df_start_time = df['utc_timestamp'].min()
+    df_end_time = df['utc_timestamp'].max()
+    total_duration = df_end_time - df_start_time
+    logger.info(f'Dataset time range: {df_start_time} to {df_end_time} (duration: {total_duration})')
+
+    # If chosen in config file, drop all transducer depth variables (this is way more unreliable and creates a lot of unnecessary time gaps, for a relatively low return in terms of data value)
+    if DROP_TRANDUCER_DEPTH:
+        # Drop rows where qid_mapping is the transducer depth variable (in-place)
+        initial_shape = df.shape
+        df.drop(df[df['qid_mapping'] == '2::0::4::0_1::1::0::2::0_37::0::2::0_8'].index, inplace=True)
+        logger.info(f'Dropped transducer depth variable. Shape: {initial_shape} -> {df.shape}')
+    else:
+        logger.info(f'Keeping transducer depth variable. Variables: {df["qid_mapping"].unique()}')
+
+    n_observations = len(df)
+    n_unique_timestamps = df['utc_timestamp'].nunique()
+
+    # When continuing a previous run, df may only hold the observations from its resume boundary on, so the dataset info continues
+    # the one of the previous run with the observations appended since then (append.py only appends observations newer than the ingested ones)
+    if resume_boundary(previous_metadata) is not None:
+        previous_info = previous_metadata['dataset_info']
+        appended = df['utc_timestamp'] > pd.Timestamp(previous_metadata['ingest']['max_timestamp'], unit='ns', tz='UTC')
+        df_start_time = min(df_start_time, pd.Timestamp(previous_info['start_time'], tz='UTC'))
+        total_duration = df_end_time - df_start_time
+        n_observations = previous_info['total_observations'] + int(appended.sum())
+        n_unique_timestamps = previous_info['unique_timestamps'] + df.loc[appended, 'utc_timestamp'].nunique()
+
+    # Work on the observation arrays in time order from here on. The store is clustered by qid within its part files, so it is read with
+    # time_ordered=True (the runs are merged while reading); other tables are put in time order here (only the four arrays are reordered)
+    qid_mapping = df['qid_mapping'].astype('category')
+    qid_categories = qid_mapping.cat.categories
+    timestamps = timestamps_to_int64(df['utc_timestamp'])
+    qid_codes = qid_mapping.cat.codes.to_numpy()
+    values = df['value'].to_numpy()
+    time_delta_sec = df['time_delta_sec'].to_numpy()
+    order = time_order(timestamps)
+    if order is not None:
+        logger.info('The observations are not in time order, ordering them')
+        timestamps, qid_codes, values, time_delta_sec = timestamps[order], qid_codes[order], values[order], time_delta_sec[order]
+
+    # the exact observations of the full precision qids (in time order, coded like the other observations) replace their float32 ones per segment
+    exact_qids = full_precision_qids(df)
+    exact_arrays = {}
+    if full_precision is not None and len(full_precision):
+        exact_timestamps = timestamps_to_int64(full_precision['utc_timestamp'])
+        exact_order = time_order(exact_timestamps)
+        exact_order = slice(None) if exact_order is None else exact_order
+        exact_arrays = {
+            'exact_timestamp': exact_timestamps[exact_order],
+            'exact_qid_code': pd.Categorical(full_precision['qid_mapping'], categories=qid_categories).codes[exact_order].astype(qid_codes.dtype),
+            'exact_value': full_precision['value'].to_numpy(dtype=np.float64)[exact_order],
+        }
+        logger.info(f'Interpolating {len(exact_qids)} full precision qids from {len(exact_timestamps)} exact observations')
+
+    # In incremental mode only the data after the last valid segment of the previous run is synchronized again.
+    # Gap flags only depend on earlier observations (time_delta_sec) and a segment is interpolated from the observations
+    # between its start and end, so observations appended after a segment do not change it.
+    # The gap ending a segment gets the segment's seg_id, so seg_ids (and the gap count) continue from the last kept segment.
+    stable_segments_info = stable_segments(previous_metadata)
+    seg_id_offset = 0
+    previous_gaps = None
+    if len(stable_segments_info):
+        seg_id_offset = int(stable_segments_info.index[-1])
+        resume_after = resume_boundary(previous_metadata)
+        first_row = np.searchsorted(timestamps, resume_after.value, side='right')
+        timestamps, qid_codes, values, time_delta_sec = timestamps[first_row:], qid_codes[first_row:], values[first_row:], time_delta_sec[first_row:]
+        if synchronized_data_dir is not None:
+            previous_gaps = load_gap_index(synchronized_data_dir)
+            previous_gaps = previous_gaps[previous_gaps['gap_end'] <= resume_after]
+        logger.info(f'Incremental synchronization: keeping {len(stable_segments_info)} segments up to {resume_after}, synchronizing {len(timestamps)} observations after it')
+
+    unique_timestamps = timestamps[np.concatenate([[True], timestamps[1:] != timestamps[:-1]])] if len(timestamps) else timestamps
+
+    logger.info(f'Synchronizing {len(timestamps)} observations')
+    logger.info(f'number of unique time stamps: {len(unique_timestamps)}')
+    logger.info(f'Threshold factor for synchronization: {THRESHOLD_FACTOR}')
+    logger.info(f'distribution of intended sampling intervals: {pd.Series(INTENDED_SAMPLING_INTERVALS_SECONDS).value_counts()}')
+
+    # -- PART 1 -- identify time observations within gaps based on intended sampling intervals and a tolerance threshold
+
+    # Flag as time gap if |Δt_i - Δt_nominal| > (1/2) * Δt_nominal (Dalheim & Steen's method, see time_gaps.py)
+    nominal_dt = nominal_intervals(qid_categories, INTENDED_SAMPLING_INTERVALS_SECONDS)
+    gap_rows = detect_time_gaps(time_delta_sec, qid_codes, nominal_dt, THRESHOLD_FACTOR)
+    gaps = gap_index(timestamps, qid_codes, time_delta_sec, nominal_dt, gap_rows, qid_categories)
+    if previous_gaps is not None:
+        gaps = pd.concat([previous_gaps, gaps], ignore_index=True)
+    if synchronized_data_dir is not None:
+        save_gap_index(gaps, synchronized_data_dir)
+
+    # -- PART 2 -- create continuous windows of unobstructed data
+
+    # A timestamp is a gap if ANY variable has a time jump at that time
+    gap_timestamps = np.unique(timestamps[gap_rows])
+    logger.info(f'Found {len(gap_rows)} gap observations of {len(np.unique(qid_codes[gap_rows]))} qids')
+    logger.info(f'Number of obs marked as time gaps: {len(gap_timestamps)}')
+
+    # every timestamp after a gap starts a new segment, which ends at the next gap
+    segments_info = segments_from_gaps(unique_timestamps, gap_timestamps, seg_id_offset)
+
+    # Filter out segments that are too short (i.e. shorter than the minimum segment length defined in config file)
+    segment_sizes = segments_info['end_time'] - segments_info['start_time']
+    valid_segments_mask = segment_sizes >= pd.Timedelta(seconds=MIN_SEGMENT_LENGTH_SECONDS)
+
+    # Apply the filter to keep only valid segments
+    valid_segments_info = segments_info[valid_segments_mask]
+
+    # calculate the total duration of valid segments
+    total_valid_duration = (valid_segments_info['end_time'] - valid_segments_info['start_time']).sum()
+
+
+    logger.info(f'valid segments info (shape: {valid_segments_info.shape}):\n{valid_segments_info.head()}')
+    logger.info(f'Minimum segment length: {MIN_SEGMENT_LENGTH_SECONDS} seconds')
+    logger.info(f'Segments after filtering: {valid_segments_mask.sum()}/{len(valid_segments_mask)} ({valid_segments_mask.sum()/len(valid_segments_mask)*100:.4f}%)')
+    logger.info(f'Total duration of valid segments: {total_valid_duration} (seconds) ({total_valid_duration/total_duration*100:.4f}% of total duration)')
+
+    # For each valid time segment, the qids are interpolated onto the time grids of their sampling intervals
+
+    # Get unique qids from the dataset and filter by intended sampling interval
+    unique_qids = qid_categories[pd.unique(qid_codes)]
+    logger.info(f'Unique qids in dataset: {len(unique_qids)}')
+
+    # Group the qids by their intended sampling interval (every group is interpolated onto its own time grid)
+    groups = rate_groups(list(unique_qids), qid_categories, INTENDED_SAMPLING_INTERVALS_SECONDS)
+    qids_per_interval = {interval: len(group_qids) for interval, group_qids, _ in groups}
+    for interval, n_qids in qids_per_interval.items():
+        logger.info(f'QIDs with {interval}s sampling interval: {n_qids}')
+
+    # The time grids of a segment are created by the worker processing it (see sync_engine.py)
+    n_grid_points_15s = ((valid_segments_info['end_time'] - valid_segments_info['start_time']) // pd.Timedelta(seconds=15) + 1).sum()
+    logger.info(f'{len(valid_segments_info)} valid segments with {n_grid_points_15s} 15s grid points in total')
+
+    # -- PART 3 -- Linear interpolation for each segment (using multiprocessing)
+
+    # Resolve the row range of every segment by binary search on the sorted timestamps
+    start_rows = np.searchsorted(timestamps, timestamps_to_int64(valid_segments_info['start_time']), side='left')
+    end_rows = np.searchsorted(timestamps, timestamps_to_int64(valid_segments_info['end_time']), side='right')
+
+    logger.info(f'Preparing {len(valid_segments_info)} segments for parallel processing...')
+    segment_args = [
+        (i, int(start_row), int(end_row), {'seg_id': seg_id, 'start_time': segment['start_time'], 'end_time': segment['end_time']})
+        for i, ((seg_id, segment), start_row, end_row) in enumerate(zip(valid_segments_info.iterrows(), start_rows, end_rows))
+    ]
+
+    # Determine number of CPU cores to use (leave one free for system)
+    num_cores = max(1, os.cpu_count() - 1)
+    logger.info(f'Processing {len(segment_args)} segments using {num_cores} CPU cores in parallel')
+
+    # Place the timestamp, qid code and value arrays in shared memory and process the segments in parallel
+    shared_blocks, array_specs = [], {}
+    try:
+        for name, array in [('utc_timestamp', timestamps), ('qid_code', qid_codes), ('value', values)] + list(exact_arrays.items()):
+            shm, array_specs[name] = _to_shared_memory(array)
+            shared_blocks.append(shm)
+        schema = segment_schema([qid for _, group_qids, _ in groups for qid in group_qids], exact_qids)
+        full_precision_codes = qid_categories.get_indexer(exact_qids)
+        collected = [] if return_segments else None
+        with Pool(processes=num_cores, initializer=_init_segment_worker, initargs=(array_specs, groups, schema, full_precision_codes)) as pool:
+            # the segments are written while the workers are still processing later ones (in time order)
+            processed = _processed_segments(pool.imap(process_single_segment, segment_args), segment_args, collected)
+            if synchronized_data_dir is not None:
+                write_segments(synchronized_data_dir, processed, keep_seg_ids=stable_segments_info.index)
+            else:
+                for _ in processed:
+                    pass
+    finally:
+        for shm in shared_blocks:
+            shm.close()
+            shm.unlink()
+
+    logger.info(f'\nFinished processing all {len(segment_args)} segments')
+
+    segments = pa.concat_tables(collected).to_pandas() if return_segments and collected else None
+
+    elapsed_time = time.perf_counter() - function_start
+
+    # Merge the kept segments of the previous run with the new ones
+    all_segments_info = pd.concat([stable_segments_info, valid_segments_info]) if len(stable_segments_info) else valid_segments_info
+    total_valid_duration = (all_segments_info['end_time'] - all_segments_info['start_time']).sum()
+
+    # Calculate segment duration statistics
+    segment_durations = (all_segments_info['end_time'] - all_segments_info['start_time']).dt.total_seconds()
+
+    # Collect all relevant metadata/statistics of the synchronization for later reference
+    metadata = {
+        'dataset_info': {
+            'start_time': df_start_time.strftime('%Y-%m-%d %H:%M:%S'),
+            'end_time': df_end_time.strftime('%Y-%m-%d %H:%M:%S'),
+            'total_duration_seconds': float(total_duration.total_seconds()),
+            'total_observations': int(n_observations),
+            'unique_timestamps': int(n_unique_timestamps),
+        },
+        'configuration': synchronization_configuration(),
+        'variables': {
+            'total_unique_qids': int(len(unique_qids)),
+            'qids_15s_count': int(qids_per_interval.get(15, 0)),
+            'qids_1h_count': int(qids_per_interval.get(3600, 0)),
+            'qids_per_sampling_interval': {str(interval): int(n_qids) for interval, n_qids in qids_per_interval.items()},
+            'intended_sampling_intervals_distribution': {k: int(v) for k, v in pd.Series(INTENDED_SAMPLING_INTERVALS_SECONDS).value_counts().to_dict().items()},
+        },
+        'segmentation': {
+            'number_of_time_gaps': int(seg_id_offset + len(gap_timestamps)),
+            'segments_before_filtering': int(seg_id_offset + len(valid_segments_mask)),
+            'segments_after_filtering': int(len(all_segments_info)),
+            'total_valid_duration_seconds': float(total_valid_duration.total_seconds()),
+            'valid_duration_percentage': float(total_valid_duration / total_duration * 100),
+            'segment_duration_stats': {
+                'min_seconds': float(segment_durations.min()),
+                'max_seconds': float(segment_durations.max()),
+                'mean_seconds': float(segment_durations.mean()),
+                'median_seconds': float(segment_durations.median()),
+            },
+        },
+        'execution': {
+            'elapsed_time_seconds': float(elapsed_time),
+            'segments_saved': int(len(valid_segments_info)),
+            'segments_reused': int(len(stable_segments_info)),
+        },
+        'valid_segments_info': all_segments_info.assign(
+            start_time=all_segments_info['start_time'].dt.strftime('%Y-%m-%d %H:%M:%S'),
+            end_time=all_segments_info['end_time'].dt.strftime('%Y-%m-%d %H:%M:%S')
+        ).rename_axis('seg_id').reset_index().to_dict(orient='records'),
+    }
 
-logger.info(f'QIDs with 15s sampling interval: {len(qids_15s)}')
-logger.info(f'QIDs with 1h sampling interval: {len(qids_1h)}')
+    return segments, metadata
 
-# Pre-define column order for reindexing
-all_columns_15s = ['utc_timestamp', 'seg_id'] + list(qids_15s)
-all_columns_1h = ['utc_timestamp', 'seg_id'] + list(qids_1h)
+def save_synchronization_metadata(metadata, sync_output_dir, run_id):
+    """Saves the synchronization metadata to a json file in sync_output_dir."""
+    # create output directory if it doesnt already exist
+    if not os.path.exists(sync_output_dir):
+        os.makedirs(sync_output_dir)
+    else:
+        logger.info(f'synchronized data directory already exists: {sync_output_dir}')
+
+    metadata_filepath = os.path.join(sync_output_dir, f'synchronization_metadata_{run_id}.json')
+    with open(metadata_filepath, 'w') as f:
+        json.dump(metadata, f, indent=2)
+    logger.info(f'Saved metadata to: {metadata_filepath}')
+
+
+def latest_synchronization_metadata(sync_output_dir):
+    """Loads the most recently saved synchronization metadata. Returns None if there is none."""
+    metadata_files = glob.glob(os.path.join(sync_output_dir, 'synchronization_metadata_*.json'))
+    if not metadata_files:
+        return None
+    with open(max(metadata_files, key=os.path.getmtime)) as f:
+        return json.load(f)
+
+def ingest_state(long_table_dir):
+    """Returns the raw files (with their hashes) and the newest timestamp of the sensor ingest manifest, stored with the metadata of a run."""
+    manifest = load_manifest(os.path.join(long_table_dir, SENSOR_MANIFEST_NAME))
+    if manifest is None:
+        return None
+    return {
+        'files': {key: file['sha256'] for key, file in manifest['files'].items()},
+        'max_timestamp': manifest['max_timestamp'],
+    }
 
-# Define function to process a single segment (for multiprocessing)
-def process_single_segment(args):
+def resumable_metadata(previous_metadata, current_ingest_state, synchronized_data_dir):
     """
-    Process a single segment with interpolation and saving.
-    
+    This function checks if a previous run can be continued incrementally.
+    That is the case if the data only grew by appended raw files since that run (append.py only appends
+    observations newer than the ingested ones), the configuration and this script did not change, and the segments of that run are still stored.
+
     Args:
-        args: Tuple containing (i, grid_15s, grid_1h, seg_info, df_segment_data, 
-                                 qids_15s, qids_1h, all_columns_15s, all_columns_1h, synchronized_data_dir)
-    
+        previous_metadata: Metadata of the previous run (see latest_synchronization_metadata).
+        current_ingest_state: Current ingest state (see ingest_state).
+        synchronized_data_dir: Directory of the synchronized dataset.
+
     Returns:
-        Tuple of (segment_index, seg_id, shape, filepath)
+        The previous metadata if the run can be continued, otherwise None.
     """
-    i, grid_15s, grid_1h, seg_info, df_segment_data, qids_15s, qids_1h, all_columns_15s, all_columns_1h, synchronized_data_dir = args
-    
-    seg_id = seg_info['seg_id']
-    seg_start_time = seg_info['start_time']
-    seg_end_time = seg_info['end_time']
-    seg_duration = seg_end_time - seg_start_time
-    
-    # -- 15s interpolation --
-    
-    # Filter segment data to only 15s qids
-    df_segment_15s = df_segment_data[df_segment_data['qid_mapping'].isin(qids_15s)]
-    
-    # Pivot the segment data so each qid is a column with timestamp as index
-    if df_segment_15s.duplicated(subset=['utc_timestamp', 'qid_mapping']).any():
-        pivot_15s = df_segment_15s.pivot_table(
-            index='utc_timestamp', columns='qid_mapping', values='value', aggfunc='first')
-    else:
-        pivot_15s = df_segment_15s.pivot(
-            index='utc_timestamp', columns='qid_mapping', values='value')
-    
-    # Combine actual observation timestamps with the grid, interpolate, extract grid points
-    combined_15s = pivot_15s.reindex(pivot_15s.index.union(grid_15s['utc_timestamp'])).sort_index()
-    combined_15s.interpolate(method='linear', limit_area='inside', inplace=True)
-    combined_15s = (
-        combined_15s
-        .loc[grid_15s['utc_timestamp']]
-        .reset_index()
-        .assign(seg_id=seg_id)
-        .reindex(columns=all_columns_15s)
-    )
-    
-    # -- 1h interpolation --
-    
-    # Filter segment data to only 1h qids
-    df_segment_1h = df_segment_data[df_segment_data['qid_mapping'].isin(qids_1h)]
-    
-    # Pivot the segment data so each qid is a column with timestamp as index
-    if df_segment_1h.duplicated(subset=['utc_timestamp', 'qid_mapping']).any():
-        pivot_1h = df_segment_1h.pivot_table(
-            index='utc_timestamp', columns='qid_mapping', values='value', aggfunc='first')
-    else:
-        pivot_1h = df_segment_1h.pivot(
-            index='utc_timestamp', columns='qid_mapping', values='value')
-    
-    # Combine actual observation timestamps with the grid, interpolate, extract grid points
-    combined_1h = pivot_1h.reindex(pivot_1h.index.union(grid_1h['utc_timestamp'])).sort_index()
-    combined_1h.interpolate(method='linear', limit_area='inside', inplace=True)
-    combined_1h = (
-        combined_1h
-        .loc[grid_1h['utc_timestamp']]
-        .reset_index()
-        .assign(seg_id=seg_id)
-        .reindex(columns=all_columns_1h)
-    )
-    
-    # -- Combine 15s and 1h dataframes into one segment dataframe --
-    
-    df_segment_combined = pd.merge(
-        combined_15s,
-        combined_1h,
-        on=['utc_timestamp', 'seg_id'],
-        how='outer'
-    )
-
-    # Save the combined segment dataframe
-    start_str = seg_start_time.strftime('%Y-%m-%d_%H-%M-%S')
-    end_str = seg_end_time.strftime('%Y-%m-%d_%H-%M-%S')
-    segment_filepath = os.path.join(synchronized_data_dir, f'synced_{start_str}_to_{end_str}.csv')
-    df_segment_combined.to_csv(segment_filepath, index=False)
-    
-    return i, seg_id, df_segment_combined.shape, segment_filepath
-
-valid_segment_dataframes = []
-
-for seg_id, segment in valid_segments_info.iterrows():
-    start_time = segment['start_time']
-    end_time = segment['end_time']
-    
-    # Create a time grid with 15-second intervals
-    time_grid_15s = pd.date_range(start=start_time, end=end_time, freq='15s')
-    df_15s = pd.DataFrame({'utc_timestamp': time_grid_15s, 'seg_id': seg_id})
-    df_15s = df_15s.reindex(columns=all_columns_15s, fill_value=np.nan)
-    
-    # Create a time grid with 1-hour intervals
-    time_grid_1h = pd.date_range(start=start_time, end=end_time, freq='1h')
-    df_1h = pd.DataFrame({'utc_timestamp': time_grid_1h, 'seg_id': seg_id})
-    df_1h = df_1h.reindex(columns=all_columns_1h, fill_value=np.nan)
-    
-    valid_segment_dataframes.append((df_15s, df_1h))
-
-# Check that there is the right amount of dataframes and that the time grids are correct
-logger.info(f'Created {len(valid_segment_dataframes)} valid segment dataframes with 15s and 1h time grids. shapes of list items: {[ (df_15s.shape, df_1h.shape) for df_15s, df_1h in valid_segment_dataframes[:5] ]}')
-
-# check that the date format is correct (utc timestamps should be in datetime format)
-logger.info(f'utc_timestamp column data type in first 15s and 1h dataframe: {valid_segment_dataframes[0][0]["utc_timestamp"].dtype} and {valid_segment_dataframes[0][1]["utc_timestamp"].dtype}')
-
-# -- PART 3 -- Linear interpolation for each segment (using multiprocessing)
-
-# Prepare arguments for parallel processing
-logger.info(f'Preparing {len(valid_segment_dataframes)} segments for parallel processing...')
-
-segment_args = []
-for i, (grid_15s, grid_1h) in enumerate(valid_segment_dataframes):
-    seg_id = grid_15s['seg_id'].iloc[0]
-    seg_start_time = valid_segments_info.loc[seg_id, 'start_time']
-    seg_end_time = valid_segments_info.loc[seg_id, 'end_time']
-    
-    # Pre-filter the main dataframe for this segment's time range to reduce memory overhead
-    df_segment_data = df.query(
-        'utc_timestamp >= @seg_start_time and utc_timestamp <= @seg_end_time'
-    ).copy()
-    
-    seg_info = {
-        'seg_id': seg_id,
-        'start_time': seg_start_time,
-        'end_time': seg_end_time
-    }
-    
-    segment_args.append((
-        i, grid_15s.copy(), grid_1h.copy(), seg_info, df_segment_data,
-        qids_15s, qids_1h, all_columns_15s, all_columns_1h, synchronized_data_dir
-    ))
-
-# Determine number of CPU cores to use (leave one free for system)
-num_cores = max(1, os.cpu_count() - 1)
-logger.info(f'Processing {len(segment_args)} segments using {num_cores} CPU cores in parallel')
-
-# Process segments in parallel
-with Pool(processes=num_cores) as pool:
-    results = pool.map(process_single_segment, segment_args)
-
-# Log results
-for i, seg_id, shape, filepath in results:
-    logger.info(f'Segment {i+1}/{len(results)} (ID: {seg_id}): shape {shape}, saved to {os.path.basename(filepath)}')
-
-logger.info(f'\nFinished processing all {len(results)} segments')
-
-
-script_end = time.perf_counter()
-elapsed_time = script_end - script_start
-
-# Calculate segment duration statistics
-segment_durations = (valid_segments_info['end_time'] - valid_segments_info['start_time']).dt.total_seconds()
-
-# Save all relevant metadata/statistics that has been collected during synchronization to a json file for later reference
-metadata = {
-    'dataset_info': {
-        'start_time': df_start_time.strftime('%Y-%m-%d %H:%M:%S'),
-        'end_time': df_end_time.strftime('%Y-%m-%d %H:%M:%S'),
-        'total_duration_seconds': float(total_duration.total_seconds()),
-        'total_observations': int(len(df)),
-        'unique_timestamps': int(df['utc_timestamp'].nunique()),
-    },
-    'configuration': {
-        'tolerance_factor': float(THRESHOLD_FACTOR),
-        'min_segment_length_seconds': int(MIN_SEGMENT_LENGTH_SECONDS),
-        'drop_transducer_depth': bool(DROP_TRANDUCER_DEPTH),
-    },
-    'variables': {
-        'total_unique_qids': int(len(unique_qids)),
-        'qids_15s_count': int(len(qids_15s)),
-        'qids_1h_count': int(len(qids_1h)),
-        'intended_sampling_intervals_distribution': {k: int(v) for k, v in pd.Series(INTENDED_SAMPLING_INTERVALS_SECONDS).value_counts().to_dict().items()},
-    },
-    'segmentation': {
-        'number_of_time_gaps': int(time_gap_mask.sum()),
-        'segments_before_filtering': int(len(valid_segments_mask)),
-        'segments_after_filtering': int(valid_segments_mask.sum()),
-        'total_valid_duration_seconds': float(total_valid_duration.total_seconds()),
-        'valid_duration_percentage': float(total_valid_duration / total_duration * 100),
-        'segment_duration_stats': {
-            'min_seconds': float(segment_durations.min()),
-            'max_seconds': float(segment_durations.max()),
-            'mean_seconds': float(segment_durations.mean()),
-            'median_seconds': float(segment_durations.median()),
-        },
-    },
-    'execution': {
-        'elapsed_time_seconds': float(elapsed_time),
-        'segments_saved': int(len(valid_segment_dataframes)),
-    },
-    'valid_segments_info': valid_segments_info.assign(
-        start_time=valid_segments_info['start_time'].dt.strftime('%Y-%m-%d %H:%M:%S'),
-        end_time=valid_segments_info['end_time'].dt.strftime('%Y-%m-%d %H:%M:%S')
-    ).to_dict(orient='records'),
-}
-
-# save metadata to json file
-metadata_filepath = os.path.join(sync_output_dir, f'synchronization_metadata_{script_start}.json') # script start time is close enough
-with open(metadata_filepath, 'w') as f:
-    json.dump(metadata, f, indent=2)
-logger.info(f'Saved metadata to: {metadata_filepath}')
-
-logger.info(f'Total synchronization time: {elapsed_time:.2f} seconds')
\ No newline at end of file
+    if previous_metadata is None or current_ingest_state is None:
+        logger.info('No previous synchronization run or ingest manifest found, synchronizing everything')
+        return None
+    previous_ingest_state = previous_metadata.get('ingest')
+    if previous_ingest_state is None or any('seg_id' not in segment for segment in previous_metadata['valid_segments_info']):
+        logger.info('The previous synchronization metadata has no ingest state or segment ids, synchronizing everything')
+        return None
+    if previous_metadata['configuration'] != synchronization_configuration():
+        logger.info('The synchronization configuration or code changed since the previous run, synchronizing everything')
+        return None
+    changed_files = [key for key, sha256 in previous_ingest_state['files'].items() if current_ingest_state['files'].get(key) != sha256]
+    if changed_files:
+        logger.info(f'{len(changed_files)} raw file(s) were changed or removed since the previous run, synchronizing everything')
+        return None
+    if load_gap_index(synchronized_data_dir) is None:
+        logger.info('The gap index of the previous run is missing, synchronizing everything')
+        return None
+    stored_seg_ids = {entry['seg_id'] for entry in load_segment_index(synchronized_data_dir)}
+    missing_segments = [seg_id for seg_id in stable_segments(previous_metadata).index if seg_id not in stored_seg_ids]
+    if missing_segments:
+        logger.info(f'{len(missing_segments)} segment(s) of the previous run are missing in the synchronized dataset, synchronizing everything')
+        return None
+    return previous_metadata
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Synchronizes the appended sensor data onto time grids within continuous segments. By default, only the data after the segments of the previous run is synchronized if the data was only appended to since then.')
+    parser.add_argument('--full', action='store_true', help='synchronize all data instead of continuing the previous run')
+    args = parser.parse_args()
+
+    script_start = time.perf_counter()
+
+    # continue the previous run if only new data was appended since then
+    current_ingest_state = ingest_state(long_table_dir)
+    previous_metadata = None if args.full else resumable_metadata(latest_synchronization_metadata(sync_output_dir), current_ingest_state, synchronized_data_dir)
+    if previous_metadata is not None and previous_metadata['ingest']['max_timestamp'] == current_ingest_state['max_timestamp']:
+        logger.info('No new observations since the previous synchronization run, nothing to do')
+        sys.exit(0)
+
+    # load the appended dataframe (excl. noon reports) with float32 values, and the exact values of the full precision qids separately.
+    # When continuing the previous run, only the observations from the end of its last valid segment on are read (pushed down to the
+    # month partitions and row groups of the store), the older ones are not needed
+    catalog = load_catalog()
+    start = resume_boundary(previous_metadata)
+    df = load_long_table(long_table_dir, catalog, exclude_qid_prefixes=[NOON_REPORT_QID_PREFIX], start=start, time_ordered=True, full_precision=False)
+    exact_qids = full_precision_qids(catalog)
+    full_precision = load_long_table(long_table_dir, catalog, exclude_qid_prefixes=[NOON_REPORT_QID_PREFIX], qids=exact_qids, start=start, time_ordered=True) if exact_qids else None
+
+    _, metadata = synchronize(df, synchronized_data_dir=synchronized_data_dir, return_segments=False, previous_metadata=previous_metadata, full_precision=full_precision)
+    metadata['ingest'] = current_ingest_state
+
+    # save metadata to json file
+    save_synchronization_metadata(metadata, sync_output_dir, script_start) # script start time is close enough
+
+    elapsed_time = time.perf_counter() - script_start
+    logger.info(f'Total synchronization time: {elapsed_time:.2f} seconds')
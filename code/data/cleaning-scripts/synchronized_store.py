@@ -0,0 +1,173 @@
+import os
+import json
+import shutil
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from loguru import logger
+
+# Columnar storage of the synchronized segments (utc_timestamp, seg_id and one column per qid).
+# All segments are stored in one parquet dataset, partitioned by the month of the segment start:
+#
+#   synchronized/month=2024-01/segments.parquet      one row group per segment, in time order
+#   synchronized/_segment_index.json                 segment offset index
+#   synchronized/_gap_index.parquet                  gap index (see time_gaps.py)
+#
+# The segment offset index lists every segment in time order:
+#   {"seg_id": ..., "start_time": ..., "end_time": ..., "file": "month=2024-01/segments.parquet", "row_group": 3, "row_offset": 51840, "rows": 2160}
+# so all segments or any subset of them can be read with one bulk read of the matching row groups.
+
+SEGMENT_INDEX_NAME = '_segment_index.json'
+SEGMENT_FILE_NAME = 'segments.parquet'
+
+
+def segment_month(start_time):
+    """Returns the month partition key ('YYYY-MM') of a segment."""
+    return start_time.strftime('%Y-%m')
+
+
+def segment_schema(qid_columns, full_precision_qids=()):
+    """Returns the arrow schema of the synchronized segments (float32 qid columns like the long table values, float64 for the full precision qids)."""
+    full_precision_qids = set(full_precision_qids)
+    return pa.schema(
+        [('utc_timestamp', pa.timestamp('ns', tz='UTC')), ('seg_id', pa.int64())]
+        + [(qid, pa.float64() if qid in full_precision_qids else pa.float32()) for qid in qid_columns]
+    )
+
+
+def load_segment_index(synchronized_dir):
+    """Loads the segment offset index. Returns an empty list if there is none."""
+    index_path = os.path.join(synchronized_dir, SEGMENT_INDEX_NAME)
+    if not os.path.isfile(index_path):
+        return []
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def _save_segment_index(segment_index, synchronized_dir):
+    """Writes the segment offset index atomically."""
+    index_path = os.path.join(synchronized_dir, SEGMENT_INDEX_NAME)
+    tmp_path = f'{index_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(segment_index, f, indent=2)
+    os.replace(tmp_path, index_path)
+
+
+def _align(table, schema):
+    """Casts a segment table to the schema of a month file (qid columns missing in the table are added as nulls)."""
+    columns = [
+        table.column(field.name).cast(field.type) if field.name in table.column_names else pa.nulls(len(table), field.type)
+        for field in schema
+    ]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def write_segments(synchronized_dir, segment_tables, keep_seg_ids=()):
+    """
+    This function writes the synchronized segments to the partitioned dataset and updates the segment offset index.
+    Kept segments of the previous run stay where they are; a month file that contains kept and new segments is rewritten.
+    All other files in synchronized_dir (stale months, per-segment csv files of older versions) are removed,
+    except for index files starting with '_'.
+
+    Args:
+        synchronized_dir: Root directory of the synchronized dataset.
+        segment_tables: Iterable of (seg_id, start_time, end_time, arrow table) in time order (all after the kept segments).
+        keep_seg_ids: seg_ids of the previous run to keep.
+
+    Returns:
+        The segment offset index.
+    """
+    os.makedirs(synchronized_dir, exist_ok=True)
+    keep_seg_ids = set(keep_seg_ids)
+    kept = [entry for entry in load_segment_index(synchronized_dir) if entry['seg_id'] in keep_seg_ids]
+    kept_months = {entry['file'] for entry in kept}
+
+    segment_index = list(kept)
+    writer, month_file, month_schema, row_group, row_offset = None, None, None, 0, 0
+    written_files = set()
+
+    def close_month():
+        if writer is not None:
+            writer.close()
+            os.replace(os.path.join(synchronized_dir, f'{month_file}.tmp'), os.path.join(synchronized_dir, month_file))
+
+    for seg_id, start_time, end_time, table in segment_tables:
+        file = f'month={segment_month(start_time)}/{SEGMENT_FILE_NAME}'
+        if file != month_file:
+            close_month()
+            month_file, month_schema, row_group, row_offset = file, table.schema, 0, 0
+            os.makedirs(os.path.join(synchronized_dir, os.path.dirname(file)), exist_ok=True)
+
+            # the kept segments of this month are copied into the rewritten file first
+            kept_in_month = [entry for entry in segment_index if entry['file'] == file]
+            kept_table = None
+            if kept_in_month:
+                kept_table = pq.ParquetFile(os.path.join(synchronized_dir, file)).read_row_groups([entry['row_group'] for entry in kept_in_month])
+                month_schema = pa.unify_schemas([kept_table.schema, table.schema], promote_options='permissive')
+            writer = pq.ParquetWriter(os.path.join(synchronized_dir, f'{file}.tmp'), month_schema)
+            kept_offset = 0
+            for entry in kept_in_month:
+                writer.write_table(_align(kept_table.slice(kept_offset, entry['rows']), month_schema), row_group_size=max(entry['rows'], 1))
+                kept_offset += entry['rows']
+                entry.update(row_group=row_group, row_offset=row_offset)
+                row_group, row_offset = row_group + 1, row_offset + entry['rows']
+            written_files.add(file)
+
+        writer.write_table(_align(table, month_schema), row_group_size=max(len(table), 1))
+        segment_index.append({
+            'seg_id': int(seg_id),
+            'start_time': start_time.isoformat(),
+            'end_time': end_time.isoformat(),
+            'file': file,
+            'row_group': row_group,
+            'row_offset': row_offset,
+            'rows': len(table),
+        })
+        row_group, row_offset = row_group + 1, row_offset + len(table)
+    close_month()
+
+    # remove everything that is not part of the dataset anymore
+    valid_files = kept_months | written_files
+    for name in os.listdir(synchronized_dir):
+        path = os.path.join(synchronized_dir, name)
+        if name.startswith('_'):
+            continue  # index files (segment index, gap index)
+        if os.path.isdir(path) and f'{name}/{SEGMENT_FILE_NAME}' not in valid_files:
+            shutil.rmtree(path)
+        elif os.path.isfile(path):
+            os.unlink(path)
+
+    _save_segment_index(segment_index, synchronized_dir)
+    logger.info(f'Wrote {len(segment_index) - len(kept)} segment(s) and kept {len(kept)} segment(s) in {len(valid_files)} month file(s) in {synchronized_dir}')
+    return segment_index
+
+
+def read_synchronized_data(synchronized_dir, seg_ids=None, n_segments=None):
+    """
+    This function reads all synchronized segments or a subset of them in one bulk read.
+
+    Args:
+        synchronized_dir: Root directory of the synchronized dataset.
+        seg_ids: If provided, only these segments are read.
+        n_segments: If provided, only the first n segments are read (for faster testing).
+
+    Returns:
+        DataFrame with the segments in time order (utc_timestamp, seg_id and one column per qid).
+    """
+    segment_index = load_segment_index(synchronized_dir)
+    if seg_ids is not None:
+        seg_ids = set(seg_ids)
+        segment_index = [entry for entry in segment_index if entry['seg_id'] in seg_ids]
+    if n_segments is not None:
+        segment_index = segment_index[:n_segments]
+
+    row_groups = {}
+    for entry in segment_index:
+        row_groups.setdefault(entry['file'], []).append(entry['row_group'])
+    tables = [pq.ParquetFile(os.path.join(synchronized_dir, file)).read_row_groups(groups) for file, groups in row_groups.items()]
+    if not tables:
+        return pd.DataFrame(columns=['utc_timestamp', 'seg_id'])
+
+    df = pa.concat_tables(tables, promote_options='permissive').to_pandas()
+    logger.info(f'Read {len(segment_index)} segment(s) with shape {df.shape} from {synchronized_dir}')
+    return df
@@ -0,0 +1,39 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+# the cleaning scripts are flat modules that import each other (and config.py) by name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# seg_id per row of the segment-aware engines (rolling stds, spikes): segments of one and two rows, and segments whose rows are not
+# contiguous in the frame (the pandas references group by seg_id, so they do not depend on the row order)
+SEGMENT_LAYOUTS = {
+    'contiguous': [0] * 12 + [1] + [2] * 2 + [3] * 9,
+    'lengths 1 and 2': [0, 1, 1, 2, 3, 3, 4],
+    'not contiguous': [2, 0, 2, 1, 0, 0, 2, 1, 1, 2, 0, 3, 2, 0, 1, 2, 0, 2],
+    'one segment': [5] * 15,
+}
+
+
+def make_segment_frame(seg_ids, columns, seed=0, nan_share=0.2, shuffle_index=False):
+    """
+    This function builds a frame of sensor columns with a seg_id column for the engine tests.
+
+    Args:
+        seg_ids: seg_id per row (e.g. one of SEGMENT_LAYOUTS).
+        columns: Dictionary of column name -> function(rng, n_rows) returning the values of the column.
+        seed: Seed of the generator.
+        nan_share: Share of missing values per column.
+        shuffle_index: Use a shuffled index that does not start at 0 (the engines have to keep the index of the frame).
+
+    Returns:
+        DataFrame with the seg_id column and the sensor columns.
+    """
+    rng = np.random.default_rng(seed)
+    n_rows = len(seg_ids)
+    df = pd.DataFrame({'seg_id': seg_ids, **{col: values(rng, n_rows) for col, values in columns.items()}},
+                      index=rng.permutation(n_rows) + 100 if shuffle_index else None)
+    for col in columns:
+        df.loc[rng.random(n_rows) < nan_share, col] = np.nan
+    return df
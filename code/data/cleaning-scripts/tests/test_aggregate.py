@@ -0,0 +1,173 @@
+import numpy as np
+import pandas as pd
+import pytest
+from aggregate import asof_attach_vars, base_window_length, join_long_vars_asof, roll_up_statistics, window_statistics, windows_from_statistics
+from config import WINDOW_LABEL, WINDOW_SIDE
+from long_table import parse_numeric_values
+
+# The windows are aggregated from sufficient statistics computed with built-in groupby reductions. They have to match the former
+# g.agg with Python callables per (seg_id, window) group: the circular mean of the angles and the sum of the positive counter increments.
+
+METHODS = {'speed': 'mean', 'angle': 'circular_mean', 'counter': 'counter_increase', 'power': 'max', 'load': 'min', 'fuel': 'sum', 'flag': 'count'}
+
+
+def circular_mean_deg(x):
+    x = pd.Series(x).dropna().to_numpy(dtype=float)
+    if x.size == 0:
+        return np.nan
+    r = np.deg2rad(x)
+    return np.rad2deg(np.arctan2(np.mean(np.sin(r)), np.mean(np.cos(r)))) % 360.0
+
+
+def counter_increase(x):
+    x = pd.Series(x).dropna()
+    if len(x) < 2:
+        return np.nan
+    d = x.diff()
+    return d[d > 0].sum()
+
+
+REFERENCE_METHODS = {**METHODS, 'angle': circular_mean_deg, 'counter': counter_increase}
+
+
+def make_filtered_frame(seed=0, n_segments=4):
+    """15s filtered data of a few segments (with gaps between them), angles around north, a counter with resets and NaNs in every column."""
+    rng = np.random.default_rng(seed)
+    frames = []
+    start = pd.Timestamp('2024-03-01 00:07:30', tz='UTC')
+    for seg_id in range(n_segments):
+        n_rows = int(rng.integers(1, 900))
+        keep = rng.random(n_rows) > 0.1  # rows removed by the cleaning
+        frames.append(pd.DataFrame({
+            'seg_id': seg_id * 2 + 1,
+            'utc_timestamp': start + pd.to_timedelta(np.arange(n_rows) * 15, unit='s'),
+            'speed': rng.normal(12, 1, n_rows),
+            'angle': (rng.normal(0, 20, n_rows)) % 360,
+            'counter': np.cumsum(rng.uniform(0, 10, n_rows)) * np.where(np.arange(n_rows) < n_rows // 2, 1, 0.5),  # reset halfway
+            'power': rng.normal(5000, 100, n_rows),
+            'load': rng.uniform(0, 100, n_rows),
+            'fuel': rng.uniform(0, 1, n_rows),
+            'flag': rng.choice([0.0, 1.0], n_rows),
+        })[keep])
+        start += pd.Timedelta(seconds=n_rows * 15) + pd.Timedelta(minutes=int(rng.integers(1, 90)))
+    df = pd.concat(frames, ignore_index=True)
+    df['utc_timestamp'] = df['utc_timestamp'].dt.as_unit('ns')  # like the filtered data read by aggregate.py
+    for col in METHODS:
+        df.loc[rng.random(len(df)) < 0.15, col] = np.nan
+    return df
+
+
+def reference_windows(df, window_length):
+    keys = ['seg_id', pd.Grouper(key='utc_timestamp', freq=window_length, label=WINDOW_LABEL, closed=WINDOW_SIDE)]
+    g = df.groupby(keys)
+    out = g.agg(REFERENCE_METHODS)
+    out['n_obs'] = g.size()
+    return out
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('window_length', ['5min', '15min', '1h'])
+def test_window_aggregation_matches_python_callables(seed, window_length):
+    df = make_filtered_frame(seed)
+    windows = windows_from_statistics(window_statistics(df, METHODS, window_length), METHODS)
+    expected = reference_windows(df, window_length)
+    pd.testing.assert_frame_equal(windows, expected, check_dtype=False, check_names=False)
+
+
+def test_circular_mean_wraps_around_north():
+    df = pd.DataFrame({'seg_id': 1, 'utc_timestamp': pd.Timestamp('2024-03-01', tz='UTC') + pd.to_timedelta([0, 15, 30, 45], unit='s'),
+                       'angle': [350.0, 10.0, np.nan, 0.0]})
+    windows = windows_from_statistics(window_statistics(df, {'angle': 'circular_mean'}, '15min'), {'angle': 'circular_mean'})
+    angle = windows['angle'].iloc[0]
+    assert min(angle, 360.0 - angle) == pytest.approx(0.0, abs=1e-9)  # not the arithmetic mean 120
+
+
+# Every output resolution is rolled up from the statistics of the base windows, so it has to match aggregating the filtered data directly
+@pytest.mark.parametrize('window_lengths', [['5min', '15min', '1h'], ['10min', '15min', '2h'], ['1h', '3h'], ['15min']])
+def test_rolled_up_windows_match_direct_aggregation(window_lengths):
+    df = make_filtered_frame(seed=4, n_segments=6)
+    base_length = base_window_length(window_lengths)
+    base_statistics = window_statistics(df, METHODS, base_length)
+    for window_length in window_lengths:
+        windows = windows_from_statistics(roll_up_statistics(base_statistics, METHODS, base_length, window_length), METHODS)
+        pd.testing.assert_frame_equal(windows, reference_windows(df, window_length), check_dtype=False, check_names=False, obj=window_length)
+
+
+def test_base_window_length():
+    assert pd.Timedelta(base_window_length(['5min', '15min', '1h'])) == pd.Timedelta('5min')
+    assert pd.Timedelta(base_window_length(['10min', '15min'])) == pd.Timedelta('5min')
+    assert pd.Timedelta(base_window_length(['1h', '1D'])) == pd.Timedelta('1h')
+    assert pd.Timedelta(base_window_length(['2h', '3h'])) == pd.Timedelta('1h')
+    with pytest.raises(ValueError, match='must divide a day'):
+        base_window_length(['15min', '7h'])
+
+
+# The weather and noon report variables are attached with one as-of join of the pivoted variables. This has to match the former
+# merge_asof per variable, also when a variable (or all of them) has no rows in the long table.
+VARS = ['wind (MB)', 'wave (S)', 'draft (Noon Report)', 'absent (MB)']
+
+
+def reference_join_long_vars_asof(out_df, long_df, vars_full, tolerance):
+    out2 = out_df.copy()
+    out2['window_start'] = pd.to_datetime(out2['window_start'], utc=True)
+    out2 = out2.sort_values('window_start')
+    long2 = long_df.copy()
+    long2['value'] = parse_numeric_values(long2['value'])
+    long2 = long2.sort_values('utc_timestamp')
+    for v in vars_full:
+        tmp = long2.loc[long2['var_full'] == v, ['utc_timestamp', 'value']].dropna()
+        if tmp.empty:
+            out2[v] = np.nan
+            continue
+        tmp = tmp.groupby('utc_timestamp', as_index=False)['value'].mean().rename(columns={'value': v})
+        out2 = pd.merge_asof(out2, tmp, left_on='window_start', right_on='utc_timestamp', direction='backward',
+                             tolerance=pd.Timedelta(tolerance)).drop(columns=['utc_timestamp'])
+    return out2
+
+
+def reference_asof_attach_vars(out_df, long_df, vars_full, tolerance):
+    out2 = out_df.copy()
+    out2['window_start'] = pd.to_datetime(out2['window_start'], utc=True)
+    out2 = out2.sort_values('window_start')
+    long2 = long_df.sort_values('utc_timestamp')
+    for v in vars_full:
+        tmp = long2.loc[long2['var_full'].eq(v), ['utc_timestamp', 'value']].dropna().groupby('utc_timestamp', as_index=False)['value'].mean()
+        new = pd.merge_asof(out2[['window_start']], tmp, left_on='window_start', right_on='utc_timestamp', direction='backward',
+                            tolerance=pd.Timedelta(tolerance))['value'].to_numpy() if len(tmp) else np.nan
+        out2[v] = out2[v].combine_first(pd.Series(new, index=out2.index)) if v in out2.columns else new
+    return out2.reset_index(drop=True)
+
+
+def make_windows_and_long_table(seed=0):
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp('2024-03-01', tz='UTC')
+    window_start = start + pd.to_timedelta(np.sort(rng.choice(np.arange(0, 4 * 24 * 60, 15), 150, replace=False)), unit='min')
+    out = pd.DataFrame({'seg_id': np.arange(150) // 40, 'window_start': window_start, 'speed': rng.normal(12, 1, 150)}).sample(frac=1, random_state=seed)
+    out['wave (S)'] = np.where(rng.random(150) < 0.5, rng.normal(2, 0.5, 150), np.nan)  # already joined for some windows
+    n_rows = 300
+    long_df = pd.DataFrame({
+        'utc_timestamp': start + pd.to_timedelta(rng.integers(0, 4 * 24 * 60, n_rows), unit='min').floor('h'),  # duplicated times
+        'var_full': rng.choice(VARS[:3], n_rows),
+        'value': rng.normal(5, 2, n_rows).round(2).astype(object),
+    })
+    long_df.loc[long_df['var_full'] == 'draft (Noon Report)', 'value'] = [f'm:  {v}' for v in long_df.loc[long_df['var_full'] == 'draft (Noon Report)', 'value']]
+    long_df.loc[rng.random(n_rows) < 0.1, 'value'] = None
+    return out, long_df
+
+
+@pytest.mark.parametrize('long_rows', ['all', 'one variable', 'none'])
+def test_asof_joins_match_merge_asof_per_variable(long_rows):
+    out, long_df = make_windows_and_long_table()
+    if long_rows == 'one variable':
+        long_df = long_df[long_df['var_full'] == 'wind (MB)']
+    elif long_rows == 'none':
+        long_df = long_df.iloc[:0]
+
+    for tolerance in ['1h', '24h']:
+        joined = join_long_vars_asof(out, long_df, VARS, tolerance=tolerance)
+        pd.testing.assert_frame_equal(joined, reference_join_long_vars_asof(out, long_df, VARS, tolerance), check_dtype=False)
+        # the noon report values are parsed before they are attached (see prep_long_noon_table)
+        parsed = long_df.assign(value=parse_numeric_values(long_df['value']))
+        attached = asof_attach_vars(out, parsed, VARS, tolerance=tolerance)
+        pd.testing.assert_frame_equal(attached, reference_asof_attach_vars(out, parsed, VARS, tolerance), check_dtype=False)
+    assert joined['absent (MB)'].isna().all() and attached['absent (MB)'].isna().all()
@@ -0,0 +1,73 @@
+import glob
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from appended_store import FULL_PRECISION_VALUE_COLUMN, read_long_table, write_long_table
+from long_table import full_precision_qids, load_long_table, to_compact_long, value_dtype, qid_codes
+
+# The value dtype is decided per qid: every partition stores float32 values, the exact values of the full precision qids
+# (cumulative counters) are kept besides them and put back when reading with full_precision=True.
+
+LOOKUP = pd.DataFrame({
+    'qid_mapping': ['1::a', '2::counter', '2::b', '4::weather'],
+    'quantity_name': ['Speed', 'Vessel Propeller Shaft Revolutions (cumulative)', 'Torque', 'Wind'],
+    'source_name': ['s', 's', 's', 'Provider MB'],
+    'unit': ['kn', 'revs', 'N*m', 'm/s'],
+}).astype(object)
+
+
+def make_long_table(seed=0, n_rows=200):
+    rng = np.random.default_rng(seed)
+    qids = rng.choice(LOOKUP['qid_mapping'], n_rows)
+    values = np.where(qids == '2::counter', 5e7 + np.arange(n_rows) * 45.47, rng.normal(10, 3, n_rows))
+    values[rng.random(n_rows) < 0.1] = np.nan
+    return pd.DataFrame({
+        'utc_timestamp': pd.Timestamp('2024-01-31 23:00', tz='UTC') + pd.to_timedelta(np.arange(n_rows) * 30, unit='s'),  # two months
+        'qid_mapping': qids,
+        'value': values,
+        'time_delta_sec': np.full(n_rows, 30.0),
+    })
+
+
+def test_full_precision_qids_and_value_dtype():
+    assert full_precision_qids(LOOKUP) == ['2::counter']
+    assert value_dtype(qid_codes(['1::a', '2::b'], LOOKUP), LOOKUP) == np.float32
+    assert value_dtype(qid_codes(['1::a', '2::counter'], LOOKUP), LOOKUP) == np.float64
+    compact, _ = to_compact_long(make_long_table(), LOOKUP)
+    assert full_precision_qids(compact) == ['2::counter']
+
+
+def test_store_keeps_float32_values_and_exact_counters(tmp_path):
+    df = make_long_table()
+    compact, _ = to_compact_long(df, LOOKUP)
+    assert compact['value'].dtype == np.float64
+    write_long_table(compact, str(tmp_path), full_precision_qids=full_precision_qids(LOOKUP))
+
+    # every partition stores float32 values, only the counter rows have exact values
+    for path in glob.glob(str(tmp_path / '*' / '*' / '*.parquet')):
+        table = pq.read_table(path)
+        assert str(table.schema.field('value').type) == 'float'
+        exact = table.column(FULL_PRECISION_VALUE_COLUMN)
+        counter_rows = np.asarray(table.column('qid_mapping').to_pylist()) == '2::counter'
+        np.testing.assert_array_equal(exact.is_valid().to_numpy(zero_copy_only=False), counter_rows)
+
+    def by_time(table):
+        return table.sort_values(['utc_timestamp', 'qid_mapping'], kind='stable').reset_index(drop=True)
+
+    expected = by_time(df)
+    exact = by_time(read_long_table(str(tmp_path)))
+    assert exact['value'].dtype == np.float64 and FULL_PRECISION_VALUE_COLUMN not in exact.columns
+    counter = (expected['qid_mapping'] == '2::counter').to_numpy()
+    np.testing.assert_array_equal(exact['value'].to_numpy()[counter], expected['value'].to_numpy()[counter])
+    np.testing.assert_array_equal(exact['value'].to_numpy()[~counter], expected['value'].to_numpy(dtype=np.float32)[~counter].astype(np.float64))
+
+    rounded = by_time(read_long_table(str(tmp_path), full_precision=False))
+    assert rounded['value'].dtype == np.float32
+    np.testing.assert_array_equal(rounded['value'].to_numpy(), expected['value'].to_numpy(dtype=np.float32))
+
+    # without counters the loaded table is float32, with them float64 (and only their exact values)
+    assert load_long_table(str(tmp_path), LOOKUP, qids=['1::a', '4::weather'])['value'].dtype == np.float32
+    counters = load_long_table(str(tmp_path), LOOKUP, qids=['2::counter'], time_ordered=True)
+    assert counters['value'].dtype == np.float64
+    np.testing.assert_array_equal(counters['value'].to_numpy(), expected['value'].to_numpy()[counter])
+    assert load_long_table(str(tmp_path), LOOKUP, full_precision=False)['value'].dtype == np.float32
@@ -0,0 +1,28 @@
+import os
+import pandas as pd
+import pytest
+from benchmark import BENCHMARK_SIZES, HOT_FUNCTIONS, benchmark_size
+from run_pipeline import STAGE_NAMES
+
+# Smoke test of the benchmark: every stage has to finish on the synthetic data of the smallest benchmark size and of a single day
+# (the shortest data the benchmark is run on with --days) and leave aggregated and engineered tables with rows. The day of data of
+# seed 1 has no Northward Sea Water Velocity (Provider S) dropouts, so pre_agg_clean.py drops that column (its flag replaces it and
+# is all 0) and aggregate.py has to aggregate the filtered data without it.
+
+
+@pytest.mark.parametrize('size, days, seed, dropped', [
+    (min(BENCHMARK_SIZES, key=BENCHMARK_SIZES.get), None, 0, []),
+    ('1day', 1.0, 1, ['Vessel External Conditions Northward Sea Water Velocity (Provider S)']),
+])
+def test_smallest_size_runs_end_to_end(tmp_path, size, days, seed, dropped):
+    results = benchmark_size(size, work_dir=str(tmp_path), days=days, seed=seed)
+
+    assert results['rows'] > 0
+    assert list(results['stages']) == STAGE_NAMES
+    assert set(results['hot_functions']) == {f'{module}.{function}' for module, function, _ in HOT_FUNCTIONS}
+
+    data_dir = tmp_path / size / 'data'
+    assert not set(dropped) & set(pd.read_csv(data_dir / 'filtered' / 'filtered.csv', nrows=0).columns)
+    for name in sorted(os.listdir(data_dir / 'aggregated')):
+        assert len(pd.read_csv(data_dir / 'aggregated' / name)) > 0, name
+    assert len(pd.read_csv(data_dir / 'engineered' / 'engineered_features_15min.csv')) > 0
@@ -0,0 +1,114 @@
+import numpy as np
+import pandas as pd
+import pytest
+from config import DROPOUT_RULES, SEAWATER_VELOCITY_DROPOUT_VALUE, SHAFT_POWER_MAX_DEVIATION
+from dropout_rules import apply_dropout_rules
+from pre_agg_clean import deal_with_dropouts
+from quality_flags import flag_counts, flag_mask
+
+
+def test_sentinel_matches_values_stored_as_float32():
+    # the synchronized values come from the float32 long table and are cleaned as float64
+    stored = np.array([SEAWATER_VELOCITY_DROPOUT_VALUE, 0.3, np.nan, SEAWATER_VELOCITY_DROPOUT_VALUE, -0.41], dtype=np.float32)
+    df = pd.DataFrame({'velocity': stored.astype(np.float64), 'exact': [SEAWATER_VELOCITY_DROPOUT_VALUE, 0.3, np.nan, 1.0, -0.41]})
+    rules = [
+        {'flag': 'velocity dropout', 'predicate': 'equals', 'threshold': SEAWATER_VELOCITY_DROPOUT_VALUE, 'columns': ['velocity']},
+        {'flag': 'exact dropout', 'predicate': 'equals', 'threshold': SEAWATER_VELOCITY_DROPOUT_VALUE, 'columns': ['exact']},
+    ]
+    quality_flags = {}
+    df, counts = apply_dropout_rules(df, rules, quality_flags)
+    assert counts == {'velocity dropout': 2, 'exact dropout': 1}
+    assert flag_counts(df, quality_flags) == counts
+    np.testing.assert_array_equal(df['velocity'].isna(), [True, False, True, True, False])
+    np.testing.assert_array_equal(df['exact'].isna(), [True, False, True, False, False])
+
+
+# deal_with_dropouts has to match the former chain of _replace_* functions (one pandas scan and flag column per rule, in this order)
+SHAFT_POWER = 'Vessel Propeller Shaft Mechanical Power'
+RPM = 'Vessel Propeller Shaft Rotational Speed'
+TORQUE = 'Vessel Propeller Shaft Torque'
+ENGINE_RPM = 'Main Engine Rotational Speed'
+SEA_TEMPERATURE = 'Vessel External Conditions Sea Water Temperature (Provider S)'
+BELOW_ZERO = {
+    'Negative Wave Height (Provider MB)': 'Vessel External Conditions Wave Significant Height (Provider MB)',
+    'Negative Wave Height (Provider S)': 'Vessel External Conditions Wave Significant Height (Provider S)',
+    'Negative Wind Speed': 'Vessel External Conditions Wind True Speed (Provider MB)',
+    'Negative Wave Period': 'Vessel External Conditions Wave Period (Provider S)',
+    'Negative Sea Temperature': SEA_TEMPERATURE,
+    'Negative Hull Over Ground Speed': 'Vessel Hull Over Ground Speed',
+    'Negative Main Engine Rotational Speed': ENGINE_RPM,
+}
+ANGLES = {
+    'Impossible Wind Relative Angle': 'Vessel External Conditions Wind Relative Angle',
+    'Impossible Vessel Heading': 'Vessel Hull Heading True Angle',
+    'Impossible Vessel External Conditions Wind True Angle (Provivider MB)': 'Vessel External Conditions Wind True Angle (Provider MB)',
+    'Vessel External Conditions Wave True Angle (Provider S)': 'Vessel External Conditions Wave True Angle (Provider S)',
+}
+VELOCITIES = ['Vessel External Conditions Eastward Sea Water Velocity (Provider S)', 'Vessel External Conditions Northward Sea Water Velocity (Provider S)']
+
+
+def make_sensor_frame(seed=0, n_rows=400):
+    rng = np.random.default_rng(seed)
+    rpm = rng.choice([0.0, 60.0, -20.0], n_rows) + rng.normal(0, 1, n_rows).round()
+    torque = rng.normal(1e5, 1e4, n_rows)
+    columns = {
+        RPM: rpm,
+        ENGINE_RPM: rng.choice([0.0, 70.0, -1.0], n_rows),
+        TORQUE: torque,
+        SHAFT_POWER: torque * rpm * 2 * np.pi / 60 * rng.choice([1.0, 1.01, 1.1, -1.0], n_rows),
+        SEA_TEMPERATURE: rng.uniform(-2, 20, n_rows),
+        **{col: rng.uniform(-1, 10, n_rows) for col in BELOW_ZERO.values() if col not in (SEA_TEMPERATURE, ENGINE_RPM)},
+        **{col: rng.uniform(-20, 380, n_rows) for col in ANGLES.values()},
+        **{col: rng.choice([SEAWATER_VELOCITY_DROPOUT_VALUE, 0.0, 0.5], n_rows) for col in VELOCITIES},
+    }
+    df = pd.DataFrame(columns)
+    df[df.columns] = df.where(rng.random(df.shape) > 0.05)
+    return df
+
+
+def reference_dropouts(df):
+    df, flags = df.copy(), {}
+
+    def replace(flag, condition, columns):
+        df.loc[condition, columns] = np.nan
+        df[flag] = condition.astype(int)
+        flags[flag] = condition.to_numpy()
+
+    replace('Inconsistent Engine and Propeller RPM', (df[RPM] == 0) & (df[ENGINE_RPM] > 0), [RPM, ENGINE_RPM])
+    replace('Inconsistent Propeller RPM and Shaft Power', (df[RPM] > 0) & (df[SHAFT_POWER] < 0) | (df[RPM] < 0) & (df[SHAFT_POWER] > 0), [RPM, SHAFT_POWER])
+    for flag, col in BELOW_ZERO.items():
+        replace(flag, df[col] < 0, [col])
+    replace('Sea Temperature Dropout', df[SEA_TEMPERATURE] <= 6, [SEA_TEMPERATURE])
+    for flag, col in ANGLES.items():
+        replace(flag, (df[col] < 0) | (df[col] > 360), [col])
+    df['Calculated Shaft Power'] = (df[TORQUE] * df[RPM] * 2 * np.pi) / 60
+    replace('Unreliable Shaft / Torque / RPM relation', (df[SHAFT_POWER] - df['Calculated Shaft Power']).abs() > (SHAFT_POWER_MAX_DEVIATION * df['Calculated Shaft Power'].abs()),
+            [SHAFT_POWER, TORQUE, RPM])
+    for col in VELOCITIES:
+        replace(col, df[col] == -0.4, [col])
+    return df, flags
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_dropout_rules_match_the_former_chain(seed):
+    df = make_sensor_frame(seed)
+    expected, expected_flags = reference_dropouts(df)
+    quality_flags = {}
+    cleaned, counts = deal_with_dropouts(df.copy(), quality_flags, {})
+
+    assert list(counts) == list(expected_flags)
+    for flag, mask in expected_flags.items():
+        assert counts[flag] == mask.sum() > 0, flag
+        if flag not in df.columns:
+            np.testing.assert_array_equal(flag_mask(cleaned, quality_flags, flag), mask, err_msg=flag)
+    # the data columns (incl. the flags named like them) and the derived column
+    data_columns = list(df.columns) + ['Calculated Shaft Power']
+    pd.testing.assert_frame_equal(cleaned[data_columns], expected[data_columns], check_dtype=False)
+
+
+def test_rules_with_missing_columns_are_skipped():
+    df = make_sensor_frame().drop(columns=[TORQUE])
+    quality_flags = {}
+    cleaned, counts = apply_dropout_rules(df.copy(), DROPOUT_RULES, quality_flags)
+    assert 'Unreliable Shaft / Torque / RPM relation' not in counts and 'Calculated Shaft Power' not in cleaned.columns
+    assert len(counts) == len(DROPOUT_RULES) - 1
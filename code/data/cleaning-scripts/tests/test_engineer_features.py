@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+import pytest
+import engineer_features
+from config import FEATURES, JANUARY_CLEANING_DATE, JULY_CLEANING_DATE
+from engineer_features import FEATURE_FUNCTIONS, compute_features, feature_inputs, load_engineered, resolve_features
+
+# The registered features have to match the former hardcoded feature functions. A feature is only computed when it is requested
+# (with the features it depends on) and its cached column is used as long as its definition and input columns did not change.
+
+
+def make_aggregated_frame(seed=0, n_rows=200):
+    rng = np.random.default_rng(seed)
+    window_start = pd.Timestamp('2024-01-01', tz='UTC') + pd.to_timedelta(np.sort(rng.choice(365 * 96, n_rows, replace=False)) * 15, unit='min')
+    return pd.DataFrame({
+        'window_start': window_start,
+        'Fwd Draft (Noon Report)': rng.uniform(8, 12, n_rows),
+        'Aft Draft (Noon Report)': np.where(rng.random(n_rows) < 0.1, np.nan, rng.uniform(9, 13, n_rows)),
+        'Vessel Hull Over Ground Speed (knots)': rng.normal(12, 1, n_rows),
+    }).sample(frac=1, random_state=seed).reset_index(drop=True)  # the features must not depend on the row order
+
+
+def reference_features(df):
+    cleaning = pd.Series(pd.to_datetime([JANUARY_CLEANING_DATE, JULY_CLEANING_DATE], utc=True)).sort_values().dt.as_unit(df['window_start'].dt.unit)
+    merged = pd.merge_asof(pd.DataFrame({'window_start': df['window_start'], '_row_order': np.arange(len(df))}).sort_values('window_start'),
+                           pd.DataFrame({'cleaning_date': cleaning}), left_on='window_start', right_on='cleaning_date', direction='backward')
+    days = ((merged['window_start'] - merged['cleaning_date']).dt.total_seconds() / 86400).to_numpy()[np.argsort(merged['_row_order'].to_numpy())]
+    return df.assign(**{'Days Since Last Cleaning': days,
+                        'Avg Draft (Calculated)': (df['Fwd Draft (Noon Report)'] + df['Aft Draft (Noon Report)']) / 2})
+
+
+def counting_functions(monkeypatch):
+    """Counts the calls of the feature functions (the sources, part of the cache keys, stay the same during a test)."""
+    calls = []
+    for name, function in list(FEATURE_FUNCTIONS.items()):
+        monkeypatch.setitem(FEATURE_FUNCTIONS, name, lambda *args, _function=function, _name=name, **kwargs: calls.append(_name) or _function(*args, **kwargs))
+    return calls
+
+
+def test_registered_features_match_the_former_functions(tmp_path):
+    df = make_aggregated_frame()
+    engineered = compute_features(df.copy(), cache_dir=str(tmp_path))
+    pd.testing.assert_frame_equal(engineered, reference_features(df))
+
+
+def test_features_are_computed_on_request_and_cached(tmp_path, monkeypatch):
+    calls = counting_functions(monkeypatch)
+    df = make_aggregated_frame()
+    cache_dir = str(tmp_path)
+
+    # only the requested feature is computed
+    subset = compute_features(df.copy(), ['Avg Draft (Calculated)'], cache_dir=cache_dir)
+    assert calls == ['mean'] and 'Days Since Last Cleaning' not in subset.columns
+
+    # the cached feature is reused, only the new one is computed
+    calls.clear()
+    engineered = compute_features(df.copy(), cache_dir=cache_dir)
+    assert calls == ['days_since_last']
+    calls.clear()
+    pd.testing.assert_frame_equal(compute_features(df.copy(), cache_dir=cache_dir), engineered)
+    assert calls == []
+
+    # a changed input column only recomputes the features that read it
+    changed = df.copy()
+    changed.loc[0, 'Aft Draft (Noon Report)'] = 20.0
+    changed = compute_features(changed, cache_dir=cache_dir)
+    assert calls == ['mean']
+    pd.testing.assert_frame_equal(changed, reference_features(changed.drop(columns=['Days Since Last Cleaning', 'Avg Draft (Calculated)'])))
+
+    # the window length is part of the key
+    calls.clear()
+    compute_features(df.copy(), ['Avg Draft (Calculated)'], window_length='1h', cache_dir=cache_dir)
+    assert calls == ['mean']
+
+
+def test_features_depending_on_features():
+    features = FEATURES + [{'name': 'Mean Of Avg Draft And Speed', 'function': 'mean', 'columns': ['Avg Draft (Calculated)', 'Vessel Hull Over Ground Speed (knots)']}]
+    assert [feature['name'] for feature in resolve_features(['Mean Of Avg Draft And Speed'], features)] == ['Avg Draft (Calculated)', 'Mean Of Avg Draft And Speed']
+    assert feature_inputs(['Mean Of Avg Draft And Speed'], features) == ['Fwd Draft (Noon Report)', 'Aft Draft (Noon Report)', 'Vessel Hull Over Ground Speed (knots)']
+    assert [feature['name'] for feature in resolve_features(None, features)] == [feature['name'] for feature in features]
+    with pytest.raises(KeyError, match='Unknown features'):
+        resolve_features(['Unknown Feature'], features)
+
+
+def test_load_engineered_reads_only_the_requested_columns(tmp_path, monkeypatch):
+    monkeypatch.setattr(engineer_features, 'aggregated_dir', str(tmp_path / 'aggregated'))
+    monkeypatch.setattr(engineer_features, 'engineered_dir', str(tmp_path / 'engineered'))
+    (tmp_path / 'aggregated').mkdir()
+    df = make_aggregated_frame()
+    df.to_csv(tmp_path / 'aggregated' / 'aggregated_15min.csv', index=False)
+
+    loaded = load_engineered(['Avg Draft (Calculated)', 'Vessel Hull Over Ground Speed (knots)'], window_length='15min')
+    assert list(loaded.columns) == ['window_start', 'Avg Draft (Calculated)', 'Vessel Hull Over Ground Speed (knots)']
+    expected = reference_features(df)
+    np.testing.assert_allclose(loaded['Avg Draft (Calculated)'], expected['Avg Draft (Calculated)'])
+    assert (tmp_path / 'engineered' / 'features' / '15min' / 'Avg_Draft_Calculated.parquet').is_file()
+    assert not (tmp_path / 'engineered' / 'features' / '15min' / 'Days_Since_Last_Cleaning.parquet').exists()
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import pytest
+from merge_ingest import NAT_INT64, kway_merge, sort_source, time_deltas
+
+# The k-way merge has to equal a stable sort of the concatenated sources (ties across sources in source order), and the chunked
+# time deltas have to equal df.groupby(qid)['utc_timestamp'].diff() over all chunks, continued from the last timestamps per qid.
+
+
+def make_sources(seed, n_sources=4, max_rows=30, distinct_times=12):
+    rng = np.random.default_rng(seed)
+    sources = []
+    for i in range(n_sources):
+        n_rows = int(rng.integers(0, max_rows))  # empty sources included
+        sources.append({
+            'utc_timestamp': np.sort(rng.integers(0, distinct_times, n_rows)).astype(np.int64) * 1_000_000_000,  # many ties
+            'source': np.full(n_rows, i),
+            'position': np.arange(n_rows),
+        })
+    return sources
+
+
+def reference_merge(sources):
+    df = pd.concat([pd.DataFrame(source) for source in sources], ignore_index=True)
+    return df.sort_values('utc_timestamp', kind='stable').reset_index(drop=True)
+
+
+@pytest.mark.parametrize('seed', range(6))
+@pytest.mark.parametrize('block_rows, chunk_rows', [(1, 1), (2, 5), (3, 1000), (64, 10)])
+def test_kway_merge_equals_stable_sort(seed, block_rows, chunk_rows):
+    sources = make_sources(seed)
+    chunks = list(kway_merge(sources, block_rows, chunk_rows))
+    merged = pd.DataFrame({key: np.concatenate([chunk[key] for chunk in chunks]) for key in sources[0]}) if chunks else pd.DataFrame(columns=list(sources[0]))
+    expected = reference_merge(sources)
+    assert len(merged) == len(expected)
+    for key in expected.columns:
+        np.testing.assert_array_equal(merged[key].to_numpy(), expected[key].to_numpy(), err_msg=key)
+    assert all(len(chunk['utc_timestamp']) >= chunk_rows for chunk in chunks[:-1])
+
+
+def test_kway_merge_single_timestamp():
+    # every row has the same timestamp, the lookahead has to grow until the sources are exhausted
+    sources = [{'utc_timestamp': np.zeros(n, dtype=np.int64), 'source': np.full(n, i)} for i, n in enumerate([5, 0, 3, 1])]
+    merged = np.concatenate([chunk['source'] for chunk in kway_merge(sources, 1, 1)])
+    np.testing.assert_array_equal(merged, [0] * 5 + [2] * 3 + [3])
+
+
+def test_sort_source():
+    source = {'utc_timestamp': np.array([3, 1, 2, 1], dtype=np.int64), 'value': np.array([0, 1, 2, 3])}
+    sorted_source = sort_source(source)
+    np.testing.assert_array_equal(sorted_source['value'], [1, 3, 2, 0])
+    assert sort_source(sorted_source) is sorted_source
+
+
+def reference_time_deltas(timestamps, codes, last_timestamps):
+    """groupby(code).diff() with the last timestamps per code as extra first rows, NaN for unknown qids (code -1)."""
+    known = np.flatnonzero(last_timestamps != NAT_INT64)
+    df = pd.concat([
+        pd.DataFrame({'ts': last_timestamps[known], 'code': known, 'row': -1}),
+        pd.DataFrame({'ts': timestamps, 'code': codes, 'row': np.arange(len(timestamps))}),
+    ], ignore_index=True)
+    df['delta'] = df.groupby('code')['ts'].diff() / 1e9
+    df.loc[df['code'] < 0, 'delta'] = np.nan
+    return df[df['row'] >= 0]['delta'].to_numpy()
+
+
+@pytest.mark.parametrize('seed', range(6))
+def test_time_deltas_over_chunks_match_pandas(seed):
+    rng = np.random.default_rng(seed)
+    n_codes, n_rows = 5, 60
+    timestamps = np.sort(rng.integers(1_000, 1_040, n_rows)).astype(np.int64) * 1_000_000_000  # ties within and across qids
+    codes = rng.integers(-1, n_codes, n_rows).astype(np.int16)
+    initial = np.full(n_codes, NAT_INT64, dtype=np.int64)
+    initial[rng.random(n_codes) < 0.5] = 990 * 1_000_000_000  # some qids were ingested before
+    expected = reference_time_deltas(timestamps, codes, initial)
+
+    last_timestamps = initial.copy()
+    bounds = np.sort(rng.choice(np.arange(1, n_rows), 3, replace=False))
+    deltas = np.concatenate([time_deltas(timestamps[lo:hi], codes[lo:hi], last_timestamps)
+                             for lo, hi in zip(np.r_[0, bounds], np.r_[bounds, n_rows])])
+    assert deltas.dtype == np.float32
+    np.testing.assert_allclose(deltas, expected, rtol=1e-6, equal_nan=True)
+
+    # the last timestamp of every qid that occurred is carried over, the others keep their initial value
+    for code in range(n_codes):
+        rows = timestamps[codes == code]
+        assert last_timestamps[code] == (rows[-1] if len(rows) else initial[code])
@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+from quality_flags import FLAG_WORD_PREFIX, export_flags, flag_counts, flag_mask, set_flags
+
+# The flag words have to behave like one boolean column per flag: through filters and reorderings of the rows, when a flag is set
+# again, and for more flags than fit into one word.
+
+
+def test_flag_words_match_boolean_columns():
+    rng = np.random.default_rng(0)
+    n_rows, n_flags = 50, 70  # two flag words
+    df = pd.DataFrame({'value': rng.normal(size=n_rows)}, index=rng.permutation(n_rows))
+    reference = pd.DataFrame(index=df.index)
+    quality_flags = {}
+
+    flags = {f'flag {i}': rng.random(n_rows) < 0.3 for i in range(n_flags)}
+    set_flags(df, quality_flags, dict(list(flags.items())[:40]))
+    set_flags(df, quality_flags, dict(list(flags.items())[40:]))
+    for name, mask in flags.items():
+        reference[name] = mask
+    assert list(quality_flags) == list(flags) and quality_flags['flag 69'] == 69
+    assert sorted(col for col in df.columns if col.startswith(FLAG_WORD_PREFIX)) == [f'{FLAG_WORD_PREFIX}0', f'{FLAG_WORD_PREFIX}1']
+
+    # setting a flag again replaces it (as a Series aligned with the rows), the other flags of the word are kept
+    changed = pd.Series(rng.random(n_rows) < 0.5, index=df.index)
+    set_flags(df, quality_flags, {'flag 3': changed, 'flag 64': ~changed})
+    reference['flag 3'], reference['flag 64'] = changed, ~changed
+
+    # row filters and reorderings
+    rows = rng.permutation(n_rows)[:35]
+    df, reference = df.iloc[rows], reference.iloc[rows]
+
+    for name in flags:
+        np.testing.assert_array_equal(flag_mask(df, quality_flags, name), reference[name].to_numpy(), err_msg=name)
+    assert flag_counts(df, quality_flags) == {name: int(reference[name].sum()) for name in flags}
+    assert flag_counts(df, quality_flags, ['flag 65', 'flag 2']) == {'flag 65': int(reference['flag 65'].sum()), 'flag 2': int(reference['flag 2'].sum())}
+
+    exported = export_flags(df, quality_flags, ['flag 64', 'flag 1'])
+    assert list(exported.columns) == ['value', 'flag 64', 'flag 1']
+    assert exported.index.equals(df.index)
+    pd.testing.assert_frame_equal(exported[['flag 64', 'flag 1']], reference[['flag 64', 'flag 1']].astype(int))
+
+
+def test_empty_frame():
+    df = pd.DataFrame({'value': np.array([], dtype=float)})
+    quality_flags = {}
+    set_flags(df, quality_flags, {'a': np.array([], dtype=bool)})
+    assert flag_counts(df, quality_flags) == {'a': 0}
+    assert list(export_flags(df, quality_flags, ['a']).columns) == ['value', 'a']
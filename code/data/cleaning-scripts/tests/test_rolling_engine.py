@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+import pytest
+from rolling_engine import segment_prefix_sums, rolling_statistics
+from conftest import SEGMENT_LAYOUTS, make_segment_frame
+
+# The rolling statistics have to match df.groupby('seg_id')[col].transform(lambda x: x.rolling(window, min_periods).<statistic>()),
+# the pandas code they replace in pre_agg_clean.py.
+
+COLUMNS = {
+    'a': lambda rng, n_rows: rng.normal(10, 3, n_rows),
+    'b': lambda rng, n_rows: rng.choice([1.0, 2.0, 2.0, 5.0], n_rows),  # ties and constant windows (std 0)
+    'c': lambda rng, n_rows: rng.normal(1e6, 1, n_rows),  # large offset, small variance
+}
+
+
+def make_frame(layout):
+    return make_segment_frame(SEGMENT_LAYOUTS[layout], COLUMNS, nan_share=0.25, shuffle_index=True)
+
+
+def reference(df, col, window, min_periods, statistic):
+    return df.groupby('seg_id')[col].transform(lambda x: getattr(x.rolling(window=window, min_periods=min_periods), statistic)())
+
+
+@pytest.mark.parametrize('layout', list(SEGMENT_LAYOUTS))
+@pytest.mark.parametrize('window, min_periods', [(1, 1), (3, 1), (3, 3), (4, 0), (4, 2), (5, 5), (20, 1)])
+def test_rolling_statistics_match_pandas(layout, window, min_periods):
+    df = make_frame(layout)
+    result = rolling_statistics(segment_prefix_sums(df, ['a', 'b', 'c']), window, min_periods)
+    for statistic in ['count', 'mean', 'std']:
+        assert list(result[statistic].columns) == ['a', 'b', 'c']
+        assert result[statistic].index.equals(df.index)
+        for col in ['a', 'b', 'c']:
+            expected = reference(df, col, window, min_periods, statistic)
+            np.testing.assert_allclose(result[statistic][col].to_numpy(), expected.to_numpy(), rtol=1e-7, atol=1e-7, equal_nan=True,
+                                       err_msg=f'{statistic} of {col}')
+
+
+def test_all_nan_column_and_cache():
+    df = make_frame('contiguous')
+    df['a'] = np.nan
+    prefix_sums = segment_prefix_sums(df, ['a', 'b'])
+    result = rolling_statistics(prefix_sums, 3, 1)
+    assert result['mean']['a'].isna().all() and result['std']['a'].isna().all()
+    assert (result['count']['a'] == 0).all()
+    # a second window size is computed from the same prefix sums, the first one is cached
+    np.testing.assert_allclose(rolling_statistics(prefix_sums, 5, 2)['mean']['b'], reference(df, 'b', 5, 2, 'mean'), equal_nan=True)
+    assert rolling_statistics(prefix_sums, 3, 1)['mean'].equals(result['mean'])
+
+
+def test_empty_frame():
+    df = pd.DataFrame({'seg_id': np.array([], dtype=np.int64), 'a': np.array([], dtype=float)})
+    result = rolling_statistics(segment_prefix_sums(df, ['a']), 3, 1)
+    assert all(len(result[statistic]) == 0 for statistic in ['count', 'mean', 'std'])
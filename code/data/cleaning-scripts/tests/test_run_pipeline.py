@@ -0,0 +1,18 @@
+import subprocess
+import pytest
+import run_pipeline
+
+
+@pytest.mark.parametrize('name, full, expected', [
+    ('append', True, ['--full']),
+    ('add_noon_reps', True, ['--full']),
+    ('synchronize', True, ['--full']),
+    ('synchronize', False, []),
+    ('pre_agg_clean', True, []),  # not incremental, always rebuilds its outputs
+])
+def test_forced_incremental_stages_run_with_full(monkeypatch, name, full, expected):
+    calls = []
+    monkeypatch.setattr(run_pipeline.subprocess, 'run', lambda command, cwd: calls.append(command) or subprocess.CompletedProcess(command, 0))
+    stage = next(stage for stage in run_pipeline.STAGES if stage['name'] == name)
+    assert run_pipeline.run_stage(stage, full=full)
+    assert calls[0][1].endswith(f'{name}.py') and calls[0][2:] == expected
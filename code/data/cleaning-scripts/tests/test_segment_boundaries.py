@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pre_agg_clean import _filter_segment_start_and_ends
+from conftest import SEGMENT_LAYOUTS, make_segment_frame
+
+# The boundary trimming has to match the former per-segment loop of filter_nans: per segment (in order of their first row)
+# the first and last row are dropped if a required sensor variable is NaN, their weather values are moved to the neighbouring row.
+
+COLUMNS = {
+    'sensor_a': lambda rng, n_rows: rng.normal(10, 1, n_rows),
+    'sensor_b': lambda rng, n_rows: rng.normal(0, 1, n_rows),
+    'weather': lambda rng, n_rows: np.where(rng.random(n_rows) < 0.5, rng.normal(5, 1, n_rows), np.nan),  # hourly, mostly missing
+}
+
+
+def reference(df, weather_vars, sensor_vars):
+    def trim(segment):
+        if len(segment) < 3:
+            return segment
+        for position, neighbour in [(0, 1), (-1, -2)]:
+            if len(segment) < 2:
+                break
+            row, next_row = segment.index[position], segment.index[neighbour]
+            if segment.loc[row, sensor_vars].isna().any():
+                for col in weather_vars:
+                    if pd.notna(segment.loc[row, col]) and pd.isna(segment.loc[next_row, col]):
+                        segment.loc[next_row, col] = segment.loc[row, col]
+                segment = segment.drop(index=row)
+        return segment
+    return pd.concat([trim(segment.copy()) for _, segment in df.groupby('seg_id', sort=False)], ignore_index=True)
+
+
+@pytest.mark.parametrize('layout', list(SEGMENT_LAYOUTS))
+@pytest.mark.parametrize('seed', range(5))
+def test_trimming_matches_the_per_segment_loop(layout, seed):
+    df = make_segment_frame(SEGMENT_LAYOUTS[layout], COLUMNS, seed=seed, nan_share=0.4, shuffle_index=True)
+    expected = reference(df, ['weather'], ['sensor_a', 'sensor_b'])
+    # absent required variables are ignored
+    trimmed = _filter_segment_start_and_ends(df.copy(), ['weather', 'absent weather'], ['sensor_a', 'sensor_b', 'absent sensor'])
+    pd.testing.assert_frame_equal(trimmed, expected)
+
+
+def test_three_row_segment_keeps_the_weather_value_of_the_first_row():
+    df = pd.DataFrame({'seg_id': [1, 1, 1], 'sensor': [np.nan, 2.0, np.nan], 'weather': [7.0, np.nan, 8.0]})
+    trimmed = _filter_segment_start_and_ends(df, ['weather'], ['sensor'])
+    pd.testing.assert_frame_equal(trimmed, pd.DataFrame({'seg_id': [1], 'sensor': [2.0], 'weather': [7.0]}))
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+from config import NO_REPETITION_SENSOR_VARIABLES, REQUIRED_SENSOR_VARIABLES, REQUIRED_WEATHER_VARIABLES, SEAWATER_VELOCITY_DROPOUT_VALUE
+from pre_agg_clean import _segment_shards, clean_segments, clean_segments_parallel
+
+# Every cleaning step is row-local or confined to a seg_id, so cleaning size-balanced shards of whole segments in a process pool
+# has to give the same rows, flags and counts as cleaning the full data.
+
+STEADY_SENSORS = {
+    'Main Engine Rotational Speed': 75, 'Vessel Hull Over Ground Speed': 12, 'Vessel Hull Through Water Longitudinal Speed': 12,
+    'Vessel Hull Heading True Angle': 120, 'Vessel Propeller Shaft Rotational Speed': 70, 'Vessel Propeller Shaft Torque': 4e5,
+}
+
+
+def make_synchronized_frame(segment_lengths, seed=0):
+    """Synchronized 15s data of steady sailing with NaNs, spikes, repeated values, dropouts and hourly weather values."""
+    rng = np.random.default_rng(seed)
+    n_rows = sum(segment_lengths)
+    df = pd.DataFrame({'seg_id': np.repeat(np.arange(len(segment_lengths)) * 3 + 1, segment_lengths)})
+    for col in REQUIRED_SENSOR_VARIABLES:
+        level = STEADY_SENSORS.get(col, rng.uniform(10, 100))
+        df[col] = level * (1 + rng.normal(0, 0.002, n_rows))
+    for col in NO_REPETITION_SENSOR_VARIABLES:
+        df.loc[rng.random(n_rows) < 0.05, col] = df[col].shift()  # repeated values
+    rpm, torque = df['Vessel Propeller Shaft Rotational Speed'], df['Vessel Propeller Shaft Torque']
+    df['Vessel Propeller Shaft Mechanical Power'] = torque * rpm * 2 * np.pi / 60 * rng.choice([1.0, 1.0, 1.0, 1.05], n_rows)
+    for col in ['Main Engine Rotational Speed', 'Main Engine Fuel Oil Inlet Mass Flow', 'Vessel External Conditions Wind Relative Speed']:
+        df.loc[rng.random(n_rows) < 0.01, col] *= 3  # spikes
+    for col in REQUIRED_WEATHER_VARIABLES:
+        df[col] = np.where(np.arange(n_rows) % 240 == rng.integers(240), rng.uniform(7, 10, n_rows).round(1), np.nan)  # hourly
+    df['Vessel External Conditions Northward Sea Water Velocity (Provider S)'] = rng.choice([SEAWATER_VELOCITY_DROPOUT_VALUE, 0.2, 0.3], n_rows)
+    for col in REQUIRED_SENSOR_VARIABLES:
+        df.loc[rng.random(n_rows) < 0.003, col] = np.nan
+    return df
+
+
+def test_shards_are_whole_segments_of_balanced_size():
+    df = make_synchronized_frame([500, 20, 300, 300, 1, 400])
+    shards = _segment_shards(df, 3)
+    assert [len(shard) for shard in shards] == [520, 600, 401]
+    assert pd.concat(shards).index.equals(df.index)
+    assert _segment_shards(df, 10)[0]['seg_id'].nunique() == 1
+
+
+@pytest.mark.parametrize('n_workers, shards_per_worker', [(2, 1), (2, 3)])
+def test_sharded_cleaning_matches_serial_cleaning(n_workers, shards_per_worker):
+    df = make_synchronized_frame([700, 30, 400, 2, 900, 600], seed=1)
+    expected, expected_flags, expected_counts = clean_segments(df.copy())
+    cleaned, quality_flags, step_counts = clean_segments_parallel(df.copy(), n_workers, shards_per_worker=shards_per_worker)
+
+    assert 0 < len(cleaned) < len(df)
+    pd.testing.assert_frame_equal(cleaned, expected)
+    assert quality_flags == expected_flags
+    assert step_counts == expected_counts
+    # the counts of every step are merged over the shards, not only the dropout counts
+    assert list(step_counts) == ['dropouts', 'repeated values', 'spikes']
+    for step in step_counts:
+        assert sum(step_counts[step].values()) > 0, step
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from spike_engine import hampel_spike_mask
+from conftest import SEGMENT_LAYOUTS, make_segment_frame
+
+# The spike mask has to match the former pandas Hampel filter of pre_agg_clean.py: per column a rolling median per segment,
+# the rolling median of the absolute deviations from it (MAD) and |x - median| > threshold * MAD.
+
+COLUMNS = {
+    'a': lambda rng, n_rows: rng.normal(10, 1, n_rows) * np.where(rng.random(n_rows) < 0.15, 3, 1),  # spikes
+    'b': lambda rng, n_rows: rng.choice([3.0, 3.0, 3.0, 4.0], n_rows),  # ties, the MAD is often 0
+}
+
+
+def make_frame(layout, seed=0):
+    return make_segment_frame(SEGMENT_LAYOUTS[layout], COLUMNS, seed=seed)
+
+
+def reference(df, col, threshold, window, min_periods):
+    def rolling_median(values):
+        return values.groupby(df['seg_id']).transform(lambda x: x.rolling(window=window, min_periods=min_periods).median())
+    median = rolling_median(df[col])
+    deviation = (df[col] - median).abs()
+    mad = rolling_median(deviation)
+    return (deviation > threshold * mad).to_numpy()
+
+
+@pytest.mark.parametrize('layout', list(SEGMENT_LAYOUTS))
+@pytest.mark.parametrize('window, min_periods', [(1, 1), (3, 1), (3, 3), (4, 2), (5, 0), (7, 7)])
+def test_hampel_spike_mask_matches_pandas(layout, window, min_periods):
+    df = make_frame(layout)
+    thresholds = [2.0, 1.0]
+    spikes = hampel_spike_mask(df, ['a', 'b'], thresholds, window, min_periods)
+    assert spikes.shape == (len(df), 2)
+    for column, (col, threshold) in enumerate(zip(['a', 'b'], thresholds)):
+        np.testing.assert_array_equal(spikes[:, column], reference(df, col, threshold, window, min_periods), err_msg=col)
+
+
+def test_windows_larger_than_a_chunk(monkeypatch):
+    # the windows are sorted in chunks of rows, the chunk borders must not change the result
+    import spike_engine
+    monkeypatch.setattr(spike_engine, 'MAX_WINDOW_VALUES_PER_CHUNK', 7)
+    df = make_frame('not contiguous', seed=1)
+    spikes = hampel_spike_mask(df, ['a', 'b'], [2.0, 1.0], 4, 2)
+    np.testing.assert_array_equal(spikes[:, 0], reference(df, 'a', 2.0, 4, 2))
+    np.testing.assert_array_equal(spikes[:, 1], reference(df, 'b', 1.0, 4, 2))
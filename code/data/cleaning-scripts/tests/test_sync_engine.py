@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sync_engine import rate_groups, synchronize_segment
+
+# A synchronized segment has to match the former pandas implementation of synchronize.py: per rate group a pivot of the observations
+# (pivot_table(aggfunc='first') if a (timestamp, qid) is duplicated), reindexed to the union with the grid of the group,
+# interpolate(method='linear', limit_area='inside'), the grid rows, and the outer join of the groups on the timestamps.
+
+QID_INTERVALS = {'q15_a': 15, 'q15_b': 15, 'q15_c': 15, 'q1h_a': 3600, 'q1h_b': 3600}
+START = pd.Timestamp('2024-01-01 00:00:00', tz='UTC')
+
+
+def reference(obs, start, end, groups, seg_id):
+    frames = []
+    for interval, group_qids, _ in groups:
+        grid = pd.date_range(start=start, end=end, freq=f'{interval}s')
+        group_obs = obs[obs['qid_mapping'].isin(group_qids)]
+        if group_obs.duplicated(subset=['utc_timestamp', 'qid_mapping']).any():
+            pivot = group_obs.pivot_table(index='utc_timestamp', columns='qid_mapping', values='value', aggfunc='first')
+        else:
+            pivot = group_obs.pivot(index='utc_timestamp', columns='qid_mapping', values='value')
+        combined = pivot.reindex(pivot.index.union(grid)).sort_index()
+        combined.interpolate(method='linear', limit_area='inside', inplace=True)
+        frames.append(combined.loc[grid].rename_axis('utc_timestamp').reset_index().assign(seg_id=seg_id)
+                      .reindex(columns=['utc_timestamp', 'seg_id'] + group_qids))
+    result = frames[0]
+    for frame in frames[1:]:
+        result = pd.merge(result, frame, on=['utc_timestamp', 'seg_id'], how='outer')
+    return result.sort_values('utc_timestamp').reset_index(drop=True)
+
+
+def run_engine(obs, start, end, seg_id=7):
+    """Synchronizes the observations with the engine and with the reference, in the same column order."""
+    obs = obs.sort_values('utc_timestamp', kind='stable').reset_index(drop=True)
+    qid_mapping = obs['qid_mapping'].astype(pd.CategoricalDtype(list(QID_INTERVALS)))
+    groups = rate_groups(list(pd.unique(obs['qid_mapping'])), qid_mapping.cat.categories, QID_INTERVALS)
+    result = synchronize_segment(
+        obs['utc_timestamp'].dt.as_unit('ns').astype('int64').to_numpy(), qid_mapping.cat.codes.to_numpy(), obs['value'].to_numpy(),
+        seg_id, start.as_unit('ns').value, end.as_unit('ns').value, groups,
+    )
+    return result, reference(obs, start, end, groups, seg_id)
+
+
+def assert_same(result, expected):
+    assert list(result.columns) == list(expected.columns)
+    assert (result['utc_timestamp'] == expected['utc_timestamp']).all()
+    assert (result['seg_id'] == expected['seg_id']).all()
+    for col in result.columns[2:]:
+        np.testing.assert_allclose(result[col].to_numpy(dtype=np.float64), expected[col].to_numpy(dtype=np.float64), rtol=1e-6, equal_nan=True, err_msg=col)
+
+
+def observations(rows):
+    """rows: (seconds after START, qid, value)."""
+    return pd.DataFrame({
+        'utc_timestamp': [START + pd.Timedelta(seconds=seconds) for seconds, _, _ in rows],
+        'qid_mapping': [qid for _, qid, _ in rows],
+        'value': np.array([value for _, _, value in rows], dtype=np.float64),
+    })
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_random_observations_match_pandas(seed, dtype):
+    rng = np.random.default_rng(seed)
+    end = START + pd.Timedelta(hours=3)
+    rows = []
+    for qid, interval in QID_INTERVALS.items():
+        if qid == 'q15_c' and seed % 2:
+            continue  # qid without observations in the segment
+        times = np.arange(0, 3 * 3600 + 1, interval) + rng.integers(-interval // 3, interval // 3 + 1, len(np.arange(0, 3 * 3600 + 1, interval)))
+        times = np.clip(times, 0, 3 * 3600)
+        rows += [(int(t), qid, float(v)) for t, v in zip(times, rng.normal(5, 2, len(times)))]
+    obs = observations(rows)
+    obs.loc[rng.random(len(obs)) < 0.1, 'value'] = np.nan
+    obs['value'] = obs['value'].astype(dtype)
+    assert_same(*run_engine(obs, START, end))
+
+
+def test_duplicates_and_nan_observations():
+    end = START + pd.Timedelta(minutes=2)
+    obs = observations([
+        (0, 'q15_a', 1.0), (7, 'q15_a', np.nan), (7, 'q15_a', 3.0), (7, 'q15_a', 9.0),  # first valid value of a duplicate is used
+        (20, 'q15_a', 5.0), (20, 'q15_b', np.nan), (50, 'q15_b', np.nan),  # a qid with only missing values
+        (3, 'q15_c', 2.0), (110, 'q15_c', 8.0), (33, 'q15_c', 4.0), (33, 'q15_c', 4.5),
+        (0, 'q1h_a', 3.0),
+    ])
+    assert_same(*run_engine(obs, START, end))
+
+
+def test_single_observations_and_short_segments():
+    # one observation per qid (only the grid point at its timestamp is inside), and segments with a single grid point
+    obs = observations([(15, 'q15_a', 2.0), (22, 'q15_b', 3.0), (0, 'q1h_a', 1.0), (10, 'q1h_b', 4.0)])
+    assert_same(*run_engine(obs, START, START + pd.Timedelta(seconds=45)))
+    assert_same(*run_engine(obs[obs['utc_timestamp'] == START], START, START))
+    assert_same(*run_engine(obs, START, START + pd.Timedelta(seconds=29)))
+
+
+def test_observations_between_grid_points_only():
+    # the grid points are interpolated over row positions of the union of observation and grid timestamps, not over time
+    obs = observations([(1, 'q15_a', 0.0), (2, 'q15_a', 100.0), (44, 'q15_a', 10.0), (46, 'q15_a', 20.0), (59, 'q15_a', 30.0)])
+    result, expected = run_engine(obs, START, START + pd.Timedelta(seconds=60))
+    assert_same(result, expected)
+    assert result['q15_a'].notna().sum() == 3
@@ -0,0 +1,106 @@
+import os
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+# Time gap detection on the observation arrays of the long table and the persisted gap index.
+#
+# An observation is a time gap if the time since the previous observation of the same qid deviates too much from the
+# intended sampling interval of the qid (Dalheim & Steen): |Δt_i - Δt_nominal| > THRESHOLD_FACTOR * Δt_nominal.
+# Δt_i is the time_delta_sec column of the long table, i.e. the difference of the sorted per-qid timestamps computed when appending,
+# so the gaps are found with one pass over the arrays without adding helper columns to the table.
+#
+# The gap index has one row per gap observation:
+#   qid          qid of the observation
+#   gap_start    timestamp of the previous observation of the qid
+#   gap_end      timestamp of the observation that was flagged
+#   magnitude    Δt_i - Δt_nominal in seconds (negative if the qid was sampled too often)
+# It is saved next to the synchronized segments, so later (incremental) runs and reports can use it without rescanning the long table.
+
+GAP_INDEX_NAME = '_gap_index.parquet'
+
+
+def nominal_intervals(qid_categories, sampling_intervals):
+    """Returns the intended sampling interval in seconds per qid code (NaN for qids without an interval, these never have gaps)."""
+    return pd.Index(qid_categories).map(lambda qid: sampling_intervals.get(qid, np.nan)).to_numpy(dtype=np.float64)
+
+
+def detect_time_gaps(time_delta_sec, codes, nominal_dt, threshold_factor):
+    """
+    This function flags the observations that are time gaps.
+
+    Args:
+        time_delta_sec: Seconds since the previous observation of the same qid (NaN for the first observation of a qid).
+        codes: qid codes of the observations.
+        nominal_dt: Intended sampling interval per qid code (see nominal_intervals).
+        threshold_factor: Tolerance as a fraction of the intended sampling interval.
+
+    Returns:
+        Row numbers of the gap observations (sorted).
+    """
+    nominal = np.where(codes >= 0, nominal_dt[codes], np.nan)
+    with np.errstate(invalid='ignore'):
+        return np.flatnonzero(np.abs(time_delta_sec - nominal) > threshold_factor * nominal)
+
+
+def gap_index(timestamps, codes, time_delta_sec, nominal_dt, gap_rows, qid_categories):
+    """Returns the gap index (see the comment at the top of this file) of the given gap rows."""
+    gap_end = timestamps[gap_rows]
+    gap_delta = time_delta_sec[gap_rows].astype(np.float64)
+    gap_codes = codes[gap_rows]
+    return pd.DataFrame({
+        'qid': pd.Index(qid_categories)[gap_codes].to_numpy(dtype=object),
+        'gap_start': pd.to_datetime(gap_end - np.round(gap_delta * 1e9).astype(np.int64), utc=True),
+        'gap_end': pd.to_datetime(gap_end, utc=True),
+        'magnitude': gap_delta - nominal_dt[gap_codes],
+    })
+
+
+def segments_from_gaps(unique_timestamps, gap_timestamps, seg_id_offset=0):
+    """
+    This function splits the time axis into segments at the gap timestamps.
+    The first segment starts at the first timestamp, every other segment starts at the timestamp after a gap, and every segment
+    ends at the gap that ends it (so a gap directly after another gap gives a segment of length zero). The timestamps after
+    the last gap form a last segment of length zero (its end is not known yet).
+
+    Args:
+        unique_timestamps: Sorted unique int64 ns timestamps of all observations.
+        gap_timestamps: Sorted unique int64 ns timestamps with at least one gap observation.
+        seg_id_offset: seg_id of the segment before the first one (for incremental runs).
+
+    Returns:
+        DataFrame indexed by seg_id with tz-aware start_time and end_time.
+    """
+    after_gap = np.searchsorted(unique_timestamps, gap_timestamps, side='right')
+    start_rows = np.concatenate([[0], after_gap])
+    end_times = gap_timestamps
+    if start_rows[-1] < len(unique_timestamps):
+        # last segment after the last gap
+        end_times = np.concatenate([end_times, unique_timestamps[start_rows[-1:]]])
+    else:
+        start_rows = start_rows[:-1]
+
+    return pd.DataFrame(
+        {
+            'start_time': pd.to_datetime(unique_timestamps[start_rows], utc=True),
+            'end_time': pd.to_datetime(end_times, utc=True),
+        },
+        index=pd.Index(np.arange(1, len(start_rows) + 1) + seg_id_offset, name='seg_id'),
+    )
+
+
+def save_gap_index(gaps, synchronized_dir):
+    """Saves the gap index to the synchronized data directory."""
+    os.makedirs(synchronized_dir, exist_ok=True)
+    gap_index_path = os.path.join(synchronized_dir, GAP_INDEX_NAME)
+    gaps.to_parquet(f'{gap_index_path}.tmp', index=False)
+    os.replace(f'{gap_index_path}.tmp', gap_index_path)
+    logger.info(f'Saved gap index with {len(gaps)} gaps to {gap_index_path}')
+
+
+def load_gap_index(synchronized_dir):
+    """Loads the gap index from the synchronized data directory. Returns None if there is none."""
+    gap_index_path = os.path.join(synchronized_dir, GAP_INDEX_NAME)
+    if not os.path.isfile(gap_index_path):
+        return None
+    return pd.read_parquet(gap_index_path)
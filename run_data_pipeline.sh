@@ -1,24 +1,3 @@
-echo "data pipeline started"
-
-python code/data/cleaning-scripts/metadata.py
-echo "metadata.py executed"
-
-python code/data/cleaning-scripts/append.py
-echo "append.py executed"
-
-python code/data/cleaning-scripts/add_noon_reps.py
-echo "add_noon_reps.py executed"
-
-python code/data/cleaning-scripts/synchronize.py
-echo "synchronize.py executed"
-
-python code/data/cleaning-scripts/pre_agg_clean.py
-echo "pre_agg_clean.py executed"
-
-python code/data/cleaning-scripts/aggregate.py
-echo "aggregate.py executed"
-
-python code/data/cleaning-scripts/engineer_features.py
-echo "engineer_features.py executed"
-
-echo "data pipeline finished"
\ No newline at end of file
+# Runs the data pipeline via the Python runner, which skips stages that are up to date.
+# Arguments are passed on, e.g. ./run_data_pipeline.sh --from aggregate (see run_pipeline.py --help)
+python code/data/cleaning-scripts/run_pipeline.py "$@"